@@ -8,6 +8,11 @@ from minio import Minio
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import subprocess
 
+# Graph and object store clients, shared by every container created in this process
+# Keyed by connection parameters, so batch jobs connect once per worker instead of once per container
+_graph_connections  = {}
+_object_store_clients = {}
+
 class Container(object):
     """
     Container: an abstraction with an id, name, namespace, type, and a list of associated data nodes
@@ -78,23 +83,31 @@ class Container(object):
         if isinstance(params, ConfigSet):
             params=params.get_config_set("APP_CFG")
 
-        # Connect to graph DB
-        self.logger.info ("Connecting to: %s", params['GRAPH_URI'])
-        self._conn = Neo4jConnection(uri=params['GRAPH_URI'], user=params['GRAPH_USER'], pwd=params['GRAPH_PASSWORD'])
-        self.logger.info ("Connection test: %s", self._conn.test_connection())
+        # Connect to graph DB, reusing this process's connection
+        graph_key = (params['GRAPH_URI'], params['GRAPH_USER'])
+        if graph_key not in _graph_connections:
+            self.logger.info ("Connecting to: %s", params['GRAPH_URI'])
+            _graph_connections[graph_key] = Neo4jConnection(uri=params['GRAPH_URI'], user=params['GRAPH_USER'], pwd=params['GRAPH_PASSWORD'])
+            self.logger.info ("Connection test: %s", _graph_connections[graph_key].test_connection())
+        self._conn = _graph_connections[graph_key]
 
         if params.get('OBJECT_STORE_ENABLED',  False):
-            self.logger.info ("Connecting to: %s", params['MINIO_URI'])
-            self._client = Minio(params['MINIO_URI'], access_key=params['MINIO_USER'], secret_key=params['MINIO_PASSWORD'], secure=False)
-            try:
-                for bucket in self._client.list_buckets():
-                    self.logger.debug("Found bucket %s", bucket.name )
-                self.logger.info("OBJECT_STORE_ENABLED=True")
-                params['OBJECT_STORE_ENABLED'] = True
-            except:
-                self.logger.warning("Could not connect to object store")
-                self.logger.warning("Set OBJECT_STORE_ENABLED=False")
-                params['OBJECT_STORE_ENABLED'] = False
+            object_store_key = (params['MINIO_URI'], params['MINIO_USER'])
+            if object_store_key not in _object_store_clients:
+                self.logger.info ("Connecting to: %s", params['MINIO_URI'])
+                client = Minio(params['MINIO_URI'], access_key=params['MINIO_USER'], secret_key=params['MINIO_PASSWORD'], secure=False)
+                try:
+                    for bucket in client.list_buckets():
+                        self.logger.debug("Found bucket %s", bucket.name )
+                    self.logger.info("OBJECT_STORE_ENABLED=True")
+                except:
+                    self.logger.warning("Could not connect to object store")
+                    self.logger.warning("Set OBJECT_STORE_ENABLED=False")
+                    client = None
+                _object_store_clients[object_store_key] = client
+
+            self._client = _object_store_clients[object_store_key]
+            params['OBJECT_STORE_ENABLED'] = self._client is not None
 
         self._host = socket.gethostname() # portable to *docker* containers
         self.logger.info ("Running on: %s", self._host)
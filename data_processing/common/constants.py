@@ -56,6 +56,15 @@ def CONFIG_LOCATION(cfg):
 def TABLE_LOCATION(cfg, is_source=False):
     return "{0}/tables/{1}".format(PROJECT_LOCATION(cfg), TABLE_NAME(cfg, is_source))
 
+def PULL_STATE_LOCATION(cfg):
+    """
+    State of incremental SlideViewer pulls, see data_processing/pathology/common/pull_state.py
+
+    :param cfg:
+    :return: ROOT_PATH/PROJECT_NAME/tables/{TABLE_NAME}_PULL_STATE
+    """
+    return "{0}_PULL_STATE".format(TABLE_LOCATION(cfg))
+
 def TABLE_NAME(cfg, is_source=False):
 
     if is_source:   
@@ -0,0 +1,64 @@
+'''
+Merge of new records into delta tables with a "latest" flag
+
+The latest records of a partition, e.g. (user, slide_id, labelset), are those updated last. Rather than
+recomputing the flag with a window over the whole table and overwriting it, merge_latest() flips the flag of the
+partitions touched by the updates only, in the same MERGE that upserts the records. Files of other partitions are
+not rewritten.
+'''
+import os
+
+from pyspark.sql.functions import col, lit
+
+# source column telling the merge what to do with each record
+MERGE_ACTION = "_merge_action"
+UPSERT = "upsert"
+RETIRE = "retire"
+
+
+def merge_latest(spark, df, table_path, uuid_column, partition_columns):
+    """
+    Upsert records into a delta table and flag the latest records of each partition
+
+    Records are matched on their uuid: existing records get the date_updated of the update, new records are
+    inserted. All records of df are flagged latest, as they share the date_updated of this run, and the previously
+    latest records of their partitions that aren't updated are flagged not latest.
+
+    :param spark: spark session
+    :param df: new records, with the uuid, partition, date_updated and latest columns
+    :param table_path: path to the delta table, created from df if it doesn't exist
+    :param uuid_column: record uuid column e.g. geojson_record_uuid
+    :param partition_columns: columns of the partitions of the latest flag e.g. ["user", "slide_id", "labelset"]
+    """
+    df = df.withColumn("latest", lit(True))
+
+    if not os.path.exists(table_path):
+        df.write.format("delta").save(table_path)
+        return
+
+    from delta.tables import DeltaTable
+    table = DeltaTable.forPath(spark, table_path)
+
+    # latest records of the touched partitions that are not updated
+    touched_df = df.select(partition_columns).distinct()
+    retire_df = table.toDF() \
+        .filter(col("latest")) \
+        .select([uuid_column] + partition_columns) \
+        .join(touched_df, on=partition_columns, how="left_semi") \
+        .join(df.select(uuid_column), on=uuid_column, how="left_anti") \
+        .select(uuid_column) \
+        .distinct() \
+        .withColumn(MERGE_ACTION, lit(RETIRE))
+
+    source_df = df.withColumn(MERGE_ACTION, lit(UPSERT)) \
+        .unionByName(retire_df, allowMissingColumns=True)
+
+    table.alias("main_table") \
+        .merge(source_df.alias("updates"), f"main_table.{uuid_column} = updates.{uuid_column}") \
+        .whenMatchedUpdate(condition=f"updates.{MERGE_ACTION} = '{UPSERT}'",
+                           set={"date_updated": "updates.date_updated", "latest": "true"}) \
+        .whenMatchedUpdate(condition=f"updates.{MERGE_ACTION} = '{RETIRE}'",
+                           set={"latest": "false"}) \
+        .whenNotMatchedInsert(condition=f"updates.{MERGE_ACTION} = '{UPSERT}'",
+                              values={column: f"updates.{column}" for column in df.columns}) \
+        .execute()
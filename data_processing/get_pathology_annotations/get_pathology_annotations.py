@@ -20,7 +20,7 @@ import data_processing.common.constants as const
 
 from pyspark.sql.functions import udf, lit
 from pyspark.sql.types import StringType, MapType
-from pyspark.sql.functions import  to_json
+from pyspark.sql.functions import  to_json, col
 
 import os, shutil, sys, importlib, json, yaml, subprocess, time, click
 from io import BytesIO
@@ -95,7 +95,11 @@ def getPathologyAnnotation(annotation_type, project,id, labelset):
         row = spark.read.format("delta").load(GEOJSON_TABLE_PATH).where(f"slide_id='{slide_id}' and labelset='{labelset.upper()}' and latest=True")
         if row.count() == 0:
                 return "No annotations match the provided query."
-        geojson = row.select(to_json(GEOJSON_COLUMN).alias("val")).head()['val']
+        # concatenated geojsons may be saved as strings, see SERIALIZED_CONCAT in refined_table/regional_annotation
+        if dict(row.dtypes)[GEOJSON_COLUMN] == 'string':
+                geojson = row.select(col(GEOJSON_COLUMN).alias("val")).head()['val']
+        else:
+                geojson = row.select(to_json(GEOJSON_COLUMN).alias("val")).head()['val']
         return geojson
 
 
@@ -5,7 +5,10 @@ Created: February 2021
 Given a slide (container) ID
 1. resolve the path to the WsiImage and TileLabels
 2. perform various scoring and labeling to tiles
-3. save tiles as a parquet file with schema [address, coordinates, *scores, *labels ]
+3. save tiles as a parquet file with schema [address, x, y, z, tile_key, *scores, *labels, data_path, object_bucket, object_path ]
+
+The tiles can be read back with data_processing.pathology.common.tile_slice_reader.TileSliceReader.from_parquet(),
+or data_processing.pathology.common.tile_shards.TileShardReader.from_parquet() for compressed tiles
 
 Example:
 python3 -m data_processing.pathology.cli.collect_tiles \
@@ -25,7 +28,7 @@ from data_processing.common.Container       import Container
 from data_processing.common.Node            import Node
 from data_processing.common.config          import ConfigSet
 
-from data_processing.pathology.common.preprocess import save_tiles
+from data_processing.pathology.common.preprocess import save_tiles, read_tile_index
 
 import pandas as pd
 import pyarrow.parquet as pq
@@ -89,9 +92,13 @@ def save_tiles_with_container(cohort_id: str, container_id: str, method_data: di
         if image_node is None:
             raise ValueError("Image node not found")
 
-        df = pd.read_csv(image_node.get_path(type="pathlib").joinpath("address.slice.csv"))
+        df = read_tile_index(image_node.get_path(type="pathlib").joinpath("address.slice.parquet")).reset_index()
+
+        # Compressed tiles are spread across shards, raw tiles are all in tiles.slice.pil
+        data_file = df["tile_shard"] if "tile_shard" in df.columns else "tiles.slice.pil"
+        df.loc[:,"data_path"]     = str(image_node.get_path(type="pathlib")) + "/" + data_file
         df.loc[:,"object_bucket"] = image_node.properties['object_bucket']
-        df.loc[:,"object_path"]   = image_node.properties['object_folder'] + "/tiles.slice.pil"
+        df.loc[:,"object_path"]   = image_node.properties['object_folder'] + "/" + data_file
         logger.info(df)
 
         output_container = Container( cfg ).setNamespace(cohort_id).lookupAndAttach(output_container_id)
@@ -0,0 +1,185 @@
+'''
+Given a cohort and a graph query or a list of slide (container) IDs
+1. run generate_tile_labels, visualize_tile_labels and collect_tiles for every slide, across a worker pool
+2. skip steps whose outputs already exist with the same input slide hash and params (--skip_existing), slides
+   whose size and mtime haven't changed since their output was made aren't hashed again
+3. report per-slide step timings
+
+Each worker process imports the pipeline and connects to the graph DB and object store once, and reuses
+them for all of its slides.
+
+The method params hold one section per step, each as in that step's own example json, see example_tile_cohort.json.
+Steps without a section are not run.
+
+Example:
+python3 -m data_processing.pathology.cli.tile_cohort \
+    -c TCGA-BRCA \
+    -q "MATCH (n:slide) RETURN n.qualified_address" \
+    -m data_processing/pathology/cli/example_tile_cohort.json \
+    -n 8 --skip_existing -o tile_cohort_timings.csv
+'''
+
+# General imports
+import os, json, sys, time
+import click
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# From common
+from data_processing.common.custom_logger   import init_logger
+from data_processing.common.Container       import Container
+from data_processing.common.Neo4jConnection import Neo4jConnection
+from data_processing.common.config          import ConfigSet
+
+from data_processing.pathology.common.preprocess        import get_slide_hash, get_params_hash
+from data_processing.pathology.cli.generate_tile_labels  import generate_tile_labels_with_container
+from data_processing.pathology.cli.visualize_tile_labels import visualize_tile_labels_with_container
+from data_processing.pathology.cli.collect_tiles         import save_tiles_with_container
+
+logger = init_logger("tile_cohort.log")
+cfg = ConfigSet("APP_CFG",  config_file="config.yaml")
+
+# (method params section, entry method, output node type), in pipeline order
+TILING_STEPS = [
+    ("generate_tile_labels",  generate_tile_labels_with_container,  "TileScores"),
+    ("visualize_tile_labels", visualize_tile_labels_with_container, "TileScores"),
+    ("collect_tiles",         save_tiles_with_container,            "TileImages"),
+]
+
+@click.command()
+@click.option('-c', '--cohort_id',    required=True)
+@click.option('-q', '--query',        default=None, help="graph query returning (node).qualified_address")
+@click.option('-l', '--slide_list',   default=None, help="file with one slide (container) ID per line")
+@click.option('-m', '--method_param_path',    required=True)
+@click.option('-n', '--num_processes', default=4, type=int)
+@click.option('--skip_existing', is_flag=True, default=False)
+@click.option('-o', '--report_file',  default=None, help="csv file for per-slide timings")
+def cli(cohort_id, query, slide_list, method_param_path, num_processes, skip_existing, report_file):
+    with open(method_param_path) as json_file:
+        method_data = json.load(json_file)
+
+    if (query is None) == (slide_list is None):
+        raise click.UsageError("Provide exactly one of --query or --slide_list")
+
+    if query is not None:
+        container_ids = get_container_ids(query)
+    else:
+        with open(slide_list) as fp:
+            container_ids = [line.strip() for line in fp if line.strip()]
+
+    df_timings = tile_cohort(cohort_id, container_ids, method_data, num_processes, skip_existing)
+
+    if report_file is not None:
+        df_timings.to_csv(report_file, index=False)
+        logger.info("Saved timings to %s", report_file)
+
+def get_container_ids(query):
+    """
+    Run a graph query returning (node).qualified_address, as the radiology service does
+
+    :param query: cypher query
+    :return: list of container IDs
+    """
+    conn    = Neo4jConnection(uri=cfg.get_value("APP_CFG::GRAPH_URI"), user=cfg.get_value("APP_CFG::GRAPH_USER"), pwd=cfg.get_value("APP_CFG::GRAPH_PASSWORD"))
+    records = [rec.data() for rec in conn.query(query)]
+    conn.close()
+
+    if not len(records) >= 1:
+        raise ValueError("No matching containers found!")
+    if not len(records[0].keys()) == 1 or not "qualified_address" in list(records[0].keys())[0]:
+        raise ValueError("Please only return (node).qualified_address")
+
+    return [list(rec.values())[0] for rec in records]
+
+def get_current_slide_hash(slide_path, output_node):
+    """
+    The slide hash, reused from the step output while the slide file size and mtime are the same as when it was made,
+    so only new or changed slides are read in full and hashed
+    """
+    slide_stat = os.stat(slide_path)
+    if output_node is not None and output_node.properties.get("slide_size") == slide_stat.st_size \
+            and output_node.properties.get("slide_mtime_ns") == slide_stat.st_mtime_ns:
+        return output_node.properties["slide_hash"]
+    return get_slide_hash(slide_path)
+
+def get_expected_params(container, step, step_data):
+    """
+    The params a step's entry method will receive (and hash into its output properties) for this container
+    """
+    params = dict(step_data)
+    if step == "generate_tile_labels":
+        params["slide_hash"] = get_current_slide_hash(container.get("wsi", step_data['input_wsi_tag']).get_path(),
+                                                      container.get("TileScores", step_data['job_tag']))
+    else:
+        label_node = container.get("TileScores", step_data['input_label_tag'])
+        if label_node is not None: params.update(label_node.properties)
+    return params
+
+def is_output_current(container, output_type, job_tag, params):
+    """
+    True if the step output exists and was made from the same params, including the input slide hash
+    """
+    output_node = container.get(output_type, job_tag)
+    return output_node is not None and output_node.properties.get("params_hash") == get_params_hash(params)
+
+def tile_slide(cohort_id: str, container_id: str, method_data: dict, skip_existing: bool):
+    """
+    Run the tiling steps for one slide
+
+    :return: dict with the container ID, status and seconds taken by each step
+    """
+    result = {"container_id": container_id, "status": "done"}
+    start  = time.perf_counter()
+
+    try:
+        container = Container( cfg ).setNamespace(cohort_id).lookupAndAttach(container_id)
+
+        for step, run_step, output_type in TILING_STEPS:
+            if step not in method_data: continue
+            step_data = method_data[step]
+            step_start = time.perf_counter()
+
+            params = get_expected_params(container, step, step_data)
+            if skip_existing and is_output_current(container, output_type, step_data['job_tag'], params):
+                result[step] = "skipped"
+                continue
+
+            # Pass the slide hash along so it isn't computed twice
+            run_step(cohort_id, container_id, dict(step_data, slide_hash=params["slide_hash"]) if step == "generate_tile_labels" else dict(step_data))
+            result[step] = round(time.perf_counter() - step_start, 3)
+
+            # Entry methods log their exceptions rather than raising, so check the output was saved
+            if not is_output_current(container, output_type, step_data['job_tag'], params):
+                result["status"] = f"failed: {step}"
+                break
+
+    except Exception:
+        logger.exception("Exception raised for %s, stopping slide", container_id)
+        result["status"] = "failed"
+
+    result["total"] = round(time.perf_counter() - start, 3)
+    return result
+
+def tile_cohort(cohort_id: str, container_ids: list, method_data: dict, num_processes: int, skip_existing: bool):
+    """
+    Run the tiling steps for all slides across a process pool
+
+    :return: pd.DataFrame of per-slide timings, see tile_slide()
+    """
+    logger.info("Tiling %s slides with %s processes", len(container_ids), num_processes)
+
+    results = []
+    with ProcessPoolExecutor(num_processes) as executor:
+        futures = [executor.submit(tile_slide, cohort_id, container_id, method_data, skip_existing) for container_id in container_ids]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            logger.info("Processed slides [%s,%s]: %s", len(results), len(container_ids), result)
+
+    df_timings = pd.DataFrame(results)
+    logger.info("Done: %s", df_timings.status.value_counts().to_dict())
+    return df_timings
+
+
+if __name__ == "__main__":
+    cli()
@@ -5,7 +5,7 @@ Created: February 2021
 Given a slide (container) ID
 1. resolve the path to the WSI image
 2. perform various scoring and labeling to tiles
-3. save tiles as a csv with schema [address, coordinates, *scores, *labels ]
+3. save tiles as a parquet file with schema [address, x, y, z, tile_key, *scores, *labels ]
 
 Example:
 python3 -m data_processing.pathology.cli.visualize_tile_labels \
@@ -0,0 +1,236 @@
+'''
+Run-length encoded storage for regional annotation bitmaps
+
+SlideViewer label bitmaps are stored at full slide resolution and are mostly background, so only the non-zero runs
+of each row are kept. A .rle.npz file holds:
+
+    shape        [height, width]
+    row_offsets  (height + 1,) int64, the runs of row r are run_*[row_offsets[r]:row_offsets[r + 1]]
+    run_starts   int32 column of the first pixel of each run
+    run_lengths  int32 number of pixels in each run
+    run_labels   label of each run, in the dtype of the bitmap
+
+RunLengthAnnotation reads a file back as an array-like bitmap: slicing it decodes a dense crop, so it can be used
+in place of the npy array by build_geojson.
+'''
+import numpy as np
+
+RLE_SUFFIX = ".rle.npz"
+
+# Rows encoded at once, bounds the memory used to encode a memory mapped bitmap
+RLE_STRIP_ROWS = 256
+
+
+class RunLengthAnnotation(object):
+    """
+    RunLengthAnnotation: a 2D label bitmap stored as the non-zero runs of each row
+
+    Example usage:
+    $ annotation = RunLengthAnnotation.load("/path/to/123_jill_SVBMP-123sdf_annot.rle.npz")
+    $ annotation.shape
+        > (2967, 2220)
+    $ annotation[1000:1512, 200:712].shape
+        > (512, 512)
+    $ annotation.to_array()
+    """
+
+    def __init__(self, shape, row_offsets, run_starts, run_lengths, run_labels):
+        """
+        :param shape: (height, width) of the bitmap
+        :param row_offsets: (height + 1,) index of the first run of each row
+        :param run_starts: column of the first pixel of each run
+        :param run_lengths: number of pixels in each run
+        :param run_labels: label of each run
+        """
+        self.shape       = tuple(int(n) for n in shape)
+        self.row_offsets = row_offsets
+        self.run_starts  = run_starts
+        self.run_lengths = run_lengths
+        self.run_labels  = run_labels
+
+    @classmethod
+    def from_array(cls, annotation, strip_rows=RLE_STRIP_ROWS):
+        """
+        Encode a bitmap strip by strip, so a memory mapped bitmap is never fully loaded
+
+        :param annotation: 2D array of unsigned integer labels, 0 being background
+        :param strip_rows: number of rows encoded at once
+        :return: RunLengthAnnotation
+        """
+        strips = ((row_start, annotation[row_start:row_start + strip_rows]) for row_start in range(0, annotation.shape[0], strip_rows))
+        return cls.from_strips(annotation.shape, annotation.dtype, strips)
+
+    @classmethod
+    def from_strips(cls, shape, dtype, strips):
+        """
+        Encode a bitmap from strips of rows, e.g. as read from a bmp by bmp_converter.iter_bmp_strips()
+
+        :param shape: (height, width) of the bitmap
+        :param dtype: unsigned integer dtype of the labels, 0 being background
+        :param strips: iterable of (row_start, 2D array of rows), in any order, covering all rows
+        :return: RunLengthAnnotation
+        """
+        if len(shape) != 2:
+            raise ValueError(f"Expected a 2D bitmap, got shape {shape}")
+
+        height, width = shape
+        row_counts = np.zeros(height, dtype=np.int64)
+        encoded_strips = []
+
+        for row_start, strip in strips:
+            if strip.ndim != 2 or strip.shape[1] != width or strip.dtype != dtype or not np.issubdtype(strip.dtype, np.unsignedinteger):
+                raise ValueError(f"Expected strips of {dtype} labels and width {width}, got {strip.dtype} array of shape {strip.shape}")
+            if strip.size == 0: continue
+            flat = np.asarray(strip).ravel()
+
+            # a run starts at each label change, and at the start of each row
+            is_start = np.empty(flat.size, dtype=bool)
+            is_start[0] = True
+            np.not_equal(flat[1:], flat[:-1], out=is_start[1:])
+            is_start[::width] = True
+
+            starts  = np.flatnonzero(is_start)
+            lengths = np.diff(starts, append=flat.size)
+            labels  = flat[starts]
+
+            keep = labels != 0
+            rows, cols = np.divmod(starts[keep], width)
+            row_counts[row_start:row_start + len(strip)] = np.bincount(rows, minlength=len(strip))
+
+            encoded_strips.append((row_start, cols.astype(np.int32), lengths[keep].astype(np.int32), labels[keep]))
+
+        encoded_strips.sort(key=lambda encoded_strip: encoded_strip[0])
+        row_offsets = np.concatenate([[0], np.cumsum(row_counts)])
+        return cls(shape, row_offsets,
+                   np.concatenate([np.zeros(0, dtype=np.int32)] + [run_starts for _, run_starts, _, _ in encoded_strips]),
+                   np.concatenate([np.zeros(0, dtype=np.int32)] + [run_lengths for _, _, run_lengths, _ in encoded_strips]),
+                   np.concatenate([np.zeros(0, dtype=dtype)] + [run_labels for _, _, _, run_labels in encoded_strips]))
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: path to a .rle.npz file
+        :return: RunLengthAnnotation
+        """
+        with np.load(path) as data:
+            return cls(data["shape"], data["row_offsets"], data["run_starts"], data["run_lengths"], data["run_labels"])
+
+    def save(self, path):
+        """
+        :param path: output path, should end with RLE_SUFFIX
+        """
+        with open(path, 'wb') as fp:
+            np.savez(fp, shape=np.array(self.shape), row_offsets=self.row_offsets,
+                     run_starts=self.run_starts, run_lengths=self.run_lengths, run_labels=self.run_labels)
+
+    @property
+    def dtype(self):
+        return self.run_labels.dtype
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def num_runs(self):
+        return len(self.run_labels)
+
+    def __getitem__(self, key):
+        """
+        Dense crop from row and column slices, e.g. annotation[100:200, 300:400] or annotation[100:200]
+        """
+        key = key if isinstance(key, tuple) else (key,)
+        if len(key) > 2 or not all(isinstance(k, slice) for k in key):
+            raise IndexError("RunLengthAnnotation only supports row and column slices")
+        key = key + (slice(None),) * (2 - len(key))
+
+        bounds = []
+        for k, size in zip(key, self.shape):
+            start, stop, step = k.indices(size)
+            if step != 1:
+                raise IndexError("RunLengthAnnotation only supports slices with step 1")
+            bounds.extend([start, max(start, stop)])
+
+        return self.get_crop(*bounds)
+
+    def __array__(self, dtype=None):
+        return self.to_array() if dtype is None else self.to_array().astype(dtype)
+
+    def to_array(self):
+        """
+        :return: the dense bitmap
+        """
+        return self.get_crop(0, self.shape[0], 0, self.shape[1])
+
+    def get_crop(self, row_start, row_stop, col_start, col_stop):
+        """
+        Decode a region of the bitmap
+
+        Runs don't overlap, so each row of the crop is the running sum of +label at the start and -label at the end
+        of each run, in the wrapping arithmetic of the unsigned label dtype.
+
+        :return: dense np.ndarray of shape (row_stop - row_start, col_stop - col_start)
+        """
+        first, last = self.row_offsets[row_start], self.row_offsets[row_stop]
+        rows   = np.repeat(np.arange(row_stop - row_start), np.diff(self.row_offsets[row_start:row_stop + 1]))
+        starts = self.run_starts[first:last].astype(np.int64)
+        stops  = starts + self.run_lengths[first:last]
+        labels = self.run_labels[first:last]
+
+        keep = (starts < col_stop) & (stops > col_start)
+        rows, labels = rows[keep], labels[keep]
+        starts = np.maximum(starts[keep], col_start) - col_start
+        stops  = np.minimum(stops[keep], col_stop) - col_start
+
+        deltas = np.zeros((row_stop - row_start, col_stop - col_start + 1), dtype=self.dtype)
+        deltas[rows, starts] += labels
+        deltas[rows, stops]  -= labels
+        return np.cumsum(deltas[:, :-1], axis=1, dtype=self.dtype)
+
+    def get_label_stats(self, block_size):
+        """
+        Pixel counts and block aligned bounding boxes of all labels, from the runs alone.
+        Same as build_geojson.get_label_stats() on the dense bitmap, without the background label 0.
+
+        :param block_size: bounding box granularity in pixels
+        :return: dict of label_num -> (num_pixels, (row_start, row_stop, col_start, col_stop))
+        """
+        if self.num_runs == 0:
+            return {}
+
+        height, width = self.shape
+        rows   = np.repeat(np.arange(height, dtype=np.int64), np.diff(self.row_offsets))
+        labels = self.run_labels.astype(np.int64)
+        stops  = self.run_starts.astype(np.int64) + self.run_lengths
+        num_labels = labels.max() + 1
+
+        num_pixels = np.bincount(labels, weights=self.run_lengths, minlength=num_labels)
+        row_min, col_min = np.full(num_labels, height), np.full(num_labels, width)
+        row_max, col_max = np.zeros(num_labels, dtype=np.int64), np.zeros(num_labels, dtype=np.int64)
+        np.minimum.at(row_min, labels, rows)
+        np.maximum.at(row_max, labels, rows)
+        np.minimum.at(col_min, labels, self.run_starts)
+        np.maximum.at(col_max, labels, stops)
+
+        label_stats = {}
+        for label_num in np.flatnonzero(num_pixels).tolist():
+            bbox = (int(row_min[label_num] // block_size * block_size),
+                    int(min((row_max[label_num] // block_size + 1) * block_size, height)),
+                    int(col_min[label_num] // block_size * block_size),
+                    int(min(-(-col_max[label_num] // block_size) * block_size, width)))
+            label_stats[label_num] = (int(num_pixels[label_num]), bbox)
+
+        return label_stats
+
+
+def load_annotation(path, mmap_mode=None):
+    """
+    Load an annotation bitmap saved either as a dense .npy array or as a .rle.npz file
+
+    :param path: path to annotation file
+    :param mmap_mode: mmap_mode for np.load() of dense arrays
+    :return: np.ndarray or RunLengthAnnotation
+    """
+    if str(path).endswith(RLE_SUFFIX):
+        return RunLengthAnnotation.load(path)
+    return np.load(path, mmap_mode=mmap_mode)
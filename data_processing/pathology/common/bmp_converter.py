@@ -0,0 +1,174 @@
+'''
+Conversion of regional annotation bitmaps (bmp) from SlideViewer to numpy arrays
+
+PIL decodes a whole bmp at once, and np.array() then copies it, so converting a full resolution bitmap used to need
+twice its size in memory. Uncompressed 1, 4 and 8 bit palette, 8 bit grayscale and 24 bit bmps are instead read a strip
+of rows at a time straight from the pixel array, using the layout PIL parses from the header. Other layouts are
+decoded by PIL.
+
+This module is shipped to the spark executors with addPyFile, see proxy_table/regional_annotation/generate.py
+'''
+import os
+
+import numpy as np
+from PIL import Image
+Image.MAX_IMAGE_PIXELS = 5000000000
+
+# Rows read at once, an 8 bit strip of a 100k pixel wide slide is 100MB
+BMP_STRIP_ROWS = 1024
+
+# PIL raw mode of the pixel array -> (bits per pixel, channels)
+STREAMED_RAW_MODES = {"P;1": (1, 1), "P;4": (4, 1), "P": (8, 1), "L": (8, 1), "BGR": (8, 3)}
+
+
+def get_bmp_layout(bmp_file):
+    """
+    Layout of the pixel array of an uncompressed bmp, without decoding it
+
+    :param bmp_file: path to bmp file
+    :return: dict with shape, bits, offset, stride and bottom_up of the pixel array, or None if it can't be read in strips
+    """
+    with Image.open(bmp_file) as img:
+        if img.format != "BMP" or len(img.tile) != 1:
+            return None
+
+        decoder, extents, offset, args = img.tile[0]
+        raw_mode, stride, direction = args
+        if decoder != "raw" or raw_mode not in STREAMED_RAW_MODES:
+            return None
+
+        width, height = img.size
+        bits, channels = STREAMED_RAW_MODES[raw_mode]
+
+    return {"shape": (height, width) if channels == 1 else (height, width, channels),
+            "bits": bits,
+            "offset": offset,
+            "stride": stride,
+            "bottom_up": direction == -1}
+
+
+def iter_bmp_strips(bmp_file, strip_rows=BMP_STRIP_ROWS):
+    """
+    Generator over the rows of a bmp, as np.array(Image.open(bmp_file)) would return them
+
+    Strips are read in file order, so from the bottom of the image for bottom-up bmps. Bmps that can't be read in
+    strips are decoded by PIL and returned as a single strip.
+
+    :param bmp_file: path to bmp file
+    :param strip_rows: number of rows read at once
+    :return: generator of (row_start, strip)
+    """
+    layout = get_bmp_layout(bmp_file)
+    if layout is None:
+        yield 0, np.array(Image.open(bmp_file))
+        return
+
+    height, width = layout["shape"][:2]
+    stride = layout["stride"]
+
+    with open(bmp_file, 'rb') as fp:
+        fp.seek(layout["offset"])
+        for file_row in range(0, height, strip_rows):
+            num_rows = min(strip_rows, height - file_row)
+
+            buffer = fp.read(num_rows * stride)
+            if len(buffer) < num_rows * stride:
+                raise OSError(f"Truncated bmp file {bmp_file}")
+            strip = np.frombuffer(buffer, dtype=np.uint8).reshape(num_rows, stride)
+
+            # palette indices of packed pixels, most significant bits first
+            if layout["bits"] == 1:
+                strip = np.unpackbits(strip, axis=1)[:, :width]
+            elif layout["bits"] == 4:
+                strip = np.stack([strip >> 4, strip & 0x0F], axis=-1).reshape(num_rows, -1)[:, :width]
+            elif len(layout["shape"]) == 3:
+                # BGR -> RGB
+                strip = strip[:, :width * 3].reshape(num_rows, width, 3)[..., ::-1]
+            else:
+                strip = strip[:, :width]
+
+            if layout["bottom_up"]:
+                yield height - file_row - num_rows, strip[::-1]
+            else:
+                yield file_row, strip
+
+
+def save_bmp_as_npy(bmp_file, output_filepath, strip_rows=BMP_STRIP_ROWS):
+    """
+    Stream a bmp into an npy file, holding one strip of rows in memory at a time
+
+    :param bmp_file: path to bmp file
+    :param output_filepath: path to npy file
+    :param strip_rows: number of rows read at once
+    """
+    layout = get_bmp_layout(bmp_file)
+    if layout is None:
+        np.save(output_filepath, np.array(Image.open(bmp_file)))
+        return
+
+    annotation = np.lib.format.open_memmap(output_filepath, mode='w+', dtype=np.uint8, shape=layout["shape"])
+    for row_start, strip in iter_bmp_strips(bmp_file, strip_rows):
+        annotation[row_start:row_start + len(strip)] = strip
+    annotation.flush()
+    del annotation
+
+
+def get_annotation_filepath(bmp_file, output_folder, extension):
+    """
+    Output path of a converted bmp, in a folder named after the folder holding the bmp
+
+    :param bmp_file: /path/to/{case_id}/image.bmp
+    :param output_folder: /path/to/output/folder
+    :param extension: extension replacing .bmp
+    :return: /path/to/output/folder/{case_id}/image{extension}
+    """
+    new_image_name = os.path.basename(bmp_file).replace(".bmp", extension)
+    bmp_caseid_folder = os.path.basename(os.path.dirname(bmp_file))
+    output_caseid_folder = os.path.join(output_folder, bmp_caseid_folder)
+
+    if not os.path.exists(output_caseid_folder):
+        os.makedirs(output_caseid_folder, exist_ok=True)
+
+    return os.path.join(output_caseid_folder, new_image_name)
+
+
+def convert_bmp_to_npy(bmp_file, output_folder):
+    """
+    Reads a bmp file and creates friendly numpy ndarray file in the uint8 format in the output
+    directory specified, with extention .annot.npy
+
+    Troubleshooting:
+        Make sure Pillow is upgraded to version 8.0.0 if getting an Unsupported BMP Size OS Error
+
+    :param bmp_file - /path/to/image.bmp
+    :param output_folder - /path/to/output/folder
+    :return filepath to file containing numpy array
+    """
+    if not '.bmp' in bmp_file:
+        return ''
+
+    output_filepath = get_annotation_filepath(bmp_file, output_folder, ".npy")
+    save_bmp_as_npy(bmp_file, output_filepath)
+    return output_filepath
+
+
+def convert_bmp_to_rle(bmp_file, output_folder):
+    """
+    Reads a bmp file and creates a run-length encoded annotation file in the output directory specified,
+    with extention .rle.npz. Much smaller than the npy file for mostly empty annotations, see annotation_rle.py
+
+    :param bmp_file - /path/to/image.bmp
+    :param output_folder - /path/to/output/folder
+    :return filepath to file containing run-length encoded annotation
+    """
+    from annotation_rle import RunLengthAnnotation, RLE_SUFFIX
+
+    if not '.bmp' in bmp_file:
+        return ''
+
+    output_filepath = get_annotation_filepath(bmp_file, output_folder, RLE_SUFFIX)
+
+    with Image.open(bmp_file) as img:
+        width, height = img.size
+    RunLengthAnnotation.from_strips((height, width), np.uint8, iter_bmp_strips(bmp_file)).save(output_filepath)
+    return output_filepath
@@ -2,16 +2,31 @@
 # are vectorized into a set of polygons. These polygons are then converted into the geoJSON format and written to file.
 
 from skimage import measure
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import numpy as np
+import pandas as pd
 import json
 import ast
 import copy
+import functools
+import gc
+import hashlib
 import signal
 
 # max amount of time for a geojson to be generated. if generation surpasses this limit, it is likely the annotation file is
 # too large or they may be annotation artifacts present in the slide. currently set at 30 minute timeout
 TIMEOUT_SECONDS = 1800
 
+# bitmap block size used to find label bounding boxes, see get_label_stats()
+LABEL_BLOCK_SIZE = 128
+
+# default block size for tiled contour tracing, see find_contours_tiled()
+CONTOUR_BLOCK_SIZE = 4096
+
+# default number of threads tracing the labels of a bitmap, per spark python worker, see build_geojsons_from_annotation()
+BUILD_THREADS = 4
+
 
 # Base template for geoJSON file
 geojson_base = {
@@ -30,78 +45,274 @@ def build_geojson_from_pointclick_json(labelsets, labelset, sv_json):
     """
     print("Building geojson for labelset " + str(labelset))
 
-    labelsets = ast.literal_eval(labelsets)
-    mappings = labelsets[labelset]
+    return build_geojsons_from_pointclick_jsons(pd.Series([labelsets]), pd.Series([labelset]), pd.Series([sv_json])).iloc[0]
 
-    output_geojson = []
-    for entry in sv_json:
-        point = {}
-        x = int(entry['x'])
-        y = int(entry['y'])
-        class_num = int(entry['class'])
-        if class_num not in mappings:
-            continue
-        class_name = mappings[class_num]
-        coordinates = [x,y]
 
-        point["type"] = "Feature"
-        point["id"] = "PathAnnotationObject"
-        point["geometry"] = {"type": "Point",  "coordinates": coordinates}
-        point["properties"] = {"classification": {"name": class_name}}
-        output_geojson.append(point)
+@functools.lru_cache(maxsize=8)
+def parse_label_config(label_config):
+    """
+    :param label_config: dictionary of labelset as string {labelset: {label number: label name}}
+    :return: label config as a dataframe of (labelset, class, class_name)
+    """
+    return pd.DataFrame([(labelset, int(label_num), label_name)
+                         for labelset, mappings in ast.literal_eval(label_config).items()
+                         for label_num, label_name in mappings.items()],
+                        columns=["labelset", "class", "class_name"])
+
 
-    return output_geojson
+def build_geojsons_from_pointclick_jsons(label_config: pd.Series, labelsets: pd.Series, sv_jsons: pd.Series) -> pd.Series:
+    """
+    Build geojsons from slideviewer jsons, for a batch of (slide, labelset) rows, see build_geojson_from_pointclick_json()
 
+    The points of all rows are gathered into one dataframe, so the label config is parsed once and classes are mapped
+    to names with a single join, instead of once per point.
 
-# adapted from: https://github.com/ijmbarr/image-processing-with-numpy/blob/master/image-processing-with-numpy.ipynb
-def add_contours_for_label(annotation_geojson, annotation, label_num, mappings, contour_level, polygon_tolerance):
+    :param label_config: dictionary of labelset as string {labelset: {label number: label name}}, the same in all rows
+    :param labelsets: labelset of each row e.g. default_labels
+    :param sv_jsons: list of dictionaries from slideviewer of each row
+    :return: geojson list of each row, None for rows without a slideviewer json
     """
-    Finds the contours for a label mask, builds a polygon, converts polygon to geoJSON feature dictionary
+    if len(sv_jsons) == 0:
+        return pd.Series([], index=sv_jsons.index, dtype=object)
+
+    row_ids, entries = [], []
+    for row_id, sv_json in enumerate(sv_jsons):
+        if sv_json is None: continue
+        row_ids.extend([row_id] * len(sv_json))
+        entries.extend(sv_json)
+
+    # maps may come from arrow as lists of (key, value) pairs
+    if entries and not isinstance(entries[0], dict):
+        entries = [dict(entry) for entry in entries]
+
+    points = pd.DataFrame.from_records(entries, columns=["x", "y", "class"])
+    points = points.astype(int) \
+        .assign(row_id=row_ids, labelset=labelsets.to_numpy()[row_ids] if row_ids else [])
+
+    # the label config is the same literal in all rows
+    label_df = parse_label_config(label_config.iloc[0])
+
+    # drops points of classes not in the labelset, keeping the order of the points
+    points = points.merge(label_df, on=["labelset", "class"], how="inner")
+
+    # millions of small dicts would trigger many garbage collections, none of which can free anything
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        features = [{"type": "Feature",
+                     "id": "PathAnnotationObject",
+                     "geometry": {"type": "Point", "coordinates": [x, y]},
+                     "properties": {"classification": {"name": class_name}}}
+                    for x, y, class_name in zip(points["x"].tolist(), points["y"].tolist(), points["class_name"].tolist())]
+    finally:
+        if gc_enabled: gc.enable()
+
+    bounds = np.searchsorted(points["row_id"].to_numpy(), np.arange(len(sv_jsons) + 1))
+    return pd.Series([features[bounds[row_id]:bounds[row_id + 1]] if sv_json is not None else None
+                      for row_id, sv_json in enumerate(sv_jsons)], index=sv_jsons.index)
+
+
+def get_label_stats(annotation, block_size=LABEL_BLOCK_SIZE):
+    """
+    Pixel counts and bounding boxes of all labels, in a single pass over the bitmap.
+
+    Each strip of block_size rows is reduced with one np.bincount over (label, column block) keys. Bounding boxes
+    are aligned to blocks, so they may be up to block_size - 1 pixels larger than the label.
+
+    :param annotation: npy array of bitmap, with non-negative integer labels, or a RunLengthAnnotation
+    :param block_size: bounding box granularity in pixels
+    :return: dict of label_num -> (num_pixels, (row_start, row_stop, col_start, col_stop))
+    """
+    # run-length encoded bitmaps are counted from their runs, see annotation_rle.py
+    if hasattr(annotation, "get_label_stats"):
+        return annotation.get_label_stats(block_size)
+
+    height, width = annotation.shape
+    blocks_x = -(-width // block_size)
+    column_block = np.arange(width, dtype=np.int64) // block_size
+
+    label_stats = {}
+    for row_start in range(0, height, block_size):
+        strip = annotation[row_start:row_start + block_size]
+        block_counts = np.bincount((strip.astype(np.int64) * blocks_x + column_block).ravel())
+        block_counts = np.pad(block_counts, (0, -len(block_counts) % blocks_x)).reshape(-1, blocks_x)
+
+        for label_num in np.flatnonzero(block_counts.any(axis=1)).tolist():
+            present = np.flatnonzero(block_counts[label_num]).tolist()
+            row_stop  = min(row_start + block_size, height)
+            col_start = present[0] * block_size
+            col_stop  = min((present[-1] + 1) * block_size, width)
+
+            num_pixels, bbox = label_stats.get(label_num, (0, (row_start, row_stop, col_start, col_stop)))
+            bbox = (bbox[0], row_stop, min(bbox[2], col_start), max(bbox[3], col_stop))
+            label_stats[label_num] = (num_pixels + int(block_counts[label_num].sum()), bbox)
+
+    return label_stats
+
+
+def stitch_contour_pieces(pieces):
+    """
+    Joins open contour pieces whose end point is the start point of another piece.
+
+    :param pieces: list of (n, 2) contour arrays, closed contours repeat their first point
+    :return: list of contours
+    """
+    contours = [piece for piece in pieces if np.array_equal(piece[0], piece[-1])]
+    open_pieces = [piece for piece in pieces if not np.array_equal(piece[0], piece[-1])]
+
+    piece_by_start = {tuple(piece[0]): n for n, piece in enumerate(open_pieces)}
+    piece_ends = {tuple(piece[-1]) for piece in open_pieces}
+
+    # start with pieces no other piece leads into (contours open at the bitmap edge), the rest form rings
+    chain_starts = [n for n, piece in enumerate(open_pieces) if tuple(piece[0]) not in piece_ends] + list(range(len(open_pieces)))
+
+    used = set()
+    for n in chain_starts:
+        if n in used: continue
+        used.add(n)
+        chain = [open_pieces[n]]
+
+        next_n = piece_by_start.get(tuple(open_pieces[n][-1]))
+        while next_n is not None and next_n not in used:
+            used.add(next_n)
+            chain.append(open_pieces[next_n][1:])
+            next_n = piece_by_start.get(tuple(open_pieces[next_n][-1]))
+
+        contours.append(np.concatenate(chain))
+
+    return contours
+
+
+def find_contours_tiled(annotation, label_num, contour_level, bbox, block_size=CONTOUR_BLOCK_SIZE, stop_event=None):
+    """
+    Finds the contours of a label block by block, so only one block mask is held in memory.
+
+    Blocks overlap by one pixel, so every marching squares cell is traced by exactly one block, and pieces of a
+    contour that crosses block edges meet at identical points on the shared rows and columns, where they are stitched.
+
+    :param annotation: npy array of bitmap, may be memory mapped
+    :param label_num: label to trace
+    :param contour_level: value along which to find contours in the array
+    :param bbox: (row_start, row_stop, col_start, col_stop) region holding the label and a pixel of background
+    :param block_size: block size in pixels
+    :param stop_event: optional threading.Event, checked between blocks, to stop tracing
+    :return: list of contours in bitmap coordinates, empty if stopped
+    """
+    row_start, row_stop, col_start, col_stop = bbox
+
+    pieces = []
+    for block_row in range(row_start, max(row_stop - 1, row_start + 1), block_size):
+        for block_col in range(col_start, max(col_stop - 1, col_start + 1), block_size):
+            if stop_event is not None and stop_event.is_set():
+                return []
+            mask = (annotation[block_row:min(block_row + block_size + 1, row_stop),
+                               block_col:min(block_col + block_size + 1, col_stop)] == label_num).astype(np.int8)
+            if not mask.any() or mask.all(): continue
+
+            pieces.extend(piece + (block_row, block_col) for piece in measure.find_contours(mask, level = contour_level))
+
+    return stitch_contour_pieces(pieces)
+
+
+def get_label_polygons(annotation, label_num, contour_level, polygon_tolerance, label_stats, contour_block_size=None, stop_event=None):
+    """
+    Finds the contours of a label and simplifies them into polygons.
+
+    Contours are only traced within the label's bounding box, padded by a pixel of background so contours close
+    as they would on the full bitmap.
 
-    :param annotation_geojson: geojson result to populate
     :param annotation: npy array of bitmap
-    :param label_num: int value represented in the npy array; corresponding to the annotation label set.
-    :param mappings: label map for the specified label set
+    :param label_num: int value represented in the npy array
     :param contour_level: value along which to find contours in the array
     :param polygon_tolerance: polygon resolution
-    :return: geojson result
+    :param label_stats: label pixel counts and bounding boxes from get_label_stats()
+    :param contour_block_size: if set, labels spanning more than this many pixels are traced in blocks, see find_contours_tiled()
+    :param stop_event: optional threading.Event, checked before tracing and between blocks, to stop tracing
+    :return: list of polygons as [x, y] coordinate lists, empty if the label is not in the bitmap or stopped
     """
-    if label_num in annotation:
-        print("Building contours for label " + str(label_num))
+    if stop_event is not None and stop_event.is_set():
+        return []
 
-        num_pixels = np.count_nonzero(annotation == label_num)
-        print("num_pixels with label", num_pixels)
+    if label_num not in label_stats:
+        print("No label " + str(label_num) + " found")
+        return []
 
-        mask = np.where(annotation==label_num,1,0).astype(np.int8)
-        contours = measure.find_contours(mask, level = contour_level)
-        print("num contours", len(contours))
+    print("Building contours for label " + str(label_num))
 
-        scaled_tolerance = polygon_tolerance
-        if num_pixels >= 10000000:
-            scaled_tolerance = int(num_pixels / 10000000)
+    num_pixels, (row_start, row_stop, col_start, col_stop) = label_stats[label_num]
+    print("num_pixels with label", num_pixels)
 
-        simplified_contours = [measure.approximate_polygon(c, tolerance=scaled_tolerance) for c in contours]
+    row_start, col_start = max(row_start - 1, 0), max(col_start - 1, 0)
+    row_stop,  col_stop  = min(row_stop + 1, annotation.shape[0]), min(col_stop + 1, annotation.shape[1])
 
-        for n, contour in enumerate(simplified_contours):
-            feature_dict = {"type":"Feature", "properties":{}, "geometry":{"type":"Polygon", "coordinates": []}}
-            feature_dict['properties']['label_num'] = str(label_num)
-            feature_dict['properties']['label_name'] = mappings[label_num]
+    if contour_block_size and max(row_stop - row_start, col_stop - col_start) > contour_block_size:
+        contours = find_contours_tiled(annotation, label_num, contour_level, (row_start, row_stop, col_start, col_stop), contour_block_size, stop_event)
+    else:
+        mask = (annotation[row_start:row_stop, col_start:col_stop] == label_num).astype(np.int8)
+        contours = [contour + (row_start, col_start) for contour in measure.find_contours(mask, level = contour_level)]
+    print("num contours", len(contours))
 
-            contour_list =   contour.tolist()
-            for coord in contour_list:
-                x = int(round(coord[0]))
-                y = int(round(coord[1]))
-                # switch coordinates, otherwise gets flipped
-                coord[0] = y
-                coord[1] = x
+    scaled_tolerance = polygon_tolerance
+    if num_pixels >= 10000000:
+        scaled_tolerance = int(num_pixels / 10000000)
 
-            feature_dict['geometry']['coordinates'] = contour_list
-            annotation_geojson['features'].append(feature_dict)
-    else:
-        print("No label " + str(label_num) + " found")
+    simplified_contours = [measure.approximate_polygon(c, tolerance=scaled_tolerance) for c in contours]
+
+    polygons = []
+    for contour in simplified_contours:
+        contour_list =   contour.tolist()
+        for coord in contour_list:
+            x = int(round(coord[0]))
+            y = int(round(coord[1]))
+            # switch coordinates, otherwise gets flipped
+            coord[0] = y
+            coord[1] = x
+        polygons.append(contour_list)
+
+    return polygons
+
+
+def add_polygons_for_label(annotation_geojson, polygons, label_num, mappings):
+    """
+    Converts polygons of a label to geoJSON feature dictionaries
+
+    :param annotation_geojson: geojson result to populate
+    :param polygons: polygons from get_label_polygons()
+    :param label_num: label of the polygons
+    :param mappings: label map for the specified label set
+    :return: geojson result
+    """
+    for polygon in polygons:
+        feature_dict = {"type":"Feature", "properties":{}, "geometry":{"type":"Polygon", "coordinates": []}}
+        feature_dict['properties']['label_num'] = str(label_num)
+        feature_dict['properties']['label_name'] = mappings[label_num]
+        feature_dict['geometry']['coordinates'] = polygon
+        annotation_geojson['features'].append(feature_dict)
     return annotation_geojson
 
 
+# adapted from: https://github.com/ijmbarr/image-processing-with-numpy/blob/master/image-processing-with-numpy.ipynb
+def add_contours_for_label(annotation_geojson, annotation, label_num, mappings, contour_level, polygon_tolerance, label_stats=None, contour_block_size=None):
+    """
+    Finds the contours for a label mask, builds a polygon, converts polygon to geoJSON feature dictionary
+
+    :param annotation_geojson: geojson result to populate
+    :param annotation: npy array of bitmap
+    :param label_num: int value represented in the npy array; corresponding to the annotation label set.
+    :param mappings: label map for the specified label set
+    :param contour_level: value along which to find contours in the array
+    :param polygon_tolerance: polygon resolution
+    :param label_stats: label pixel counts and bounding boxes from get_label_stats(), computed if not given
+    :param contour_block_size: if set, labels spanning more than this many pixels are traced in blocks, see find_contours_tiled()
+    :return: geojson result
+    """
+    if label_stats is None:
+        label_stats = get_label_stats(annotation)
+
+    polygons = get_label_polygons(annotation, label_num, contour_level, polygon_tolerance, label_stats, contour_block_size)
+    return add_polygons_for_label(annotation_geojson, polygons, label_num, mappings)
+
+
 def handler(signum, frame):
     raise TimeoutError("Geojson generation timed out.")
 
@@ -111,38 +322,50 @@ def build_geojson_from_annotation(df):
     """
     Builds geojson for all annotation labels in the specified labelset.
 
+    The npy_filepath column may also point to a run-length encoded .rle.npz file, see annotation_rle.py.
+    With a contour_block_size column > 0, the npy file is memory mapped and large labels are traced in blocks
+    (see find_contours_tiled()), which keeps memory bounded and runs without the TIMEOUT_SECONDS limit.
+
     :param df: Pandas dataframe
     :return: Pandas dataframe with geojson field populated
     """
-    from build_geojson import add_contours_for_label, handler
+    from build_geojson import add_contours_for_label, get_label_stats, handler
+    from annotation_rle import load_annotation
 
     labelsets = df.label_config.values[0]
     annotation_npy_filepath = df.npy_filepath.values[0]
     labelset = df.labelset.values[0]
     contour_level = df.contour_level.values[0]
     polygon_tolerance = df.polygon_tolerance.values[0]
+    contour_block_size = int(df.contour_block_size.values[0]) if "contour_block_size" in df.columns else 0
 
     labelsets = ast.literal_eval(labelsets)
     mappings = labelsets[labelset]
 
     print("\nBuilding GeoJSON annotation from npy file:", annotation_npy_filepath)
 
-    annotation = np.load(annotation_npy_filepath)
+    annotation = load_annotation(annotation_npy_filepath, mmap_mode='r' if contour_block_size else None)
     annotation_geojson = copy.deepcopy(geojson_base)
 
-    signal.signal(signal.SIGALRM, handler)
-    signal.alarm(TIMEOUT_SECONDS)
+    # one pass over the bitmap for the pixel counts and bounding boxes of all labels
+    label_stats = get_label_stats(annotation)
+
+    if not contour_block_size:
+        signal.signal(signal.SIGALRM, handler)
+        signal.alarm(TIMEOUT_SECONDS)
 
     try:
         for label_num in mappings:
-            annotation_geojson = add_contours_for_label(annotation_geojson, annotation, label_num, mappings, float(contour_level), float(polygon_tolerance))
+            annotation_geojson = add_contours_for_label(annotation_geojson, annotation, label_num, mappings, float(contour_level), float(polygon_tolerance),
+                                                        label_stats, contour_block_size)
     except TimeoutError as err:
         print("Timeout Error occured while building geojson from slide", annotation_npy_filepath)
 
         return df
 
     # disables alarm
-    signal.alarm(0)
+    if not contour_block_size:
+        signal.alarm(0)
 
     # empty geojson created, return nan and delete from geojson table
     if len(annotation_geojson['features']) == 0:
@@ -152,6 +375,82 @@ def build_geojson_from_annotation(df):
     return df
 
 
+def build_geojsons_from_annotation(df):
+    """
+    Builds geojson for all labelsets of one annotation bitmap.
+
+    The npy file is loaded once (memory mapped) and counted once, and the contours of each label are traced once
+    in a thread pool and shared by all labelsets mapping that label. skimage releases the GIL while tracing.
+    The pool has build_threads threads, or BUILD_THREADS without that column. On timeout, labels not yet traced
+    are cancelled, labels being traced are stopped at their next block, and the bitmap is dropped once they have.
+
+    :param df: Pandas dataframe of the rows of a single bitmap, e.g. of several users, and a labelset_list column with
+    the labelsets to build
+    :return: Pandas dataframe with one row per input row and labelset with a non-empty geojson
+    """
+    from build_geojson import add_polygons_for_label, get_label_polygons, get_label_stats, handler, BUILD_THREADS
+    from annotation_rle import load_annotation
+
+    labelsets = ast.literal_eval(df.label_config.values[0])
+    annotation_npy_filepath = df.npy_filepath.values[0]
+    contour_level = float(df.contour_level.values[0])
+    polygon_tolerance = float(df.polygon_tolerance.values[0])
+    contour_block_size = int(df.contour_block_size.values[0]) if "contour_block_size" in df.columns else 0
+    labelset_list = list(df.labelset_list.values[0])
+    build_threads = int(df.build_threads.values[0]) if "build_threads" in df.columns else BUILD_THREADS
+
+    print("\nBuilding GeoJSON annotations for", len(labelset_list), "labelsets from npy file:", annotation_npy_filepath)
+
+    annotation = load_annotation(annotation_npy_filepath, mmap_mode='r')
+    label_stats = get_label_stats(annotation)
+
+    label_nums = sorted({label_num for labelset in labelset_list for label_num in labelsets[labelset]})
+
+    if not contour_block_size:
+        signal.signal(signal.SIGALRM, handler)
+        signal.alarm(TIMEOUT_SECONDS)
+
+    # not a with block, which would wait for all labels on timeout
+    stop_event = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=build_threads)
+    futures = {label_num: executor.submit(get_label_polygons, annotation, label_num, contour_level, polygon_tolerance,
+                                          label_stats, contour_block_size, stop_event)
+               for label_num in label_nums}
+    try:
+        label_polygons = {label_num: future.result() for label_num, future in futures.items()}
+    except TimeoutError as err:
+        print("Timeout Error occured while building geojson from slide", annotation_npy_filepath)
+
+        stop_event.set()
+        for future in futures.values():
+            future.cancel()
+        executor.shutdown(wait=True)
+        return df.drop(columns=["labelset_list"]).iloc[:0].assign(labelset="")
+    executor.shutdown()
+
+    # disables alarm
+    if not contour_block_size:
+        signal.alarm(0)
+
+    rows = []
+    for labelset in labelset_list:
+        mappings = labelsets[labelset]
+        annotation_geojson = copy.deepcopy(geojson_base)
+        for label_num in mappings:
+            annotation_geojson = add_polygons_for_label(annotation_geojson, label_polygons[label_num], label_num, mappings)
+
+        # empty geojsons are not returned
+        if len(annotation_geojson['features']) == 0:
+            continue
+
+        rows.append(df.drop(columns=["labelset_list"]).assign(labelset=labelset, geojson=json.dumps(annotation_geojson)))
+
+    if len(rows) == 0:
+        return df.drop(columns=["labelset_list"]).iloc[:0].assign(labelset="")
+
+    return pd.concat(rows, ignore_index=True)
+
+
 def concatenate_regional_geojsons(geojson_list):
     """
     Concatenates geojsons if there are more than one annotations for the labelset.
@@ -173,3 +472,65 @@ def concatenate_regional_geojsons(geojson_list):
 
     return concat_geojson
 
+
+def get_features_span(geojson):
+    """
+    Span of the features array of a serialized FeatureCollection, as written by build_geojson_from_annotation(),
+    with the features array as its last member
+
+    :param geojson: geojson string
+    :return: (start, stop) of the text between the brackets of the features array, or None if not found
+    """
+    key = geojson.find('"features"')
+    start = geojson.find('[', key) + 1
+    stop = geojson.rfind(']')
+    if key < 0 or start <= 0 or stop < start or geojson[key + len('"features"'):start - 1].strip() != ':' or geojson[stop + 1:].strip() != '}':
+        return None
+    return start, stop
+
+
+def concatenate_serialized_geojsons(geojson_list, prefix):
+    """
+    Concatenates geojson strings by splicing the text of their features arrays, without parsing them.
+    Geojsons with another layout are parsed, as by concatenate_regional_geojsons().
+
+    The uuid is hashed while splicing, and is the same as utils.generate_uuid_dict(concat_geojson, prefix).
+
+    :param geojson_list: list of geojson strings
+    :param prefix: list e.g. ["SVCONCATGEOJSON", "default-label"]
+    :return: (concatenated geojson string, uuid of concatenated geojson)
+    """
+    spans = [get_features_span(geojson) for geojson in geojson_list]
+    if None in spans:
+        concat_geojson = concatenate_regional_geojsons(geojson_list)
+        # features as the last member, so it can be spliced
+        concat_geojson["features"] = concat_geojson.pop("features")
+        concat_geojson = json.dumps(concat_geojson)
+        spans = [get_features_span(concat_geojson)]
+        geojson_list = [concat_geojson]
+
+    head, tail = geojson_list[0][:spans[0][0]], geojson_list[0][spans[0][1]:]
+    features = [geojson[start:stop] for geojson, (start, stop) in zip(geojson_list, spans) if geojson[start:stop].strip()]
+    pieces = [head] + [piece for n, feature in enumerate(features) for piece in ([", "] if n else []) + [feature]] + [tail]
+
+    # hash of the json string of the geojson string, escaping piece by piece escapes the whole string
+    sha256 = hashlib.sha256(b'"')
+    for piece in pieces:
+        sha256.update(json.dumps(piece)[1:-1].encode('utf-8'))
+    sha256.update(b'"')
+
+    return "".join(pieces), "-".join(prefix + [sha256.hexdigest()])
+
+
+def concatenate_serialized_geojsons_batch(geojson_lists: pd.Series, labelsets: pd.Series) -> pd.DataFrame:
+    """
+    concatenate_serialized_geojsons() for a batch of (slide, labelset) rows, as a pandas_udf
+
+    :param geojson_lists: list of geojson strings of each row
+    :param labelsets: labelset of each row
+    :return: dataframe of concat_geojson and concat_geojson_record_uuid
+    """
+    results = [concatenate_serialized_geojsons(list(geojson_list), ["SVCONCATGEOJSON", labelset])
+               for geojson_list, labelset in zip(geojson_lists, labelsets)]
+    return pd.DataFrame(results, columns=["concat_geojson", "concat_geojson_record_uuid"], index=geojson_lists.index)
+
@@ -6,21 +6,26 @@
 Various utility and processing methods for pathology
 '''
 
-import os, itertools, logging, re
+import os, itertools, json, hashlib, logging, re, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy  as np
 import pandas as pd
 import seaborn as sns
 
 from PIL import Image
+from filehash import FileHash
 
 import openslide
 from openslide.deepzoom import DeepZoomGenerator
 
 from skimage.color   import rgb2gray
-from skimage.filters import threshold_otsu
+from skimage.filters import threshold_otsu, laplace
 from skimage.draw import rectangle_perimeter, rectangle
 
+from data_processing.pathology.common.region_reader import SlideRegionReader
+from data_processing.pathology.common.tile_shards   import encode_tile, get_shard_name, write_tile_shard
+
 NUM_COLORS = 100 + 1
 scoring_palette = sns.color_palette("viridis_r", n_colors=NUM_COLORS)
 scoring_palette_as_list = [[int(x * 255) for x in scoring_palette.pop()] for i in range(NUM_COLORS)]
@@ -63,30 +68,220 @@ def get_full_resolution_generator(slide, tile_size):
     assert generator.level_dimensions[generator_level] == slide.dimensions
     return generator, generator_level
 
+# USED -> generate cli
+def get_tile_grid(img, tile_size):
+    """
+    Reshape an image into a strided grid of tiles, matching the DeepZoomGenerator full resolution tiling (no overlap).
+    Partial tiles along the right and bottom edges are zero padded, their true extents are returned alongside.
+
+    :param img: np.ndarray of shape (height, width) or (height, width, channels)
+    :param tile_size: int
+    :return: np.ndarray view of shape (tiles_y, tiles_x, tile_size, tile_size, channels),
+             np.ndarray of shape (tiles_y, tiles_x) with the number of valid pixels in each tile
+    """
+    assert isinstance(img, np.ndarray)
+    if img.ndim == 2: img = img[..., np.newaxis]
+
+    height, width, channels = img.shape
+    tiles_y = -(-height // tile_size)
+    tiles_x = -(-width  // tile_size)
+
+    # Only copies the image if there are partial edge tiles
+    pad_y = tiles_y * tile_size - height
+    pad_x = tiles_x * tile_size - width
+    if pad_y or pad_x:
+        img = np.pad(img, ((0, pad_y), (0, pad_x), (0, 0)))
+
+    stride_y, stride_x, stride_c = img.strides
+    tile_grid = np.lib.stride_tricks.as_strided(img,
+        shape=(tiles_y, tiles_x, tile_size, tile_size, channels),
+        strides=(stride_y * tile_size, stride_x * tile_size, stride_y, stride_x, stride_c),
+        writeable=False)
+
+    extent_y = np.minimum(tile_size, height - np.arange(tiles_y) * tile_size)
+    extent_x = np.minimum(tile_size, width  - np.arange(tiles_x) * tile_size)
+
+    return tile_grid, np.outer(extent_y, extent_x)
+
+# USED -> generate cli
+def get_scores_at_addresses(score_grid, address_raster):
+    """
+    Look up per-tile scores for a list of (column, row) tile addresses
+
+    :param score_grid: np.ndarray of shape (tiles_y, tiles_x)
+    :param address_raster: iterable of (x, y) tile addresses
+    :return: list of scores
+    """
+    addresses = np.array(list(address_raster), dtype=int).reshape(-1, 2)
+    tiles_y, tiles_x = score_grid.shape
+    if ((addresses < 0) | (addresses >= (tiles_x, tiles_y))).any():
+        raise ValueError('Invalid address')
+    return score_grid[addresses[:, 1], addresses[:, 0]].tolist()
+
+# USED -> generate cli
+def get_otsu_score_grid(otsu_img, otsu_tile_size):
+    """
+    Fraction of foreground pixels for every tile of an otsu mask, in one reduction
+
+    :param otsu_img: np.ndarray otsu mask, see make_otsu()
+    :param otsu_tile_size: int
+    :return: np.ndarray of shape (tiles_y, tiles_x)
+    """
+    otsu_grid, tile_pixels = get_tile_grid(otsu_img, otsu_tile_size)
+    return otsu_grid[..., 0].sum(axis=(2, 3)) / tile_pixels
+
+# USED -> generate cli
+def get_purple_score_grid(rgb_img, rgb_tile_size):
+    """
+    Fraction of purple (H&E stained) pixels for every tile of an RGB image, in one reduction
+
+    :param rgb_img: np.ndarray uint8 RGB image
+    :param rgb_tile_size: int
+    :return: np.ndarray of shape (tiles_y, tiles_x)
+    """
+    rgb_grid, tile_pixels = get_tile_grid(rgb_img, rgb_tile_size)
+    r, g, b = rgb_grid[..., 0], rgb_grid[..., 1], rgb_grid[..., 2]
+    # uint8 arithmetic (including overflow) is kept as-is so scores match the per-tile implementation
+    g_offset = g + np.uint8(10)
+    return ((r > g_offset) & (b > g_offset)).sum(axis=(2, 3)) / tile_pixels
+
 # USED -> generate cli
 def get_otsu_scores(address_raster, otsu_img, otsu_tile_size):
-    otsu_slide = array_to_slide(otsu_img)
-    otsu_generator, otsu_generator_level = get_full_resolution_generator(otsu_slide, tile_size=otsu_tile_size)   
-    otsu_score_results = []
-    for address in address_raster:
-        otsu_tile = np.array(otsu_generator.get_tile(otsu_generator_level, address))
-        otsu_score_results.append( otsu_tile.mean().item() )
-    return otsu_score_results
+    return get_scores_at_addresses(get_otsu_score_grid(otsu_img, otsu_tile_size), address_raster)
 
 # USED -> generate cli
 def get_purple_scores(address_raster, rgb_img, rgb_tile_size):
-    rgb_slide = array_to_slide(rgb_img)
-    rgb_generator, rgb_generator_level = get_full_resolution_generator(rgb_slide, tile_size=rgb_tile_size)   
-    purple_score_results = []
-    for address in address_raster:
-        rgb_tile = np.array(rgb_generator.get_tile(rgb_generator_level, address))
-        r, g, b = rgb_tile[..., 0], rgb_tile[..., 1], rgb_tile[..., 2]
-        # cond1 = r > 75
-        # cond2 = b > 90
-        # score = np.sum(cond1 & cond2)
-        score = np.mean((r > (g + 10)) & (b > (g + 10)))
-        purple_score_results.append ( score )  
-    return purple_score_results
+    return get_scores_at_addresses(get_purple_score_grid(rgb_img, rgb_tile_size), address_raster)
+
+# Tile scorers available to pretile_scoring, see register_tile_scorer()
+TILE_SCORERS = {}
+DEFAULT_TILE_SCORERS = ["otsu_score", "purple_score"]
+
+def register_tile_scorer(name, vectorized=True):
+    """
+    Register a tile scoring function under the given name, so it can be selected from the method "scorers" param.
+
+    Vectorized scorers are called once per slide as scorer(block, **params) with a TileBlock and must return a
+    (tiles_y, tiles_x) array. Other scorers are called once per tile as scorer(tile, **params) with the tile pixels
+    and must return a float.
+
+    :param name: scorer name
+    :param vectorized: True if the scorer works on the whole TileBlock
+    """
+    def decorator(scorer):
+        TILE_SCORERS[name] = (scorer, vectorized)
+        return scorer
+    return decorator
+
+class TileBlock:
+    """
+    A thumbnail decoded once and viewed as a grid of tiles, shared by all tile scorers of a slide.
+    Derived planes (grayscale, otsu threshold) are computed lazily and at most once.
+    """
+    def __init__(self, rgb_img, tile_size, otsu_img=None):
+        self.rgb_img   = rgb_img
+        self.tile_size = tile_size
+        self.otsu_img  = otsu_img
+        self.rgb_grid, self.tile_pixels = get_tile_grid(rgb_img, tile_size)
+        self.valid_grid = get_tile_grid(np.ones(rgb_img.shape[:2], dtype=bool), tile_size)[0][..., 0]
+        self._gray_img = None
+        self._otsu_threshold = None
+
+    @property
+    def gray_img(self):
+        if self._gray_img is None: self._gray_img = rgb2gray(self.rgb_img)
+        return self._gray_img
+
+    @property
+    def gray_grid(self):
+        return get_tile_grid(self.gray_img, self.tile_size)[0][..., 0]
+
+    @property
+    def otsu_threshold(self):
+        if self._otsu_threshold is None: self._otsu_threshold = threshold_otsu(self.gray_img)
+        return self._otsu_threshold
+
+    def tile_mean(self, pixel_grid):
+        """
+        :param pixel_grid: np.ndarray of shape (tiles_y, tiles_x, tile_size, tile_size) with per-pixel values
+        :return: mean value over the valid pixels of each tile
+        """
+        return np.where(self.valid_grid, pixel_grid, 0).sum(axis=(2, 3)) / self.tile_pixels
+
+    def tiles(self):
+        """
+        Generator over ((row, column), tile pixels) with partial edge tiles cropped to their true extent
+        """
+        for row, col in np.ndindex(self.tile_pixels.shape):
+            y, x = row * self.tile_size, col * self.tile_size
+            yield (row, col), self.rgb_img[y:y + self.tile_size, x:x + self.tile_size]
+
+@register_tile_scorer("otsu_score")
+def score_otsu(block, scale=1):
+    """ Fraction of foreground pixels, see make_otsu() """
+    if scale == 1 and block.otsu_img is not None:
+        return block.tile_mean(get_tile_grid(block.otsu_img, block.tile_size)[0][..., 0])
+    return block.tile_mean(block.gray_grid < (block.otsu_threshold * scale))
+
+@register_tile_scorer("purple_score")
+def score_purple(block):
+    """ Fraction of purple (H&E stained) pixels """
+    r, g, b = block.rgb_grid[..., 0], block.rgb_grid[..., 1], block.rgb_grid[..., 2]
+    # uint8 arithmetic (including overflow) is kept as-is so scores match get_purple_scores()
+    g_offset = g + np.uint8(10)
+    return block.tile_mean((r > g_offset) & (b > g_offset))
+
+@register_tile_scorer("blur_score")
+def score_blur(block):
+    """ Variance of the laplacian of the grayscale image, low values indicate out of focus tiles """
+    laplace_grid = get_tile_grid(laplace(block.gray_img), block.tile_size)[0][..., 0]
+    mean = block.tile_mean(laplace_grid)
+    return block.tile_mean(laplace_grid ** 2) - mean ** 2
+
+@register_tile_scorer("pen_score")
+def score_pen(block, min_difference=50):
+    """ Fraction of pixels with blue, green or black ink like colors """
+    rgb = block.rgb_grid.astype(np.int16)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    blue  = (b - r > min_difference) & (b - g > min_difference // 2)
+    green = (g - r > min_difference // 2) & (g - b > 0)
+    black = (r < 50) & (g < 50) & (b < 50)
+    return block.tile_mean(blue | green | black)
+
+# USED -> generate cli
+def score_tiles(rgb_img, tile_size, scorers=DEFAULT_TILE_SCORERS, otsu_img=None):
+    """
+    Run the selected tile scorers over one shared TileBlock of the thumbnail
+
+    :param rgb_img: np.ndarray uint8 RGB thumbnail
+    :param tile_size: int, tile size at the thumbnail scale
+    :param scorers: list of scorer names, or dicts like {"scorer": "otsu_score", "scale": 0.8, "name": "otsu_score_0.8"}.
+                    Scorer params default the column name to the scorer name with the param values appended.
+    :param otsu_img: optional precomputed make_otsu() mask of rgb_img, e.g. from get_thumbnail_and_otsu()
+    :return: dict of column name -> np.ndarray of shape (tiles_y, tiles_x)
+    """
+    block = TileBlock(rgb_img, tile_size, otsu_img)
+
+    score_grids = {}
+    for spec in scorers:
+        if isinstance(spec, str): spec = {"scorer": spec}
+        spec = dict(spec)
+        scorer_name = spec.pop("scorer")
+        column      = spec.pop("name", "_".join([scorer_name] + [str(value) for value in spec.values()]))
+
+        if scorer_name not in TILE_SCORERS:
+            raise ValueError(f"Unknown tile scorer {scorer_name}, expected one of {list(TILE_SCORERS)}")
+        scorer, vectorized = TILE_SCORERS[scorer_name]
+
+        if vectorized:
+            score_grids[column] = scorer(block, **spec)
+        else:
+            score_grid = np.zeros(block.tile_pixels.shape)
+            for index, tile in block.tiles():
+                score_grid[index] = scorer(tile, **spec)
+            score_grids[column] = score_grid
+
+    return score_grids
 
 # USED -> utils
 def coord_to_address(s, magnification):
@@ -103,6 +298,94 @@ def address_to_coord(s):
     y = int(m.group(2))
     return (x,y)
 
+# Packed tile key layout, from the most significant bits: | z: 16 bits | y: 24 bits | x: 24 bits |
+TILE_KEY_COORD_BITS = 24
+
+# USED -> utils
+def pack_tile_key(x, y, z):
+    """
+    Pack tile addresses into int64 keys, see TILE_KEY_COORD_BITS
+
+    :param x: tile column(s)
+    :param y: tile row(s)
+    :param z: magnification(s)
+    :return: np.ndarray of int64 tile keys
+    """
+    x, y, z = (np.asarray(value, dtype=np.int64) for value in (x, y, z))
+    coord_limit = 1 << TILE_KEY_COORD_BITS
+    if ((x < 0) | (x >= coord_limit) | (y < 0) | (y >= coord_limit) | (z < 0) | (z >= 1 << 15)).any():
+        raise ValueError('Invalid address')
+    return (z << (2 * TILE_KEY_COORD_BITS)) | (y << TILE_KEY_COORD_BITS) | x
+
+# USED -> utils
+def unpack_tile_key(tile_key):
+    """
+    :param tile_key: int64 tile key(s), see pack_tile_key()
+    :return: x, y, z as np.ndarrays
+    """
+    tile_key   = np.asarray(tile_key, dtype=np.int64)
+    coord_mask = (1 << TILE_KEY_COORD_BITS) - 1
+    return tile_key & coord_mask, (tile_key >> TILE_KEY_COORD_BITS) & coord_mask, tile_key >> (2 * TILE_KEY_COORD_BITS)
+
+# USED -> utils
+def parse_tile_addresses(addresses):
+    """
+    Vectorized address_to_coord(), keeping the magnification
+
+    :param addresses: iterable of tile addresses, e.g. x10_y21_z20
+    :return: np.ndarray of shape (n, 3) with (x, y, z) columns
+    """
+    coords = pd.Series(addresses, dtype=str).str.extract(r'x(\d+)_y(\d+)_z(\d+)', flags=re.IGNORECASE)
+    if coords.isna().any(axis=None):
+        raise ValueError('Invalid address')
+    return coords.to_numpy(dtype=np.int64).reshape(-1, 3)
+
+# USED -> utils
+def make_tile_index(x, y, magnification):
+    """
+    Columnar tile index with integer x, y, z columns and a packed tile_key, indexed by the derived string address
+
+    :param x: tile columns
+    :param y: tile rows
+    :param magnification: z, a single magnification or one per tile
+    :return: pd.DataFrame indexed by address with x, y, z and tile_key columns
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    z = np.broadcast_to(np.asarray(magnification, dtype=np.int64), x.shape)
+
+    df = pd.DataFrame({"x": x, "y": y, "z": z, "tile_key": pack_tile_key(x, y, z)})
+    df.index = pd.Index("x" + df.x.astype(str) + "_y" + df.y.astype(str) + "_z" + df.z.astype(str), name="address")
+    return df
+
+# USED -> utils
+def read_tile_index(file_path):
+    """
+    Read a tile index written by write_tile_index(), or a legacy csv index whose only tile identity is the address
+
+    :param file_path: path to a .parquet or .csv tile index
+    :return: pd.DataFrame indexed by address with x, y, z and tile_key columns
+    """
+    if not str(file_path).endswith(".csv"):
+        return pd.read_parquet(file_path).set_index("address")
+
+    df = pd.read_csv(file_path).set_index("address")
+    if "tile_key" not in df.columns:
+        x, y, z = parse_tile_addresses(df.index).T
+        df_index = make_tile_index(x, y, z)
+        df = pd.concat([df_index.set_index(df.index), df.drop(columns=["coordinates"], errors="ignore")], axis=1)
+    return df
+
+# USED -> utils
+def write_tile_index(df, file_path):
+    """
+    Write a tile index as parquet, with the address as a regular column
+
+    :param df: pd.DataFrame indexed by address, see make_tile_index()
+    :param file_path: output .parquet path
+    """
+    df.reset_index().to_parquet(file_path, index=False)
+
 # USED -> utils
 def get_downscaled_thumbnail(slide, scale_factor):
     new_width  = slide.dimensions[0] // scale_factor
@@ -122,36 +405,101 @@ def make_otsu(img, scale=1):
     threshold = threshold_otsu(_img)
     return (_img < (threshold * scale)).astype(float)
 
+# USED -> utils
+def get_slide_hash(slide_file_path):
+    return FileHash('sha256').hash_file(slide_file_path)
+
+# USED -> utils
+def get_params_hash(params):
+    """
+    Hash of a method's params, recorded in its output properties to detect outputs made with the same inputs
+
+    :param params: dict of json serializable params
+    :return: sha256 hex digest
+    """
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+# USED -> generate, vis tiles
+def get_thumbnail_and_otsu(slide, scale_factor, cache_dir=None, slide_hash=None):
+    """
+    Downscaled RGB thumbnail and its otsu mask, cached as .npy files in cache_dir.
+
+    Cache files are keyed by the slide file hash and the scale factor, so every step run on the same slide
+    (pretile_scoring, visualize_scoring) only reads the slide thumbnail once. Cached arrays are returned
+    read-only memory mapped.
+
+    :param slide: openslide.OpenSlide
+    :param scale_factor: int, downscale factor from full resolution
+    :param cache_dir: cache directory, or None to skip caching
+    :param slide_hash: slide file hash, see get_slide_hash(), or None to skip caching
+    :return: np.ndarray RGB thumbnail, np.ndarray boolean otsu mask
+    """
+    if cache_dir is None or slide_hash is None:
+        rgb_thumbnail = get_downscaled_thumbnail(slide, scale_factor)
+        return rgb_thumbnail, make_otsu(rgb_thumbnail).astype(bool)
+
+    cache_prefix   = os.path.join(cache_dir, f"{slide_hash}_{scale_factor}")
+    thumbnail_file = cache_prefix + ".thumbnail.npy"
+    otsu_file      = cache_prefix + ".otsu.npy"
+
+    if not (os.path.exists(thumbnail_file) and os.path.exists(otsu_file)):
+        rgb_thumbnail = get_downscaled_thumbnail(slide, scale_factor)
+        otsu_img      = make_otsu(rgb_thumbnail).astype(bool)
+
+        # Write then rename, so concurrent jobs never load a partial file
+        for cache_file, img in [(thumbnail_file, rgb_thumbnail), (otsu_file, otsu_img)]:
+            with open(cache_file + f".{os.getpid()}.tmp", 'wb') as fp:
+                np.save(fp, img)
+            os.replace(cache_file + f".{os.getpid()}.tmp", cache_file)
+
+    return np.load(thumbnail_file, mmap_mode='r'), np.load(otsu_file, mmap_mode='r')
+
 # USED -> vis tiles
 def visualize_tiling_scores(df, thumbnail_img, tile_size):
     """
-    Draw colored boxes around tiles 
-    :param _thumbnail: np.ndarray
-    :param tile_size: int
-    :param tile_addresses:
-    :return: new thumbnail image with black boxes around tiles passing threshold
+    Draw colored boxes around tiles passing the otsu and purple score thresholds, colored by otsu score.
+    Boxes are drawn just outside each tile like skimage.draw.rectangle_perimeter(), later tiles on top.
+
+    :param df: pd.DataFrame tile index, see make_tile_index(), with otsu_score and purple_score columns
+    :param thumbnail_img: np.ndarray RGB thumbnail, modified in place
+    :param tile_size: int, tile size at the thumbnail scale
+    :return: thumbnail image with colored boxes around tiles passing threshold
     """
 
     assert isinstance(thumbnail_img, np.ndarray) and isinstance(tile_size, int)
-    thumbnail = array_to_slide(thumbnail_img)
-    generator, generator_level = get_full_resolution_generator(thumbnail, tile_size=tile_size)
-
-    for index, row in df.iterrows():
-        address = address_to_coord(index)
-
-        if not row.otsu_score   > 0.5: continue
-        if not row.purple_score > 0.1: continue
-
-        extent = generator.get_tile_dimensions(generator_level, address)
-        start = (address[1] * tile_size, address[0] * tile_size)  # flip because OpenSlide uses
-                                                                    # (column, row), but skimage
-                                                                    # uses (row, column)
-        rr, cc = rectangle_perimeter(start=start, extent=extent, shape=thumbnail_img.shape)
-        
-        # set color based on intensity of value instead of black border (1)
-        scaled_score = round(row.otsu_score * (NUM_COLORS-1))
-        thumbnail_img[rr, cc] = scoring_palette_as_list[scaled_score]
-    
+    height, width = thumbnail_img.shape[:2]
+
+    passing = ((df.otsu_score > 0.5) & (df.purple_score > 0.1)).to_numpy()
+    coords  = df.loc[passing, ["x", "y"]].to_numpy()
+    scaled_scores = np.round(df.otsu_score.to_numpy()[passing] * (NUM_COLORS-1)).astype(int)
+
+    tile_x, tile_y = coords[:, 0], coords[:, 1]
+    if ((tile_x * tile_size >= width) | (tile_y * tile_size >= height)).any():
+        raise ValueError('Invalid address')
+
+    # Tile extents as given by DeepZoomGenerator.get_tile_dimensions(), which returns (width, height)
+    # but was used as a (rows, columns) extent, kept so overlays stay the same
+    extent_rows = np.minimum(tile_size, width  - tile_x * tile_size)
+    extent_cols = np.minimum(tile_size, height - tile_y * tile_size)
+    row_start, col_start = tile_y * tile_size - 1, tile_x * tile_size - 1
+    row_end,   col_end   = row_start + extent_rows + 1, col_start + extent_cols + 1
+
+    # Top, bottom, left and right sides of every box, as (n_tiles, 4, side_length) arrays
+    steps = np.arange(tile_size + 2)
+    rows = np.stack(np.broadcast_arrays(row_start[:, None], row_end[:, None], row_start[:, None] + steps, row_start[:, None] + steps), axis=1)
+    cols = np.stack(np.broadcast_arrays(col_start[:, None] + steps, col_start[:, None] + steps, col_start[:, None], col_end[:, None]), axis=1)
+    valid = np.stack([steps <= extent_cols[:, None] + 1] * 2 + [steps <= extent_rows[:, None] + 1] * 2, axis=1)
+    valid &= (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    order = np.broadcast_to(np.arange(len(coords))[:, None, None], rows.shape)
+
+    # Where boxes overlap, the last tile in df order is drawn on top
+    owner = np.full(height * width, -1, dtype=np.int64)
+    np.maximum.at(owner, rows[valid] * width + cols[valid], order[valid])
+    pixels = np.flatnonzero(owner >= 0)
+
+    palette = np.array(scoring_palette_as_list, dtype=thumbnail_img.dtype)
+    thumbnail_img[pixels // width, pixels % width] = palette[scaled_scores[owner[pixels]]]
+
     return thumbnail_img
 
 ### MAIN ENTRY METHOD -> pretile
@@ -190,9 +538,10 @@ def pretile_scoring(slide_file_path: str, output_dir: str, params: dict):
     logger.info("Normalized magnification scale factor for %sx is %s, overall thumbnail scale factor is %s", requested_magnification, to_mag_scale_factor, to_thumbnail_scale_factor)
     logger.info("Requested tile size=%s, tile size at full magnficiation=%s, tile size at thumbnail=%s", requested_tile_size, full_resolution_tile_size, thumbnail_tile_size)
 
-    # Create thumbnail image for scoring
-    rbg_thumbnail  = get_downscaled_thumbnail(slide, to_thumbnail_scale_factor)
-    otsu_thumbnail = make_otsu(rbg_thumbnail)
+    # Create thumbnail image for scoring, cached next to the scores for the visualize step
+    slide_hash = params.get("slide_hash") or get_slide_hash(slide_file_path)
+    slide_stat = os.stat(slide_file_path)
+    rbg_thumbnail, otsu_thumbnail = get_thumbnail_and_otsu(slide, to_thumbnail_scale_factor, cache_dir=output_dir, slide_hash=slide_hash)
 
     # get DeepZoomGenerator, level
     full_generator, full_level = get_full_resolution_generator(slide, tile_size=full_resolution_tile_size)
@@ -201,20 +550,26 @@ def pretile_scoring(slide_file_path: str, output_dir: str, params: dict):
     logger.info("tiles x %s, tiles y %s", tile_x_count, tile_y_count)
 
     
-    address_raster = [{"address": coord_to_address(address, requested_magnification), "coordinates": address} for address in itertools.product(range(1, tile_x_count-1), range(1, tile_y_count-1))]
-    logger.info("Number of tiles in raster: %s", len(address_raster))
+    # Same column by column order as itertools.product(range(1, tile_x_count-1), range(1, tile_y_count-1))
+    raster_x = np.repeat(np.arange(1, tile_x_count-1), max(tile_y_count-2, 0))
+    raster_y = np.tile  (np.arange(1, tile_y_count-1), max(tile_x_count-2, 0))
+    logger.info("Number of tiles in raster: %s", len(raster_x))
 
-    df = pd.DataFrame(address_raster).set_index("address")
+    df = make_tile_index(raster_x, raster_y, requested_magnification)
 
-    df.loc[:, "otsu_score"  ] = get_otsu_scores   (df['coordinates'], otsu_thumbnail, thumbnail_tile_size)
-    df.loc[:, "purple_score"] = get_purple_scores (df['coordinates'], rbg_thumbnail,  thumbnail_tile_size)
+    # Single pass over the thumbnail for all scores. save_tiles() and visualize_scoring() select tiles on the
+    # default scores, so they are always computed, before the requested scorers which may override their columns
+    scorers = params.get("scorers", DEFAULT_TILE_SCORERS)
+    scorers = [scorer for scorer in DEFAULT_TILE_SCORERS if scorer not in scorers] + list(scorers)
+    for column, score_grid in score_tiles(rbg_thumbnail, thumbnail_tile_size, scorers, otsu_thumbnail).items():
+        df.loc[:, column] = get_scores_at_addresses(score_grid, df[["x", "y"]].to_numpy())
 
     logger.info("Displaying DataFrame for otsu_score > 0.5:")
     logger.info (df [ df["otsu_score"] > 0.5 ])
 
-    output_file = os.path.join(output_dir, "tile_scores_and_labels.csv")
+    output_file = os.path.join(output_dir, "tile_scores_and_labels.parquet")
 
-    df.to_csv(output_file)
+    write_tile_index(df, output_file)
 
     logger.info ("Saved tile scores at %s", output_file)
 
@@ -225,7 +580,12 @@ def pretile_scoring(slide_file_path: str, output_dir: str, params: dict):
         "tile_size": requested_tile_size,
         "full_resolution_tile_size": full_resolution_tile_size,
         "total_tiles": len(df),
-        "available_labels": list(df.columns)
+        "available_labels": list(df.columns),
+        "slide_hash": slide_hash,
+        "slide_size": slide_stat.st_size,
+        "slide_mtime_ns": slide_stat.st_mtime_ns,
+        "thumbnail_cache_dir": output_dir,
+        "params_hash": get_params_hash(params)
     }
 
     return properties
@@ -260,9 +620,11 @@ def visualize_scoring(slide_file_path: str, scores_file_path: str, output_dir: s
 
     output_file = os.path.join(output_dir, "tile_scores_and_labels_visualization.png")
 
-    # Create thumbnail image for scoring
-    rbg_thumbnail  = get_downscaled_thumbnail(slide, to_thumbnail_scale_factor)
-    df_scores      = pd.read_csv(scores_file_path).set_index("address")
+    # Reuse the thumbnail cached by pretile_scoring, the TileScores properties are passed in params
+    rbg_thumbnail, _ = get_thumbnail_and_otsu(slide, to_thumbnail_scale_factor,
+                                              cache_dir=params.get("thumbnail_cache_dir"), slide_hash=params.get("slide_hash"))
+    rbg_thumbnail  = np.array(rbg_thumbnail)
+    df_scores      = read_tile_index(scores_file_path)
 
     thumbnail_overlayed = visualize_tiling_scores(df_scores, rbg_thumbnail, thumbnail_tile_size)
     thumbnail_overlayed = Image.fromarray(thumbnail_overlayed)
@@ -272,13 +634,115 @@ def visualize_scoring(slide_file_path: str, scores_file_path: str, output_dir: s
 
     properties = {
         "file": output_file,
+        "params_hash": get_params_hash(params)
     }
 
     return properties
 
 
+# Slide handle of a save_tiles worker process, see init_tile_worker()
+_tile_worker = {}
+
+# USED -> save tiles
+def init_tile_worker(slide_file_path, full_resolution_tile_size, requested_tile_size):
+    """
+    Open the slide once per worker process, OpenSlide handles can't be shared across processes
+
+    :param slide_file_path: path to the WSI
+    :param full_resolution_tile_size: tile size at full resolution
+    :param requested_tile_size: output tile size
+    """
+    slide  = openslide.OpenSlide(slide_file_path)
+    reader = SlideRegionReader(slide, full_resolution_tile_size, requested_tile_size)
+    _tile_worker.update(slide=slide, reader=reader)
+
+# USED -> save tiles
+def write_tiles_at_offsets(output_file, coords, offsets, requested_tile_size):
+    """
+    Read, resize and write tiles into pre-computed offsets of an already allocated output file
+
+    :param output_file: path to tiles.slice.pil
+    :param coords: list of (x, y) tile addresses
+    :param offsets: list of byte offsets, one per tile
+    :param requested_tile_size: output tile size
+    :return: number of tiles written
+    """
+    reader      = _tile_worker['reader']
+    tile_length = requested_tile_size * requested_tile_size * 3
+
+    with open(output_file, 'r+b') as fp:
+        for coord, offset in zip(coords, offsets):
+            img_pil   = reader.get_tile(coord)
+            img_bytes = img_pil.tobytes()
+            assert img_pil.mode == "RGB" and len(img_bytes) == tile_length
+
+            fp.seek(offset)
+            fp.write(img_bytes)
+
+    return len(coords)
+
+# USED -> save tiles
+def write_tiles_to_shard(shard_path, addresses, coords, requested_tile_size, tile_codec, tile_quality):
+    """
+    Read, resize, encode and pack tiles into one shard file, see tile_shards.write_tile_shard()
+
+    :param shard_path: output path
+    :param addresses: list of tile addresses
+    :param coords: list of (x, y) tile addresses, one per address
+    :param requested_tile_size: output tile size
+    :param tile_codec: one of tile_shards.TILE_CODECS
+    :param tile_quality: JPEG quality
+    :return: list of [address, offset, length] index entries, seconds spent encoding
+    """
+    reader = _tile_worker['reader']
+    encode_seconds = 0
+
+    def encoded_tiles():
+        nonlocal encode_seconds
+        for address, coord in zip(addresses, coords):
+            img_pil = reader.get_tile(coord)
+            start = time.perf_counter()
+            tile_bytes = encode_tile(img_pil, tile_codec, tile_quality)
+            encode_seconds += time.perf_counter() - start
+            yield address, tile_bytes
+
+    entries = write_tile_shard(shard_path, encoded_tiles(), tile_codec, requested_tile_size, "RGB")
+    return entries, encode_seconds
+
+# USED -> save tiles
+def run_tile_jobs(jobs, num_processes, slide_file_path, full_resolution_tile_size, requested_tile_size):
+    """
+    Run tile jobs in a process pool, or in this process if num_processes is 1
+
+    :param jobs: list of (function, *args) tuples
+    :return: list of job results, in job order
+    """
+    logger = logging.getLogger(__name__)
+
+    if num_processes > 1:
+        with ProcessPoolExecutor(num_processes, initializer=init_tile_worker, initargs=(slide_file_path, full_resolution_tile_size, requested_tile_size)) as executor:
+            futures = [executor.submit(*job) for job in jobs]
+            for counter, future in enumerate(as_completed(futures)):
+                logger.info( "Proccessing tile jobs [%s,%s]", counter + 1, len(jobs))
+            return [future.result() for future in futures]
+
+    init_tile_worker(slide_file_path, full_resolution_tile_size, requested_tile_size)
+    return [job[0](*job[1:]) for job in jobs]
+
 ### MAIN ENTRY METHOD -> save tiles
 def save_tiles(slide_file_path: str, scores_file_path: str, output_dir: str, params: dict):
+    """
+    Save tiles passing the otsu and purple score thresholds, indexed by the address.slice.parquet tile index
+
+    With the default "raw" tile_codec, tiles are saved as raw RGB bytes to tiles.slice.pil. Tiles are a fixed size,
+    so each tile's offset is known upfront. With the "png", "webp" or "jpeg" tile_codec, tiles are compressed and packed
+    into shards of tiles_per_shard tiles, see tile_shards.py.
+
+    Tiles are read from the native pyramid level closest to the requested magnification, see SlideRegionReader.
+
+    With num_processes > 1 the work is split across a process pool, each worker reading from its own OpenSlide handle
+    and writing into its part of the file or its own shards. The output is identical to the single process output.
+    """
     logger = logging.getLogger(__name__)
 
     logger.info("Processing slide %s", slide_file_path)
@@ -286,9 +750,13 @@ def save_tiles(slide_file_path: str, scores_file_path: str, output_dir: str, par
 
     requested_tile_size       = params.get("tile_size")
     requested_magnification   = params.get("magnification")
+    num_processes             = params.get("num_processes", 1)
+    tile_codec                = params.get("tile_codec", "raw")
+    tile_quality              = params.get("tile_quality", 90)
+    tiles_per_shard           = params.get("tiles_per_shard", 4096)
 
     slide = openslide.OpenSlide(slide_file_path)
-    df_scores = pd.read_csv(scores_file_path).set_index("address")
+    df_scores = read_tile_index(scores_file_path)
 
     to_mag_scale_factor = get_scale_factor_at_magnfication (slide, requested_magnification=requested_magnification)
 
@@ -297,40 +765,68 @@ def save_tiles(slide_file_path: str, scores_file_path: str, output_dir: str, par
 
     full_resolution_tile_size = requested_tile_size * to_mag_scale_factor
 
-    generator, level = get_full_resolution_generator(slide, tile_size=full_resolution_tile_size)
-
-    fp = open(f"{output_dir}/tiles.slice.pil",'wb')
-    offset = 0
-    counter = 0
-    for index, row in df_scores.iterrows():
-        counter += 1
-        if counter % 10000 == 0: logger.info( "Proccessing tiles [%s,%s]", counter, len(df_scores))
+    # Tiles are always RGB, so every raw tile has the same length
+    tile_mode   = "RGB"
+    tile_length = requested_tile_size * requested_tile_size * len(tile_mode)
 
-        if not row.otsu_score   > 0.5: continue
-        if not row.purple_score > 0.1: continue
+    addresses = df_scores.index[(df_scores.otsu_score > 0.5) & (df_scores.purple_score > 0.1)]
+    coords    = [tuple(coord) for coord in df_scores.loc[addresses, ["x", "y"]].to_numpy().tolist()]
+    logger.info("Saving %s tiles out of %s", len(addresses), len(df_scores))
 
-        img_pil     = generator.get_tile(level, address_to_coord(index)).resize((requested_tile_size,requested_tile_size))
-        img_bytes   = img_pil.tobytes()
-
-        fp.write( img_bytes )
-
-        df_scores.loc[index, "tile_image_offset"]   = int(offset)
-        df_scores.loc[index, "tile_image_length"]   = int(len(img_bytes))
-        df_scores.loc[index, "tile_image_size_xy"]  = int(img_pil.size[0])
-        df_scores.loc[index, "tile_image_mode"]     = img_pil.mode
-
-        offset += len(img_bytes)
-    
-    fp.close()
-
-    df_scores.dropna().to_csv(f"{output_dir}/address.slice.csv")
+    for column in ["tile_image_offset", "tile_image_length", "tile_image_size_xy"]:
+        df_scores[column] = np.nan
+    df_scores["tile_image_mode"] = None
 
     properties = {
         "path":output_dir,
-        "pil_image_bytes_mode": img_pil.mode,
-        "pil_image_bytes_size": img_pil.size[0],
-        "pil_image_bytes_length": len(img_pil.tobytes())
+        "tile_codec": tile_codec,
+        "pil_image_bytes_mode": tile_mode,
+        "pil_image_bytes_size": requested_tile_size,
+        "pil_image_bytes_length": tile_length,
+        "params_hash": get_params_hash(params)
     }
-    return properties
 
-      
+    if tile_codec == "raw":
+        offsets = np.arange(len(addresses), dtype=np.int64) * tile_length
+
+        output_file = f"{output_dir}/tiles.slice.pil"
+        with open(output_file, 'wb') as fp:
+            fp.truncate(len(addresses) * tile_length)
+
+        chunks = [chunk for chunk in np.array_split(np.arange(len(addresses)), num_processes * 4) if len(chunk) > 0]
+        jobs   = [(write_tiles_at_offsets, output_file, [coords[i] for i in chunk], offsets[chunk].tolist(), requested_tile_size) for chunk in chunks]
+        run_tile_jobs(jobs, num_processes, slide_file_path, full_resolution_tile_size, requested_tile_size)
+
+        df_scores.loc[addresses, "tile_image_offset"] = offsets
+        df_scores.loc[addresses, "tile_image_length"] = tile_length
+    else:
+        shards = [(addresses[start:start + tiles_per_shard].tolist(), coords[start:start + tiles_per_shard]) for start in range(0, len(addresses), tiles_per_shard)]
+        jobs   = [(write_tiles_to_shard, os.path.join(output_dir, get_shard_name(shard_id)), *shard, requested_tile_size, tile_codec, tile_quality) for shard_id, shard in enumerate(shards)]
+        results = run_tile_jobs(jobs, num_processes, slide_file_path, full_resolution_tile_size, requested_tile_size)
+
+        df_entries = pd.DataFrame([entry + [get_shard_name(shard_id)] for shard_id, (entries, _) in enumerate(results) for entry in entries],
+                                  columns=["address", "tile_image_offset", "tile_image_length", "tile_shard"]).set_index("address")
+        df_scores.loc[df_entries.index, "tile_image_offset"] = df_entries.tile_image_offset
+        df_scores.loc[df_entries.index, "tile_image_length"] = df_entries.tile_image_length
+        df_scores.loc[df_entries.index, "tile_shard"]        = df_entries.tile_shard
+
+        raw_bytes      = len(addresses) * tile_length
+        encoded_bytes  = df_entries.tile_image_length.sum()
+        encode_seconds = sum(encode_seconds for _, encode_seconds in results)
+
+        properties.update({
+            "tile_quality": tile_quality,
+            "tiles_per_shard": tiles_per_shard,
+            "num_shards": len(shards),
+            "compression_ratio": float(raw_bytes / encoded_bytes) if encoded_bytes else 0.0,
+            "encode_megabytes_per_second": float(raw_bytes / 1e6 / encode_seconds) if encode_seconds else 0.0
+        })
+        logger.info("Compression ratio = %s, encode throughput = %s MB/s", properties["compression_ratio"], properties["encode_megabytes_per_second"])
+
+    # Assemble the index once all tiles are written
+    df_scores.loc[addresses, "tile_image_size_xy"]  = requested_tile_size
+    df_scores.loc[addresses, "tile_image_mode"]     = tile_mode
+
+    write_tile_index(df_scores.dropna(), f"{output_dir}/address.slice.parquet")
+
+    return properties
@@ -0,0 +1,84 @@
+'''
+State of the last SlideViewer pull of each (slide, user), for incremental annotation pulls
+
+The state table is a delta table next to the proxy table, see constants.PULL_STATE_LOCATION(), with one row per
+(slideviewer_path, user) holding:
+
+    content_hash    record uuid of the last pulled annotation, e.g. SVBMP-{bmp_hash}
+    content_length  size in bytes of the last pulled annotation
+    etag            ETag returned by SlideViewer, if any
+    last_modified   Last-Modified returned by SlideViewer, if any
+    date_updated    time of the last pull that found the annotation
+
+Pulls set a pull_status on each (slide, user) row, one of PULL_STATUSES. Only changed annotations are converted and
+merged into the proxy table.
+'''
+import os
+
+from pyspark.sql.functions import col, current_timestamp, lit
+
+PULL_STATE_KEYS    = ["slideviewer_path", "user"]
+PULL_STATE_COLUMNS = ["content_hash", "content_length", "etag", "last_modified"]
+
+# values of annotations that were never pulled
+PULL_STATE_DEFAULTS = {"content_hash": "", "content_length": -1, "etag": "", "last_modified": ""}
+
+PULL_CHANGED   = "changed"
+PULL_UNCHANGED = "unchanged"
+PULL_NOT_FOUND = "not_found"
+PULL_FAILED    = "failed"
+PULL_STATUSES  = [PULL_CHANGED, PULL_UNCHANGED, PULL_NOT_FOUND, PULL_FAILED]
+
+
+def add_pull_state(spark, df, state_table_path=None):
+    """
+    Add the state of the last pull of each (slide, user) row, and an empty pull_status column
+
+    :param spark: spark session
+    :param df: dataframe with slideviewer_path and user columns
+    :param state_table_path: path to the state table, None to pull everything as if never pulled
+    :return: dataframe with the PULL_STATE_COLUMNS and pull_status added
+    """
+    if state_table_path is None or not os.path.exists(state_table_path):
+        for column, default in PULL_STATE_DEFAULTS.items():
+            df = df.withColumn(column, lit(default))
+    else:
+        state_df = spark.read.format("delta").load(state_table_path).select(PULL_STATE_KEYS + PULL_STATE_COLUMNS)
+        df = df.join(state_df, on=PULL_STATE_KEYS, how="left") \
+            .select(df.columns + PULL_STATE_COLUMNS) \
+            .fillna(PULL_STATE_DEFAULTS)
+
+    return df.withColumn("content_length", col("content_length").cast("long")) \
+        .withColumn("pull_status", lit(""))
+
+
+def update_pull_state(spark, df, state_table_path):
+    """
+    Save the state of all annotations found by a pull
+
+    :param spark: spark session
+    :param df: dataframe from a pull, with the PULL_STATE_COLUMNS and pull_status
+    :param state_table_path: path to the state table
+    """
+    state_df = df.filter(col("pull_status").isin(PULL_CHANGED, PULL_UNCHANGED)) \
+        .select(PULL_STATE_KEYS + PULL_STATE_COLUMNS) \
+        .withColumn("date_updated", current_timestamp())
+
+    if not os.path.exists(state_table_path):
+        state_df.write.format("delta").save(state_table_path)
+    else:
+        from delta.tables import DeltaTable
+        DeltaTable.forPath(spark, state_table_path).alias("state") \
+            .merge(state_df.alias("updates"), " AND ".join(f"state.{key} = updates.{key}" for key in PULL_STATE_KEYS)) \
+            .whenMatchedUpdateAll() \
+            .whenNotMatchedInsertAll() \
+            .execute()
+
+
+def get_pull_summary(df):
+    """
+    :param df: dataframe from a pull, with a pull_status column
+    :return: dict of pull status -> number of (slide, user) annotations
+    """
+    counts = {row["pull_status"]: row["count"] for row in df.groupby("pull_status").count().collect()}
+    return {status: counts.get(status, 0) for status in PULL_STATUSES}
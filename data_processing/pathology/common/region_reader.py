@@ -0,0 +1,105 @@
+'''
+Level-aware tile reads for whole slide images
+
+A tile of full_resolution_tile_size pixels at full resolution is read from the native pyramid level closest to
+(but not below) the requested magnification, so it only has to be resized by the remaining factor. Tiles are read
+in blocks of adjacent tiles, and decoded blocks are kept in an LRU cache.
+'''
+from collections import OrderedDict
+
+import openslide
+from PIL import Image
+
+# Tolerance for pyramid level downsamples that are not exact integers, e.g. 4.0003
+DOWNSAMPLE_TOLERANCE = 0.01
+
+
+class SlideRegionReader(object):
+    """
+    SlideRegionReader: reads tiles at the best native pyramid level, in cached blocks of adjacent tiles
+
+    Blocks run along the y axis, since tile rasters from pretile_scoring() are ordered column by column.
+    Reads from level 0 are identical to DeepZoomGenerator.get_tile() at full resolution.
+
+    Example usage:
+    $ reader = SlideRegionReader(openslide.OpenSlide("/path/to/slide.svs"), full_resolution_tile_size=256, tile_size=128)
+    $ reader.level
+        > 1
+    $ reader.get_tile((10, 21)).size
+        > (128, 128)
+    """
+
+    def __init__(self, slide, full_resolution_tile_size, tile_size, block_tiles=8, cache_size=16, bg_color='#ffffff'):
+        """
+        :param slide: openslide.OpenSlide or openslide.ImageSlide
+        :param full_resolution_tile_size: tile size at full resolution (level 0)
+        :param tile_size: requested output tile size
+        :param block_tiles: number of adjacent tiles read with one read_region() call
+        :param cache_size: number of decoded blocks to keep
+        :param bg_color: background color for transparent regions, as used by DeepZoomGenerator
+        """
+        assert isinstance(slide, openslide.OpenSlide) or isinstance(slide, openslide.ImageSlide)
+
+        self.slide = slide
+        self.full_resolution_tile_size = full_resolution_tile_size
+        self.tile_size   = tile_size
+        self.block_tiles = block_tiles
+        self.cache_size  = cache_size
+        self.bg_color    = bg_color
+
+        # Highest level that is still at least as detailed as the requested tile size
+        requested_downsample = full_resolution_tile_size / tile_size
+        self.level = 0
+        for level, downsample in enumerate(slide.level_downsamples):
+            if downsample <= requested_downsample * (1 + DOWNSAMPLE_TOLERANCE):
+                self.level = level
+        self.downsample = slide.level_downsamples[self.level]
+
+        self._cache = OrderedDict()
+        self.cache_hits   = 0
+        self.cache_misses = 0
+
+    def _to_level(self, coordinate):
+        return int(round(coordinate / self.downsample))
+
+    def _read_block(self, x, block_y):
+        """
+        Read a column of up to block_tiles tiles starting at tile row block_y * block_tiles, composited on the background
+        """
+        key = (x, block_y)
+        if key in self._cache:
+            self.cache_hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self.cache_misses += 1
+
+        slide_width, slide_height = self.slide.dimensions
+        x0 = x * self.full_resolution_tile_size
+        y0 = block_y * self.block_tiles * self.full_resolution_tile_size
+        x1 = min(x0 + self.full_resolution_tile_size, slide_width)
+        y1 = min(y0 + self.block_tiles * self.full_resolution_tile_size, slide_height)
+
+        size   = (self._to_level(x1) - self._to_level(x0), self._to_level(y1) - self._to_level(y0))
+        region = self.slide.read_region((x0, y0), self.level, size)
+        block  = Image.composite(region, Image.new('RGB', size, self.bg_color), region)
+
+        self._cache[key] = block
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return block
+
+    def get_tile(self, address):
+        """
+        :param address: (x, y) tile address at full resolution
+        :return: PIL RGB image of tile_size x tile_size
+        """
+        x, y = address
+        block_y, offset_y = divmod(y, self.block_tiles)
+        block = self._read_block(x, block_y)
+
+        tile_y0 = block_y * self.block_tiles * self.full_resolution_tile_size
+        top     = self._to_level(tile_y0 + offset_y * self.full_resolution_tile_size) - self._to_level(tile_y0)
+        bottom  = self._to_level(tile_y0 + (offset_y + 1) * self.full_resolution_tile_size) - self._to_level(tile_y0)
+
+        return block.crop((0, top, block.size[0], min(bottom, block.size[1]))).resize((self.tile_size, self.tile_size))
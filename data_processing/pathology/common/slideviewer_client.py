@@ -4,10 +4,63 @@ Created on January 31, 2021
 @author: pashaa@mskcc.org
 
 Functions for downloading annotations from SlideViewer
+
+Downloads go through a requests.Session shared by the process (so by each spark python worker), which keeps
+connections to SlideViewer alive between slides and retries failed requests with exponential backoff.
+download_zips() and download_sv_point_annotations() download many annotations concurrently over that session.
 '''
 import os
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# streamed bmp zips are written in chunks of this many bytes
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# retries of failed connections, reads and 429/5xx responses, waiting backoff_factor * 2^(retry - 1) seconds in between
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF_FACTOR = 0.5
+DOWNLOAD_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# (connect, read) timeouts in seconds
+DOWNLOAD_TIMEOUT = (30, 600)
+
+# concurrent downloads of the batch functions, and pooled connections of the shared session
+DOWNLOAD_THREADS = 8
+
+# message returned by slideviewer in place of the zip
+LABEL_NOT_FOUND = b'Label image not found.'
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(retries=DOWNLOAD_RETRIES, backoff_factor=DOWNLOAD_BACKOFF_FACTOR, pool_size=DOWNLOAD_THREADS):
+    '''
+    Get the requests.Session of this process for the given retry settings, created on first use.
+
+    :param retries: number of retries of a failed request
+    :param backoff_factor: backoff factor between retries, see urllib3.util.retry.Retry
+    :param pool_size: number of connections kept alive per host, should be at least the number of threads using the session
+    :return: requests.Session
+    '''
+    key = (retries, backoff_factor, pool_size)
+    with _sessions_lock:
+        if key not in _sessions:
+            retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=DOWNLOAD_RETRY_STATUSES)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = session
+
+        return _sessions[key]
+
 
 def get_slide_id(full_filename):
     '''
@@ -72,7 +125,22 @@ def fetch_slide_ids(url, project_id, dest_dir, csv_file=None):
     return slides
 
 
-def download_zip(url, dest_path, chunk_size=128):
+def save_zip(response, dest_path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    '''
+    Saves a streamed zip response to the specified file path.
+
+    :return True if zipfile saved, False if slideviewer returned its label image not found message
+    '''
+    with open(dest_path, 'wb') as fd:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if chunk == LABEL_NOT_FOUND:  # message from slideviewer
+                return False
+            else:
+                fd.write(chunk)
+        return True
+
+
+def download_zip(url, dest_path, chunk_size=DOWNLOAD_CHUNK_SIZE, session=None):
     '''
     # useful: https://stackoverflow.com/questions/9419162/download-returned-zip-file-from-url
 
@@ -81,18 +149,71 @@ def download_zip(url, dest_path, chunk_size=128):
     :url - slideviewer url to download zip from
     :dest_path - file path where zipfile should be saved
     :chunk_size - size in bytes of chunks to batch out during download
+    :session - requests.Session to download with, defaults to the shared session from get_session()
     :return True if zipfile downloaded and saved successfully, else false
+    :raises requests.RequestException if the request failed after all retries, or with an http error status
     '''
-    response = requests.get(url, stream=True)
-    with open(dest_path, 'wb') as fd:
-        for chunk in response.iter_content(chunk_size=chunk_size):
-            if chunk == b'Label image not found.':  # message from slideviewer
-                return False
-            else:
-                fd.write(chunk)
-        return True
+    session = session or get_session()
+
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        return save_zip(response, dest_path, chunk_size)
+
 
-    return False
+def download_zip_if_changed(url, dest_path, etag='', last_modified='', chunk_size=DOWNLOAD_CHUNK_SIZE, session=None):
+    '''
+    Downloads zip from the specified URL unless it is unchanged since the download that returned the given http
+    validators. Without validators, or if slideviewer ignores them, the zip is always downloaded.
+
+    :param url: slideviewer url to download zip from
+    :param dest_path: file path where zipfile should be saved
+    :param etag: ETag of the previous download
+    :param last_modified: Last-Modified of the previous download
+    :param chunk_size: size in bytes of chunks to batch out during download
+    :param session: requests.Session to download with, defaults to the shared session from get_session()
+    :return: (status, etag, last_modified), where status is 'downloaded', 'not_modified' or 'not_found'
+    :raises requests.RequestException if the request failed after all retries, or with an http error status
+    '''
+    session = session or get_session()
+
+    headers = {}
+    if etag: headers['If-None-Match'] = etag
+    if last_modified: headers['If-Modified-Since'] = last_modified
+
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as response:
+        if response.status_code == 304:
+            return 'not_modified', etag, last_modified
+        response.raise_for_status()
+
+        status = 'downloaded' if save_zip(response, dest_path, chunk_size) else 'not_found'
+        return status, response.headers.get('ETag', ''), response.headers.get('Last-Modified', '')
+
+
+def download_zips(downloads, num_threads=DOWNLOAD_THREADS, chunk_size=DOWNLOAD_CHUNK_SIZE, retries=DOWNLOAD_RETRIES):
+    '''
+    Downloads many zips concurrently over a shared session, with at most num_threads downloads at once.
+    Zips unchanged since the download that returned the given http validators are not downloaded again,
+    see download_zip_if_changed().
+
+    :param downloads: list of (url, dest_path) or (url, dest_path, etag, last_modified)
+    :param num_threads: number of concurrent downloads
+    :param chunk_size: size in bytes of chunks to batch out during download
+    :param retries: number of retries of a failed request
+    :return: list with, for each download, (status, etag, last_modified) as returned by download_zip_if_changed(),
+             or None if the request failed after all retries
+    '''
+    session = get_session(retries=retries, pool_size=num_threads)
+
+    def download(url_dest_path_and_validators):
+        url, dest_path, *validators = url_dest_path_and_validators
+        try:
+            return download_zip_if_changed(url, dest_path, *validators, chunk_size=chunk_size, session=session)
+        except requests.RequestException as err:
+            print(" +- ERROR downloading " + url + ": " + str(err))
+            return None
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        return list(executor.map(download, downloads))
 
 
 def unzip(zipfile_path):
@@ -113,15 +234,18 @@ def unzip(zipfile_path):
         return None
 
 
-def download_sv_point_annotation(url):
+def download_sv_point_annotation(url, session=None):
     """
     Call slideviewer API with the given url
 
     :param url: slide viewer api to call
+    :param session: requests.Session to call with, defaults to the shared session from get_session()
     :return: json response
     """
+    session = session or get_session()
+
     try:
-        response = requests.get(url)
+        response = session.get(url, timeout=DOWNLOAD_TIMEOUT)
         data = response.json()
     except Exception as err:
         print(err)
@@ -133,3 +257,18 @@ def download_sv_point_annotation(url):
     else:
         print(" +- Label annotation file does not exist for slide and user.")
         return None
+
+
+def download_sv_point_annotations(urls, num_threads=DOWNLOAD_THREADS, retries=DOWNLOAD_RETRIES):
+    """
+    Call slideviewer API with many urls concurrently over a shared session, with at most num_threads calls at once.
+
+    :param urls: list of slide viewer apis to call
+    :param num_threads: number of concurrent calls
+    :param retries: number of retries of a failed request
+    :return: list of json responses, None for empty or failed responses
+    """
+    session = get_session(retries=retries, pool_size=num_threads)
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        return list(executor.map(lambda url: download_sv_point_annotation(url, session=session), urls))
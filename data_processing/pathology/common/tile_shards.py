@@ -0,0 +1,143 @@
+'''
+Compressed tile storage, an alternative to the raw tiles.slice.pil written by preprocess.save_tiles()
+
+Tiles are encoded one by one (lossless PNG/WebP, or JPEG at a given quality) and packed into shard files
+holding a fixed number of tiles. Each shard ends with a footer index, so tiles stay randomly accessible:
+
+    [tile 0 bytes][tile 1 bytes]...[footer json][footer length: uint64 little endian][magic: 8 bytes]
+
+The footer json holds the codec, tile size and mode, and a list of [address, offset, length] entries.
+'''
+import json, os, struct
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+SHARD_MAGIC   = b"MINDTSH1"
+SHARD_TRAILER = struct.Struct("<Q8s")
+
+# codec -> (PIL format, save kwargs given a quality)
+TILE_CODECS = {
+    "png":  ("PNG",  lambda quality: {"compress_level": 1}),
+    "webp": ("WEBP", lambda quality: {"lossless": True}),
+    "jpeg": ("JPEG", lambda quality: {"quality": quality}),
+}
+
+
+def encode_tile(img_pil, codec, quality=90):
+    """
+    :param img_pil: PIL image
+    :param codec: one of TILE_CODECS
+    :param quality: JPEG quality, ignored by lossless codecs
+    :return: encoded bytes
+    """
+    if codec not in TILE_CODECS:
+        raise ValueError(f"Unknown tile codec {codec}, expected one of {list(TILE_CODECS)}")
+    image_format, get_kwargs = TILE_CODECS[codec]
+
+    buffer = BytesIO()
+    img_pil.save(buffer, format=image_format, **get_kwargs(quality))
+    return buffer.getvalue()
+
+
+def get_shard_name(shard_id):
+    return f"tiles.{shard_id:05d}.shard"
+
+
+def write_tile_shard(shard_path, encoded_tiles, codec, tile_size, tile_mode):
+    """
+    Pack encoded tiles into a shard file with a footer index
+
+    :param shard_path: output path
+    :param encoded_tiles: iterable of (address, encoded bytes)
+    :param codec: codec used to encode the tiles
+    :param tile_size: tile width/height
+    :param tile_mode: PIL mode of the decoded tiles
+    :return: list of [address, offset, length] index entries
+    """
+    entries = []
+    offset  = 0
+    with open(shard_path, 'wb') as fp:
+        for address, tile_bytes in encoded_tiles:
+            fp.write(tile_bytes)
+            entries.append([address, offset, len(tile_bytes)])
+            offset += len(tile_bytes)
+
+        footer = json.dumps({"codec": codec, "tile_size": tile_size, "tile_mode": tile_mode, "tiles": entries}).encode('utf-8')
+        fp.write(footer)
+        fp.write(SHARD_TRAILER.pack(len(footer), SHARD_MAGIC))
+
+    return entries
+
+
+class TileShardReader(object):
+    """
+    TileShardReader: random access to the tiles of one shard, using its footer index
+
+    Example usage:
+    $ reader = TileShardReader("/path/to/TileImages/output/tiles.00000.shard")
+    $ reader.get_tile("x10_y21_z20").shape
+        > (128, 128, 3)
+
+    Iterating across the shards collected by collect_tiles:
+    $ for reader in TileShardReader.from_parquet("/path/to/output_container/123.parquet"):
+    $     for address, tile in reader: ...
+    """
+
+    def __init__(self, shard_path):
+        """
+        :param shard_path: path to a shard file
+        """
+        self.shard_path = str(shard_path)
+        self._data = np.memmap(self.shard_path, dtype=np.uint8, mode='r')
+
+        footer_length, magic = SHARD_TRAILER.unpack(self._data[-SHARD_TRAILER.size:].tobytes())
+        if magic != SHARD_MAGIC:
+            raise ValueError(f"{self.shard_path} is not a tile shard")
+
+        footer_end = len(self._data) - SHARD_TRAILER.size
+        footer = json.loads(self._data[footer_end - footer_length:footer_end].tobytes().decode('utf-8'))
+
+        self.codec     = footer["codec"]
+        self.tile_size = footer["tile_size"]
+        self.tile_mode = footer["tile_mode"]
+        self._entries  = {address: (offset, length) for address, offset, length in footer["tiles"]}
+
+    @classmethod
+    def from_parquet(cls, parquet_path, path_column="data_path"):
+        """
+        Generator over one reader per shard listed in a collect_tiles parquet file
+
+        :param parquet_path: path to parquet file
+        :param path_column: column holding the shard path of each row
+        """
+        for data_path in pd.read_parquet(parquet_path, columns=[path_column])[path_column].unique():
+            yield cls(data_path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        for address in self._entries:
+            yield address, self.get_tile(address)
+
+    @property
+    def addresses(self):
+        return list(self._entries)
+
+    def get_encoded_tile(self, address):
+        """
+        :param address: tile address, e.g. x10_y21_z20
+        :return: zero-copy np.ndarray view of the encoded tile bytes
+        """
+        offset, length = self._entries[address]
+        return self._data[offset:offset + length]
+
+    def get_tile(self, address):
+        """
+        :param address: tile address, e.g. x10_y21_z20
+        :return: decoded tile as np.ndarray
+        """
+        return np.array(Image.open(BytesIO(self.get_encoded_tile(address).tobytes())))
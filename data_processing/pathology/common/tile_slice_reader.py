@@ -0,0 +1,144 @@
+'''
+Random access to tiles written by preprocess.save_tiles()
+
+save_tiles() writes raw PIL bytes to tiles.slice.pil and indexes them in the address.slice.parquet tile index with
+x, y, z, tile_key, tile_image_offset, tile_image_length, tile_image_size_xy and tile_image_mode columns.
+Legacy address.slice.csv indexes are read as well.
+'''
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_processing.pathology.common.preprocess import read_tile_index
+
+
+class TileSliceReader(object):
+    """
+    TileSliceReader: memory maps a tiles.slice.pil file and joins it with its address index
+
+    Tiles are returned as zero-copy numpy views of shape (size, size, channels) into the memory map.
+
+    Example usage:
+    $ reader = TileSliceReader.from_dir("/path/to/TileImages/output")
+    $ len(reader)
+        > 1024
+    $ reader.get_tile("x10_y21_z20").shape
+        > (128, 128, 3)
+    $ reader.get_tile_at(10, 21).shape
+        > (128, 128, 3)
+    $ reader.get_batch(0, 64).shape
+        > (64, 128, 128, 3)
+
+    Iterating across the slices collected by collect_tiles:
+    $ for reader in TileSliceReader.from_parquet("/path/to/output_container/123.parquet"):
+    $     for address, tile in reader: ...
+    """
+
+    def __init__(self, data_path, index):
+        """
+        :param data_path: path to tiles.slice.pil
+        :param index: pd.DataFrame or path to address.slice.parquet
+        """
+        if not isinstance(index, pd.DataFrame):
+            index = read_tile_index(index)
+        if "address" in index.columns:
+            index = index.set_index("address")
+
+        self.data_path = str(data_path)
+        self.index     = index
+
+        self._offsets  = index["tile_image_offset"].to_numpy().astype(np.int64)
+        self._lengths  = index["tile_image_length"].to_numpy().astype(np.int64)
+        self._sizes    = index["tile_image_size_xy"].to_numpy().astype(np.int64)
+        self._channels = np.array([len(mode) for mode in index["tile_image_mode"]], dtype=np.int64)
+
+        self._positions   = {address: position for position, address in enumerate(index.index)}
+        self._coordinates = {(x, y): position for position, (x, y) in enumerate(index[["x", "y"]].itertuples(index=False))}
+
+        if os.path.getsize(self.data_path) > 0:
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        else:
+            self._data = np.empty(0, dtype=np.uint8)
+
+    @classmethod
+    def from_dir(cls, output_dir):
+        """
+        :param output_dir: save_tiles() output directory
+        """
+        index_path = os.path.join(output_dir, "address.slice.parquet")
+        if not os.path.exists(index_path):
+            index_path = os.path.join(output_dir, "address.slice.csv")
+        return cls(os.path.join(output_dir, "tiles.slice.pil"), index_path)
+
+    @classmethod
+    def from_parquet(cls, parquet_path, path_column="data_path"):
+        """
+        Generator over one reader per slice listed in a collect_tiles parquet file
+
+        :param parquet_path: path to parquet file
+        :param path_column: column holding the tiles.slice.pil path of each row
+        """
+        df = pd.read_parquet(parquet_path)
+        for data_path, df_slice in df.groupby(path_column, sort=False):
+            yield cls(data_path, df_slice)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __iter__(self):
+        for position, address in enumerate(self.index.index):
+            yield address, self._get_tile(position)
+
+    @property
+    def addresses(self):
+        return list(self.index.index)
+
+    def _get_tile(self, position):
+        offset, length = self._offsets[position], self._lengths[position]
+        size, channels = self._sizes[position], self._channels[position]
+        return self._data[offset:offset + length].reshape(size, size, channels)
+
+    def get_tile(self, address):
+        """
+        :param address: tile address, e.g. x10_y21_z20
+        :return: np.ndarray view of the tile
+        """
+        return self._get_tile(self._positions[address])
+
+    def get_tile_at(self, x, y):
+        """
+        :param x: tile column
+        :param y: tile row
+        :return: np.ndarray view of the tile
+        """
+        return self._get_tile(self._coordinates[(x, y)])
+
+    def get_tiles(self, addresses):
+        """
+        :param addresses: list of tile addresses
+        :return: np.ndarray of shape (len(addresses), size, size, channels)
+        """
+        return np.stack([self.get_tile(address) for address in addresses])
+
+    def get_batch(self, start, stop):
+        """
+        Tiles in index order, as a zero-copy view when the tiles are stored contiguously (as save_tiles() does)
+
+        :param start: first tile position
+        :param stop: last tile position (exclusive)
+        :return: np.ndarray of shape (stop - start, size, size, channels)
+        """
+        positions = np.arange(start, min(stop, len(self)))
+        if len(positions) == 0:
+            return np.empty((0, 0, 0, 0), dtype=np.uint8)
+
+        offsets, lengths = self._offsets[positions], self._lengths[positions]
+        is_contiguous = (lengths == lengths[0]).all() and (offsets == offsets[0] + np.arange(len(positions)) * lengths[0]).all() \
+            and (self._sizes[positions] == self._sizes[start]).all() and (self._channels[positions] == self._channels[start]).all()
+
+        if not is_contiguous:
+            return np.stack([self._get_tile(position) for position in positions])
+
+        size, channels = self._sizes[start], self._channels[start]
+        return self._data[offsets[0]:offsets[0] + lengths.sum()].reshape(len(positions), size, size, channels)
@@ -5,9 +5,11 @@ The steps for processing pathology nuclei point annotations includes:
 """
 
 import os, json
+from functools import partial
 import click
 from pyspark.sql.window import Window
-from pyspark.sql.functions import first, last, col, lit, desc, udf, explode, array, to_json, current_timestamp
+from pyspark.sql.functions import first, last, col, lit, desc, udf, explode, array, to_json, current_timestamp, length, when, \
+    from_json
 from pyspark.sql.types import ArrayType, StringType, IntegerType, MapType, StructType, StructField
 
 from data_processing.common.CodeTimer import CodeTimer
@@ -15,13 +17,28 @@ from data_processing.common.config import ConfigSet
 from data_processing.common.custom_logger import init_logger
 from data_processing.common.sparksession import SparkConfig
 from data_processing.pathology.common.slideviewer_client import fetch_slide_ids
+from data_processing.pathology.common.pull_state import add_pull_state, update_pull_state, get_pull_summary, \
+    PULL_CHANGED, PULL_UNCHANGED, PULL_NOT_FOUND
 import data_processing.common.constants as const
+from data_processing.common.delta_merge import merge_latest
 
 logger = init_logger()
 
 os.environ['OPENBLAS_NUM_THREADS'] = '1'
 
 
+def get_point_annotation_url(slideviewer_url, slideviewer_path, project_id, user):
+    """
+    :param slideviewer_url: slideviewer base url
+    :param slideviewer_path: slide path in slideviewer
+    :param project_id: slideviewer project id
+    :param user: username
+    :return: slideviewer API url of the point annotation json
+    """
+    return slideviewer_url + "/slides/" + str(user) + "@mskcc.org/projects;" + \
+           str(project_id) + ';' + slideviewer_path + "/getSVGLabels/nucleus"
+
+
 def download_point_annotation(slideviewer_url, slideviewer_path, project_id, user):
     """
     Return json response from slide viewer call
@@ -36,13 +53,30 @@ def download_point_annotation(slideviewer_url, slideviewer_path, project_id, use
 
     print (f" >>>>>>> Processing [{slideviewer_path}] <<<<<<<<")
 
-    url = slideviewer_url + "/slides/" + str(user) + "@mskcc.org/projects;" + \
-          str(project_id) + ';' + slideviewer_path + "/getSVGLabels/nucleus"
+    url = get_point_annotation_url(slideviewer_url, slideviewer_path, project_id, user)
     print(url)
 
     return download_sv_point_annotation(url)
 
 
+def download_point_annotations(batches, slideviewer_url):
+    """
+    Download the point annotation jsons of each arrow batch of (slide, user) rows concurrently, for mapInPandas
+
+    :param batches: iterator of dataframes with slideviewer_path, sv_project_id and user columns
+    :param slideviewer_url: slideviewer base url
+    :return: iterator of dataframes with an sv_json column added, serialized, None if not found
+    """
+    from slideviewer_client import download_sv_point_annotations
+
+    for batch in batches:
+        urls = [get_point_annotation_url(slideviewer_url, slideviewer_path, project_id, user)
+                for slideviewer_path, project_id, user in zip(batch.slideviewer_path, batch.sv_project_id, batch.user)]
+        sv_jsons = download_sv_point_annotations(urls)
+
+        yield batch.assign(sv_json=[json.dumps(sv_json) if sv_json is not None else None for sv_json in sv_jsons])
+
+
 @click.command()
 @click.option('-d', '--data_config_file', default=None, type=click.Path(exists=True),
               help="path to data yaml file containing information required for pathology point annotation data ingestion. "
@@ -78,6 +112,9 @@ def create_proxy_table():
 
     # load paths from configs
     point_table_path = const.TABLE_LOCATION(cfg)
+    pull_state_path = const.PULL_STATE_LOCATION(cfg)
+    # optional, only add annotations that changed since the last pull
+    incremental = cfg.get_value(path=const.DATA_CFG+'::INCREMENTAL') if cfg.has_value(path=const.DATA_CFG+'::INCREMENTAL') else False
 
     PROJECT_ID = cfg.get_value(path=const.DATA_CFG+'::PROJECT_ID')
     SLIDEVIEWER_URL = cfg.get_value(path=const.DATA_CFG+'::SLIDEVIEWER_URL')
@@ -94,6 +131,8 @@ def create_proxy_table():
     # populate columns
     df = df.withColumn("users", array([lit(user) for user in cfg.get_value(const.DATA_CFG+'::USERS')]))
     df = df.select("slideviewer_path", "slide_id", "sv_project_id", explode("users").alias("user"))
+    # state of the last pull of each (slide, user), empty unless incremental
+    df = add_pull_state(spark, df, pull_state_path if incremental else None)
 
     # download slide point annotation jsons
     # example point json:
@@ -101,14 +140,13 @@ def create_proxy_table():
     point_json_struct = ArrayType(
         MapType(StringType(), StringType())
     )
+    # the jsons of each arrow batch of (slide, user) rows are downloaded concurrently, and come back serialized
     spark.sparkContext.addPyFile("./data_processing/pathology/common/slideviewer_client.py")
-    download_point_annotation_udf = udf(download_point_annotation,  point_json_struct)
-
-    df = df.withColumn("sv_json",
-                       download_point_annotation_udf(lit(SLIDEVIEWER_URL), "slideviewer_path", "sv_project_id", "user"))\
+    df = df.repartition(spark.sparkContext.defaultParallelism) \
+        .mapInPandas(partial(download_point_annotations, slideviewer_url=SLIDEVIEWER_URL),
+                     schema=StructType(df.schema.fields + [StructField("sv_json", StringType())])) \
+        .withColumn("sv_json", from_json("sv_json", point_json_struct)) \
         .cache()
-    # drop empty jsons that may have been created
-    df = df.dropna(subset=["sv_json"])
 
     # populate "date_added", "date_updated","latest", "sv_json_record_uuid"
     spark.sparkContext.addPyFile("./data_processing/common/EnsureByteContext.py")
@@ -121,29 +159,27 @@ def create_proxy_table():
         .withColumn("date_added", current_timestamp()) \
         .withColumn("date_updated", current_timestamp())
 
-    df.show(10, False)
-
-    # create proxy sv_point json table
-    # update main table if exists, otherwise create main table
-    if not os.path.exists(point_table_path):
-        df.write.format("delta").save(point_table_path)
-    else:
-        from delta.tables import DeltaTable
-        point_table = DeltaTable.forPath(spark, point_table_path)
-        point_table.alias("main_point_table") \
-            .merge(df.alias("point_annotation_updates"), "main_point_table.sv_json_record_uuid = point_annotation_updates.sv_json_record_uuid") \
-            .whenMatchedUpdate(set = { "date_updated" : "point_annotation_updates.date_updated" } ) \
-            .whenNotMatchedInsertAll() \
-            .execute()
-
-    # add latest flag
-    windowSpec = Window.partitionBy("user", "slide_id").orderBy(desc("date_updated"))
-    # Note that last != opposite of first! Have to use desc ordering with first...
-    spark.read.format("delta").load(point_table_path) \
-        .withColumn("date_latest", first("date_updated").over(windowSpec)) \
-        .withColumn("latest", col("date_latest")==col("date_updated")) \
-        .drop("date_latest") \
-        .write.format("delta").mode("overwrite").option("overwriteSchema", "true").save(point_table_path)
+    # slideviewer sends no http validators for point jsons, so compare their hash with the last pull
+    df = df.withColumn("pull_status", when(col("sv_json").isNull(), lit(PULL_NOT_FOUND))
+                                      .when(col("sv_json_record_uuid") == col("content_hash"), lit(PULL_UNCHANGED))
+                                      .otherwise(lit(PULL_CHANGED))) \
+        .withColumn("content_hash", col("sv_json_record_uuid")) \
+        .withColumn("content_length", length(to_json("sv_json")).cast("long")) \
+        .cache()
+
+    pull_summary = get_pull_summary(df)
+    logger.info("Pulled point annotations: " + ", ".join(f"{count} {status}" for status, count in pull_summary.items()))
+    pull_df = df
+
+    # drop empty jsons that may have been created, and jsons unchanged since the last pull
+    df = df.filter(col("pull_status") == PULL_CHANGED) \
+        .drop("content_hash", "content_length", "etag", "last_modified", "pull_status")
+
+    # create proxy sv_point json table, or merge into the main table and flag the latest annotations
+    merge_latest(spark, df, point_table_path, "sv_json_record_uuid", ["user", "slide_id"])
+
+    if incremental:
+        update_pull_state(spark, pull_df, pull_state_path)
 
 if __name__ == "__main__":
     cli()
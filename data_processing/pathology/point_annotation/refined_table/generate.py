@@ -7,7 +7,7 @@ The steps for processing pathology nuclei point annotations includes:
 import os, json
 import click
 from pyspark.sql.window import Window
-from pyspark.sql.functions import first, last, col, lit, desc, udf, explode, array, to_json, current_timestamp
+from pyspark.sql.functions import first, last, col, lit, desc, udf, pandas_udf, explode, array, to_json, current_timestamp
 from pyspark.sql.types import ArrayType, StringType, MapType, IntegerType, StructType, StructField
 
 from data_processing.common.CodeTimer import CodeTimer
@@ -15,6 +15,7 @@ from data_processing.common.config import ConfigSet
 from data_processing.common.custom_logger import init_logger
 from data_processing.common.sparksession import SparkConfig
 import data_processing.common.constants as const
+from data_processing.common.delta_merge import merge_latest
 from data_processing.pathology.common.utils import get_labelset_keys
 
 os.environ['OPENBLAS_NUM_THREADS'] = '1'
@@ -76,6 +77,13 @@ def create_refined_table():
 
     df = spark.read.format("delta").load(point_table_path)
 
+    # optional, only build geojsons of point jsons that have none yet, e.g. new or changed since the last pull.
+    # geojsons of LABEL_SETS changed since they were built need a full run
+    incremental = cfg.has_value(path=const.DATA_CFG+'::INCREMENTAL') and cfg.get_value(path=const.DATA_CFG+'::INCREMENTAL')
+    if incremental and os.path.exists(geojson_table_path):
+        built_df = spark.read.format("delta").load(geojson_table_path).select("sv_json_record_uuid").distinct()
+        df = df.join(built_df, on="sv_json_record_uuid", how="left_anti")
+
     labelsets = get_labelset_keys()
     labelset_names = array([lit(key) for key in labelsets])
 
@@ -88,9 +96,10 @@ def create_refined_table():
     label_config = cfg.get_value(path=const.DATA_CFG+'::LABEL_SETS')
 
     spark.sparkContext.addPyFile("./data_processing/pathology/common/build_geojson.py")
-    from build_geojson import build_geojson_from_pointclick_json
-    build_geojson_from_pointclick_json_udf = udf(build_geojson_from_pointclick_json,  geojson_struct)
-    df = df.withColumn("geojson", build_geojson_from_pointclick_json_udf(lit(str(label_config)), "labelset", "sv_json")).cache()
+    from build_geojson import build_geojsons_from_pointclick_jsons
+    # batched over the (slide, labelset) rows of each arrow batch, the label config is parsed once per batch
+    build_geojsons_from_pointclick_jsons_udf = pandas_udf(build_geojsons_from_pointclick_jsons, geojson_struct)
+    df = df.withColumn("geojson", build_geojsons_from_pointclick_jsons_udf(lit(str(label_config)), "labelset", "sv_json")).cache()
 
     # populate "date_added", "date_updated","latest", "sv_json_record_uuid"
     spark.sparkContext.addPyFile("./data_processing/common/EnsureByteContext.py")
@@ -103,27 +112,8 @@ def create_refined_table():
         .withColumn("date_added", current_timestamp()) \
         .withColumn("date_updated", current_timestamp())
 
-    # create geojson delta table
-    # update main table if exists, otherwise create main table
-    if not os.path.exists(geojson_table_path):
-        df.write.format("delta").save(geojson_table_path)
-    else:
-        from delta.tables import DeltaTable
-        geojson_table = DeltaTable.forPath(spark, geojson_table_path)
-        geojson_table.alias("main_pt_geojson_table") \
-            .merge(df.alias("pt_geojson_annotation_updates"), "main_pt_geojson_table.geojson_record_uuid = pt_geojson_annotation_updates.geojson_record_uuid") \
-            .whenMatchedUpdate(set = { "main_pt_geojson_table.date_updated" : "pt_geojson_annotation_updates.date_updated" } ) \
-            .whenNotMatchedInsertAll() \
-            .execute()
-
-    # add latest flag
-    windowSpec = Window.partitionBy("user", "slide_id", "labelset").orderBy(desc("date_updated"))
-    # Note that last != opposite of first! Have to use desc ordering with first...
-    spark.read.format("delta").load(geojson_table_path) \
-        .withColumn("date_latest", first("date_updated").over(windowSpec)) \
-        .withColumn("latest", col("date_latest")==col("date_updated")) \
-        .drop("date_latest") \
-        .write.format("delta").mode("overwrite").option("overwriteSchema", "true").save(geojson_table_path)
+    # create geojson delta table, or merge into the main table and flag the latest geojsons
+    merge_latest(spark, df, geojson_table_path, "geojson_record_uuid", ["user", "slide_id", "labelset"])
 
 if __name__ == "__main__":
     cli()
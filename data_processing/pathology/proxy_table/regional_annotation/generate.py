@@ -18,11 +18,12 @@ from data_processing.common.sparksession import SparkConfig
 import data_processing.common.constants as const
 
 import pandas as pd
-import numpy as np
 
 import os
 
 from data_processing.pathology.common.slideviewer_client import fetch_slide_ids
+from data_processing.pathology.common.bmp_converter import convert_bmp_to_npy
+from data_processing.pathology.common.pull_state import add_pull_state, update_pull_state, get_pull_summary, PULL_CHANGED
 
 logger = init_logger()
 
@@ -30,45 +31,46 @@ DATA_SCHEMA_FILE = os.path.join(
                       pathlib.Path(__file__).resolve().parent,
                       'data_config_schema.yml')
 
-from PIL import Image
-Image.MAX_IMAGE_PIXELS = 5000000000
+# (slide, user) rows per arrow batch, whose bitmaps are downloaded concurrently before being converted
+REGIONAL_BATCH_ROWS = 32
 
 
-def convert_bmp_to_npy(bmp_file, output_folder):
-    """
-    Reads a bmp file and creates friendly numpy ndarray file in the uint8 format in the output
-    directory specified, with extention .annot.npy
-
-    Troubleshooting:
-        Make sure Pillow is upgraded to version 8.0.0 if getting an Unsupported BMP Size OS Error
-
-    :param bmp_file - /path/to/image.bmp
-    :param output_folder - /path/to/output/folder
-    :return filepath to file containing numpy array
-    """
-    if not '.bmp' in bmp_file:
-        return ''
-
-    new_image_name = os.path.basename(bmp_file).replace(".bmp", ".npy")
-    bmp_caseid_folder = os.path.basename(os.path.dirname(bmp_file))
-    output_caseid_folder = os.path.join(output_folder, bmp_caseid_folder)
+def get_regional_annotation_download(row: pd.DataFrame):
+    '''
+    :param row: (slide, user) row with pull state, see pull_state.py
+    :return: (url, zipfile_path, etag, last_modified) of the regional annotation zip of the row
+    '''
+    full_filename = row.slideviewer_path.item()
+    user = row.user.item()
+    full_filename_without_ext = full_filename.replace(".svs", "")
 
-    if not os.path.exists(output_caseid_folder):
-        os.makedirs(output_caseid_folder)
+    # download zips into TMP_ZIP_DIR
+    TMP_ZIP_DIR = row.TMP_ZIP_DIR.item()
+    os.makedirs(TMP_ZIP_DIR, exist_ok=True)
+    zipfile_path = os.path.join(TMP_ZIP_DIR, full_filename_without_ext + "_" + user + ".zip")
 
-    output_filepath = os.path.join(output_caseid_folder, new_image_name)
+    url = row.SLIDEVIEWER_API_URL.item() +'slides/'+ str(user) + '@mskcc.org/projects;' + str(row.sv_project_id.item()) + ';' + full_filename + '/getLabelFileBMP'
 
-    np.save(output_filepath, np.array(Image.open(bmp_file)))
-    return output_filepath
+    return url, zipfile_path, row.etag.item(), row.last_modified.item()
 
 
-def process_regional_annotation_slide_row_pandas(row: pd.DataFrame) -> pd.DataFrame:
+def process_regional_annotation_slide_row_pandas(row: pd.DataFrame, download_result=None) -> pd.DataFrame:
     '''
-    Downloads regional annotation bmps for each row in dataframe and saves the bmp to disc.
+    Downloads the regional annotation bmp of a (slide, user) row, saves the bmp to disc and converts it to a
+    numpy array (see bmp_converter.py), all on the executor.
+
+    Bitmaps unchanged since the last pull, by their http validators or by their hash, are not converted,
+    see pull_state.py
 
-    :return updated dataframe with bmp metadata
+    :param row: (slide, user) row
+    :param download_result: (status, etag, last_modified) of the zip already downloaded by download_zips(), or None
+    to download it here
+    :return updated dataframe with bmp metadata, npy_filepath, pull state and pull_status
     '''
-    from slideviewer_client import download_zip, unzip
+    import requests
+    from slideviewer_client import download_zip_if_changed, unzip
+    from bmp_converter import convert_bmp_to_npy, convert_bmp_to_rle
+    from pull_state import PULL_CHANGED, PULL_UNCHANGED, PULL_NOT_FOUND, PULL_FAILED
 
     full_filename = row.slideviewer_path.item()
     user = row.user.item()
@@ -86,26 +88,40 @@ def process_regional_annotation_slide_row_pandas(row: pd.DataFrame) -> pd.DataFr
         print("Removing temporary file "+bmp_dest_path)
         os.remove(bmp_dest_path)
 
-    # download bitmap file using api (from brush and fill tool), download zips into TMP_ZIP_DIR
-    TMP_ZIP_DIR = row.TMP_ZIP_DIR.item()
-    os.makedirs(TMP_ZIP_DIR, exist_ok=True)
-    zipfile_path = os.path.join(TMP_ZIP_DIR, full_filename_without_ext + "_" + user + ".zip")
-
-    url = row.SLIDEVIEWER_API_URL.item() +'slides/'+ str(user) + '@mskcc.org/projects;' + str(row.sv_project_id.item()) + ';' + full_filename + '/getLabelFileBMP'
+    # download bitmap file using api (from brush and fill tool)
+    url, zipfile_path, etag, last_modified = get_regional_annotation_download(row)
 
     print("Pulling   ", url)
     print(" +- TO    ", bmp_dest_path)
 
-    success = download_zip(url, zipfile_path)
-
     row["bmp_record_uuid"] = 'n/a'
     row["bmp_filepath"] = 'n/a'
+    row["npy_filepath"] = 'n/a'
+    row["pull_status"] = PULL_FAILED
+
+    if download_result is None:
+        try:
+            download_result = download_zip_if_changed(url, zipfile_path, etag, last_modified)
+        except requests.RequestException as err:
+            print(" +- ERROR downloading label annotation file: " + str(err))
+            return row
 
-    if not success:
+    status, etag, last_modified = download_result
+
+    if status == 'not_modified':
+        row["pull_status"] = PULL_UNCHANGED
+        print(" +- Label annotation file not modified since last pull.")
+        return row
+
+    if status == 'not_found':
         os.remove(zipfile_path)
+        row["pull_status"] = PULL_NOT_FOUND
         print(" +- Label annotation file does not exist for slide and user.")
         return row
 
+    row["etag"] = etag
+    row["last_modified"] = last_modified
+
     unzipped_file_descriptor = unzip(zipfile_path)
 
     if unzipped_file_descriptor is None:
@@ -121,16 +137,58 @@ def process_regional_annotation_slide_row_pandas(row: pd.DataFrame) -> pd.DataFr
 
     bmp_hash = FileHash('sha256').hash_file(bmp_dest_path)
     row["bmp_record_uuid"] = f'SVBMP-{bmp_hash}'
+    row["content_length"] = os.path.getsize(bmp_dest_path)
+
+    # same bitmap as the last pull, e.g. when slideviewer sends no validators, already converted
+    if row["bmp_record_uuid"].item() == row.content_hash.item():
+        os.remove(bmp_dest_path)
+        os.remove(zipfile_path)
+        row["pull_status"] = PULL_UNCHANGED
+        print(" +- Label annotation file unchanged since last pull " + row["bmp_record_uuid"].item())
+        return row
+
+    row["content_hash"] = row["bmp_record_uuid"].item()
     row["bmp_filepath"] = bmp_dirname + '/' + slide_id + '_' + user + '_' + row["bmp_record_uuid"].item() + '_annot.bmp'
     os.rename(bmp_dest_path, row["bmp_filepath"].item())
     print(" +- Generated record " + row["bmp_record_uuid"].item())
 
+    # convert to numpy, optionally run-length encoded instead of dense
+    convert_bmp = convert_bmp_to_rle if row.ANNOTATION_FORMAT.item() == 'rle' else convert_bmp_to_npy
+    row["npy_filepath"] = convert_bmp(row["bmp_filepath"].item(), row.SLIDE_NPY_DIR.item())
+    print(" +- Converted to " + row["npy_filepath"].item())
+    row["pull_status"] = PULL_CHANGED
+
     # cleanup
     if os.path.exists(zipfile_path):
         os.remove(zipfile_path)
 
     return row
 
+
+def process_regional_annotation_slide_rows(batches):
+    '''
+    Downloads the regional annotation bmps of each REGIONAL_BATCH_ROWS (slide, user) rows concurrently, see
+    slideviewer_client.download_zips(), then converts them one row at a time, for mapInPandas
+
+    :param batches: iterator of dataframes of (slide, user) rows
+    :return: iterator of dataframes updated by process_regional_annotation_slide_row_pandas()
+    '''
+    from slideviewer_client import download_zips
+    from pull_state import PULL_FAILED
+
+    for arrow_batch in batches:
+        for start in range(0, len(arrow_batch), REGIONAL_BATCH_ROWS):
+            batch = arrow_batch.iloc[start:start + REGIONAL_BATCH_ROWS]
+            rows = [batch.iloc[[i]].copy() for i in range(len(batch))]
+            download_results = download_zips([get_regional_annotation_download(row) for row in rows])
+
+            # failed downloads are processed as such, without downloading again
+            yield pd.concat([batch.iloc[:0]] +
+                            [process_regional_annotation_slide_row_pandas(row, download_result) if download_result else
+                             row.assign(bmp_record_uuid='n/a', bmp_filepath='n/a', npy_filepath='n/a', pull_status=PULL_FAILED)
+                             for row, download_result in zip(rows, download_results)])
+
+
 def create_proxy_table():
     '''
     Creates the pathology annotations proxy table with information contained in the specified data_config_file
@@ -164,15 +222,26 @@ def create_proxy_table():
 
     # populate columns
     TMP_ZIP_DIR = cfg.get_value(const.DATA_CFG + '::REQUESTOR_DEPARTMENT') + '_tmp_zips'
+    SLIDE_NPY_DIR = os.path.join(LANDING_PATH, 'regional_npys')
+    os.makedirs(SLIDE_NPY_DIR, exist_ok=True)
+    # optional, store annotations run-length encoded instead of as dense npy arrays
+    annotation_format = cfg.get_value(path=const.DATA_CFG + '::ANNOTATION_FORMAT') if cfg.has_value(path=const.DATA_CFG + '::ANNOTATION_FORMAT') else 'npy'
+    # optional, only convert and add annotations that changed since the last pull
+    incremental = cfg.get_value(path=const.DATA_CFG + '::INCREMENTAL') if cfg.has_value(path=const.DATA_CFG + '::INCREMENTAL') else False
+    PULL_STATE_PATH = const.PULL_STATE_LOCATION(cfg)
+
     df = df.withColumn('bmp_filepath', lit('')) \
         .withColumn('users', array([lit(user) for user in cfg.get_value(const.DATA_CFG + '::USERS')])) \
         .withColumn('date_added', current_timestamp()) \
         .withColumn('date_updated', current_timestamp()) \
         .withColumn('bmp_record_uuid', lit('')) \
         .withColumn('latest', lit(True)) \
+        .withColumn('npy_filepath', lit('')) \
         .withColumn('SLIDE_BMP_DIR', lit(os.path.join(LANDING_PATH, 'regional_bmps'))) \
         .withColumn('TMP_ZIP_DIR', lit(os.path.join(LANDING_PATH, TMP_ZIP_DIR))) \
         .withColumn('SLIDEVIEWER_API_URL', lit(cfg.get_value(const.DATA_CFG + '::SLIDEVIEWER_API_URL'))) \
+        .withColumn('SLIDE_NPY_DIR', lit(SLIDE_NPY_DIR)) \
+        .withColumn('ANNOTATION_FORMAT', lit(annotation_format))
 
     # explore by user list
     df = df.select('slideviewer_path',
@@ -184,32 +253,36 @@ def create_proxy_table():
                    'date_updated',
                    'bmp_record_uuid',
                    'latest',
+                   'npy_filepath',
                    'SLIDE_BMP_DIR',
                    'TMP_ZIP_DIR',
-                   'SLIDEVIEWER_API_URL'
+                   'SLIDEVIEWER_API_URL',
+                   'SLIDE_NPY_DIR',
+                   'ANNOTATION_FORMAT'
                    )
 
-    spark.sparkContext.addPyFile("./data_processing/pathology/common/slideviewer_client.py")
-    df = df.groupby(['slideviewer_path', 'user']) \
-        .applyInPandas(process_regional_annotation_slide_row_pandas, schema=df.schema)
-    df.show()
-
-    df = df.toPandas()
-    df = df.drop(columns=['SLIDE_BMP_DIR', 'TMP_ZIP_DIR', 'SLIDEVIEWER_API_URL'])
-
-    # get slides with non-empty annotations
-    df = df.replace("n/a", np.nan)
-    df = df.dropna()
-
-    # convert annotation bitmaps to numpy arrays
-    SLIDE_NPY_DIR = os.path.join(LANDING_PATH, 'regional_npys')
-    os.makedirs(SLIDE_NPY_DIR, exist_ok=True)
-
-    # convert to numpy
-    df["npy_filepath"] = df.apply(lambda x: convert_bmp_to_npy(x.bmp_filepath, SLIDE_NPY_DIR), axis=1)
+    # state of the last pull of each (slide, user), empty unless incremental
+    df = add_pull_state(spark, df, PULL_STATE_PATH if incremental else None)
 
-    spark_bitmask_df = spark.createDataFrame(df)
-    spark_bitmask_df.show()
+    # download the (slide, user) bitmaps of each batch of rows concurrently, then hash and convert them, on the executors.
+    # only the metadata rows come back. one partition per core, batches bound the zips downloaded ahead of conversion
+    spark.sparkContext.addPyFile("./data_processing/pathology/common/slideviewer_client.py")
+    spark.sparkContext.addPyFile("./data_processing/pathology/common/annotation_rle.py")
+    spark.sparkContext.addPyFile("./data_processing/pathology/common/bmp_converter.py")
+    spark.sparkContext.addPyFile("./data_processing/pathology/common/pull_state.py")
+    # checkpointed eagerly, as the results are read by the summary, the pull state and the delta merge, which reads its
+    # source twice, and the bitmaps should only be downloaded once. unlike cache(), evicted blocks aren't recomputed
+    df = df.repartition(spark.sparkContext.defaultParallelism) \
+        .mapInPandas(process_regional_annotation_slide_rows, schema=df.schema) \
+        .localCheckpoint(eager=True)
+
+    pull_summary = get_pull_summary(df)
+    logger.info("Pulled regional annotations: " + ", ".join(f"{count} {status}" for status, count in pull_summary.items()))
+
+    # get slides with new or changed annotations
+    spark_bitmask_df = df.filter(df.pull_status == PULL_CHANGED) \
+        .drop('SLIDE_BMP_DIR', 'TMP_ZIP_DIR', 'SLIDEVIEWER_API_URL', 'SLIDE_NPY_DIR', 'ANNOTATION_FORMAT',
+              'content_hash', 'content_length', 'etag', 'last_modified', 'pull_status')
 
     # create proxy bitmask table
     # update main table if exists, otherwise create main table
@@ -230,6 +303,9 @@ def create_proxy_table():
             .whenNotMatchedInsertAll() \
             .execute()
 
+    if incremental:
+        update_pull_state(spark, df, PULL_STATE_PATH)
+
     # clean up TMP_ZIP_DIR
     tmp_zip_dir = os.path.join(LANDING_PATH, TMP_ZIP_DIR)
     if os.path.exists(tmp_zip_dir):
@@ -254,7 +330,8 @@ def cli(data_config_file, app_config_file):
     '''
     This module performs the following sequence of operations -
     1) Bitmap regional pathology tissue annotations are downloaded from SlideViewer
-    2) The downloaded bitmap annotations are then converted into npy arrays
+    2) The downloaded bitmap annotations are then converted into npy arrays, in the same spark task as the download.
+       Bitmaps of a batch of (slide, user) rows are downloaded concurrently
     3) A proxy table is built with the following fields.
 
     slideviewer_path - path to original slide image in slideviewer platform
@@ -265,7 +342,10 @@ def cli(data_config_file, app_config_file):
     date_added - date annotation first added
     date_updated - date annotation most recently updated
     bmp_record_uuid - hash of bmp annotation file, format: SVBMP-{bmp_hash}
-    npy_filepath - file path to generated npy annotation file
+    npy_filepath - file path to generated npy annotation file, or .rle.npz file with ANNOTATION_FORMAT: rle
+
+    With INCREMENTAL: true, annotations unchanged since the last pull are neither converted nor updated, see
+    data_processing/pathology/common/pull_state.py
 
     Usage:
     python3 -m data_processing.pathology.proxy_table.regional_annotation.generate \
@@ -6,9 +6,10 @@ from data_processing.common.config import ConfigSet
 from data_processing.common.custom_logger import init_logger
 from data_processing.common.sparksession import SparkConfig
 import data_processing.common.constants as const
+from data_processing.common.delta_merge import merge_latest
 from data_processing.pathology.common.utils import get_labelset_keys
 
-from pyspark.sql.functions import udf, lit, col, first, last, desc, array, to_json, collect_list, current_timestamp, explode
+from pyspark.sql.functions import udf, pandas_udf, lit, col, first, last, desc, array, to_json, collect_list, current_timestamp, explode
 from pyspark.sql.window import Window
 from pyspark.sql.types import StringType, IntegerType, ArrayType, MapType, StructType, StructField
 
@@ -109,31 +110,57 @@ def create_geojson_table():
 
     df = spark.read.format("delta").load(bitmask_table_path)
 
+    # optional, only build geojsons of bitmaps that have none yet, e.g. new or changed since the last pull.
+    # geojsons of LABEL_SETS changed since they were built need a full run
+    incremental = cfg.has_value(path=const.DATA_CFG+'::INCREMENTAL') and cfg.get_value(path=const.DATA_CFG+'::INCREMENTAL')
+    if incremental and os.path.exists(geojson_table_path):
+        built_df = spark.read.format("delta").load(geojson_table_path).select("bmp_record_uuid").distinct()
+        df = df.join(built_df, on="bmp_record_uuid", how="left_anti")
+
     # explode table by labelsets
     labelsets = get_labelset_keys()
     labelset_column = array([lit(key) for key in labelsets])
 
     df = df.withColumn("labelset_list", labelset_column)
-    # explode labelsets
-    df = df.select("slideviewer_path", "slide_id", "sv_project_id", "bmp_record_uuid", "user", "npy_filepath", explode("labelset_list").alias("labelset"))
+
+    # optional, build all labelsets of a bitmap in one group instead of one group per (bitmap, labelset)
+    per_bitmap = cfg.has_value(path=const.DATA_CFG+'::BUILD_PER_BITMAP') and cfg.get_value(path=const.DATA_CFG+'::BUILD_PER_BITMAP')
+
+    if per_bitmap:
+        df = df.select("slideviewer_path", "slide_id", "sv_project_id", "bmp_record_uuid", "user", "npy_filepath", "labelset_list")
+    else:
+        # explode labelsets
+        df = df.select("slideviewer_path", "slide_id", "sv_project_id", "bmp_record_uuid", "user", "npy_filepath", explode("labelset_list").alias("labelset"))
 
     # setup variables needed for build geojson UDF
     contour_level = cfg.get_value(path=const.DATA_CFG+'::CONTOUR_LEVEL')
     polygon_tolerance = cfg.get_value(path=const.DATA_CFG+'::POLYGON_TOLERANCE')
+    # optional, trace contours of large annotations in memory mapped blocks instead of under a timeout
+    contour_block_size = cfg.get_value(path=const.DATA_CFG+'::CONTOUR_BLOCK_SIZE') if cfg.has_value(path=const.DATA_CFG+'::CONTOUR_BLOCK_SIZE') else 0
 
     # populate geojson and geojson_record_uuid
     spark.sparkContext.addPyFile("./data_processing/common/EnsureByteContext.py")
     spark.sparkContext.addPyFile("./data_processing/common/utils.py")
+    spark.sparkContext.addPyFile("./data_processing/pathology/common/annotation_rle.py")
     spark.sparkContext.addPyFile("./data_processing/pathology/common/build_geojson.py")
-    from build_geojson import build_geojson_from_annotation
+    from build_geojson import build_geojson_from_annotation, build_geojsons_from_annotation, BUILD_THREADS
     label_config = cfg.get_value(path=const.DATA_CFG+'::LABEL_SETS')
 
     df = df.withColumn("label_config", lit(str(label_config))) \
             .withColumn("contour_level", lit(contour_level)) \
             .withColumn("polygon_tolerance", lit(polygon_tolerance)) \
+            .withColumn("contour_block_size", lit(contour_block_size)) \
             .withColumn("geojson", lit(""))
 
-    df = df.groupby(["bmp_record_uuid", "labelset"]).applyInPandas(build_geojson_from_annotation, schema = df.schema)
+    if per_bitmap:
+        # optional, threads tracing the labels of a bitmap, per python worker
+        build_threads = cfg.get_value(path=const.DATA_CFG+'::BUILD_THREADS') if cfg.has_value(path=const.DATA_CFG+'::BUILD_THREADS') else BUILD_THREADS
+        df = df.withColumn("build_threads", lit(build_threads))
+
+        geojson_schema = df.drop("labelset_list").withColumn("labelset", lit("")).schema
+        df = df.groupby("bmp_record_uuid").applyInPandas(build_geojsons_from_annotation, schema = geojson_schema)
+    else:
+        df = df.groupby(["bmp_record_uuid", "labelset"]).applyInPandas(build_geojson_from_annotation, schema = df.schema)
 
     # drop empty geojsons that may have been created
     df = df.filter("geojson != ''")
@@ -149,28 +176,8 @@ def create_geojson_table():
     geojson_df = geojson_df.withColumn("latest", lit(True))        \
                          .withColumn("date_added", current_timestamp())    \
                          .withColumn("date_updated", current_timestamp())
-    # create geojson delta table
-    # update main table if exists, otherwise create new table
-    if not os.path.exists(geojson_table_path):
-        geojson_df.write.format("delta").save(geojson_table_path)
-    else:
-        from delta.tables import DeltaTable
-        existing_geojson_table = DeltaTable.forPath(spark, geojson_table_path)
-        existing_geojson_table.alias("main_geojson_table") \
-            .merge(geojson_df.alias("geojson_annotation_updates"), "main_geojson_table.geojson_record_uuid = geojson_annotation_updates.geojson_record_uuid") \
-            .whenMatchedUpdate(set = { "date_updated" : "geojson_annotation_updates.date_updated" } ) \
-            .whenNotMatchedInsertAll() \
-            .execute()
-
-        # Removed synclatest flag - always update when merging with existing table.
-        # add latest flag
-        windowSpec = Window.partitionBy("user", "slide_id", "labelset").orderBy(desc("date_updated"))
-        # Note that last != opposite of first! Have to use desc ordering with first...
-        spark.read.format("delta").load(geojson_table_path) \
-            .withColumn("date_latest", first("date_updated").over(windowSpec)) \
-            .withColumn("latest", col("date_latest")==col("date_updated")) \
-            .drop("date_latest") \
-            .write.format("delta").mode("overwrite").option("overwriteSchema", "true").save(geojson_table_path)
+    # create geojson delta table, or merge into the main table and flag the latest geojsons
+    merge_latest(spark, geojson_df, geojson_table_path, "geojson_record_uuid", ["user", "slide_id", "labelset"])
 
     logger.info("Finished building Geojson table.")
 
@@ -206,42 +213,39 @@ def create_concat_geojson_table():
     spark.sparkContext.addPyFile("./data_processing/common/utils.py")
     spark.sparkContext.addPyFile("./data_processing/pathology/common/build_geojson.py")
     from utils import generate_uuid_dict
-    from build_geojson import concatenate_regional_geojsons
-    concatenate_regional_geojsons_udf = udf(concatenate_regional_geojsons, geojson_struct)
-    concat_geojson_record_uuid_udf = udf(generate_uuid_dict, StringType())
+    from build_geojson import concatenate_regional_geojsons, concatenate_serialized_geojsons_batch
+
+    # optional, splice the geojson strings and save the concatenated geojson as a string, instead of parsing them
+    # into a geojson_struct and serializing it again to hash it
+    serialized_concat = cfg.has_value(path=const.DATA_CFG+'::SERIALIZED_CONCAT') and cfg.get_value(path=const.DATA_CFG+'::SERIALIZED_CONCAT')
+
+    if serialized_concat:
+        concat_schema = StructType([StructField("concat_geojson", StringType()),
+                                    StructField("concat_geojson_record_uuid", StringType())])
+        concatenate_serialized_geojsons_udf = pandas_udf(concatenate_serialized_geojsons_batch, concat_schema)
+
+        # cache to not have udf called multiple times
+        concatgeojson_df = concatgeojson_df \
+            .withColumn("concat", concatenate_serialized_geojsons_udf("geojson_list", "labelset")) \
+            .select("sv_project_id", "slideviewer_path", "slide_id", "labelset", "concat.*") \
+            .cache()
+    else:
+        concatenate_regional_geojsons_udf = udf(concatenate_regional_geojsons, geojson_struct)
+        concat_geojson_record_uuid_udf = udf(generate_uuid_dict, StringType())
 
-    # cache to not have udf called multiple times
-    concatgeojson_df = concatgeojson_df.withColumn("concat_geojson", concatenate_regional_geojsons_udf("geojson_list")).cache()
+        # cache to not have udf called multiple times
+        concatgeojson_df = concatgeojson_df.withColumn("concat_geojson", concatenate_regional_geojsons_udf("geojson_list")).cache()
+
+        concatgeojson_df = concatgeojson_df \
+            .drop("geojson_list") \
+            .withColumn("concat_geojson_record_uuid", concat_geojson_record_uuid_udf(to_json("concat_geojson"), array(lit("SVCONCATGEOJSON"), "labelset")))
 
-    concatgeojson_df = concatgeojson_df \
-        .drop("geojson_list") \
-        .withColumn("concat_geojson_record_uuid", concat_geojson_record_uuid_udf(to_json("concat_geojson"), array(lit("SVCONCATGEOJSON"), "labelset")))
-    
     concatgeojson_df = concatgeojson_df.withColumn("latest", lit(True))   \
                             .withColumn("date_added", current_timestamp())    \
                             .withColumn("date_updated", current_timestamp())
 
-    # create concatenation geojson delta table
-    # update main table if exists, otherwise create main table
-    if not os.path.exists(concat_geojson_table_path):
-        concatgeojson_df.write.format("delta").save(concat_geojson_table_path)
-    else:
-        from delta.tables import DeltaTable
-        concat_geojson_table = DeltaTable.forPath(spark, concat_geojson_table_path)
-        concat_geojson_table.alias("main_geojson_table") \
-            .merge(concatgeojson_df.alias("geojson_annotation_updates"), "main_geojson_table.concat_geojson_record_uuid = geojson_annotation_updates.concat_geojson_record_uuid") \
-            .whenMatchedUpdate(set = { "date_updated" : "geojson_annotation_updates.date_updated" } ) \
-            .whenNotMatchedInsertAll() \
-            .execute()
-
-        # add latest flag
-        windowSpec = Window.partitionBy("slide_id", "labelset").orderBy(desc("date_updated"))
-        # Note that last != opposite of first! Have to use desc ordering with first...
-        spark.read.format("delta").load(concat_geojson_table_path) \
-            .withColumn("date_latest", first("date_updated").over(windowSpec)) \
-            .withColumn("latest", col("date_latest")==col("date_updated")) \
-            .drop("date_latest") \
-            .write.format("delta").mode("overwrite").option("overwriteSchema", "true").save(concat_geojson_table_path)
+    # create concatenation geojson delta table, or merge into the main table and flag the latest geojsons
+    merge_latest(spark, concatgeojson_df, concat_geojson_table_path, "concat_geojson_record_uuid", ["slide_id", "labelset"])
 
     logger.info("Finished building Concatenation table.")
 
@@ -0,0 +1,73 @@
+'''
+Promoted dicom tags, stored as typed top-level columns of the dicom proxy table next to the metadata map
+
+Filters and joins on the metadata map deserialize the whole map of every row. Promoted tags are plain parquet columns,
+so they get column pruning and predicate pushdown. Their type follows the VR of the tag in the dicom dictionary,
+values that don't parse, e.g. multi-valued, are null. All tags are kept in the metadata map.
+'''
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+from pyspark.sql.types import StructType, StructField, StringType, IntegerType, LongType, DoubleType
+
+# tags promoted by default, see PROMOTED_TAGS in data_ingestion_template.yaml.template
+PROMOTED_TAGS = ["PatientID", "AccessionNumber", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID",
+                 "SeriesNumber", "InstanceNumber", "Modality", "SeriesDescription"]
+
+# dicom value representation -> (spark type, python parser)
+PROMOTED_VR_TYPES = {"IS": (IntegerType(), int),
+                     "SS": (IntegerType(), int),
+                     "US": (IntegerType(), int),
+                     "SL": (IntegerType(), int),
+                     "UL": (LongType(), int),
+                     "DS": (DoubleType(), float),
+                     "FL": (DoubleType(), float),
+                     "FD": (DoubleType(), float)}
+
+
+def get_promoted_type(tag):
+    """
+    :param tag: dicom keyword e.g. SeriesNumber
+    :return: (spark type, python parser) of the promoted column, string for tags that aren't numbers
+    """
+    tag_number = tag_for_keyword(tag)
+    if tag_number is None:
+        return StringType(), str
+
+    return PROMOTED_VR_TYPES.get(dictionary_VR(tag_number), (StringType(), str))
+
+
+def get_promoted_schema(tags=PROMOTED_TAGS):
+    """
+    :param tags: list of dicom keywords
+    :return: StructType of the promoted columns
+    """
+    return StructType([StructField(tag, get_promoted_type(tag)[0]) for tag in tags])
+
+
+def get_promoted_values(metadatas, tag):
+    """
+    :param metadatas: list of dicom metadata dicts, see get_dicom_metadata()
+    :param tag: dicom keyword
+    :return: list of typed values of the tag, None if missing or not parsed
+    """
+    parser = get_promoted_type(tag)[1]
+
+    values = []
+    for metadata in metadatas:
+        try:
+            values.append(parser(metadata[tag]))
+        except (KeyError, ValueError):
+            values.append(None)
+    return values
+
+
+def get_dicom_column(df, tag):
+    """
+    Column of a dicom tag, promoted or from the metadata map of tables without it
+
+    :param df: dataframe of a dicom table, or derived from it
+    :param tag: dicom keyword e.g. SeriesInstanceUID
+    :return: spark column
+    """
+    if tag in df.columns:
+        return df[tag]
+    return df["metadata"][tag]
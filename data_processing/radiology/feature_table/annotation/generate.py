@@ -16,6 +16,7 @@ from data_processing.common.custom_logger import init_logger
 from data_processing.common.utils import generate_uuid_binary
 import data_processing.common.constants as const
 from data_processing.radiology.common.preprocess import find_centroid, crop_images
+from data_processing.radiology.common.dicom_schema import PROMOTED_TAGS, get_dicom_column
 
 from pyspark.sql import functions as F
 from pyspark.sql.types import StringType, IntegerType, StructType, StructField, BinaryType
@@ -85,10 +86,11 @@ def generate_feature_table(cfg):
     logger.info("Loaded mha and png tables")
 
     # Join PNG and MHA tables
-    columns = ["metadata", "dicom", "overlay", "png_record_uuid", "scan_annotation_record_uuid", "x","y", "label"]
+    promoted_tags = [tag for tag in PROMOTED_TAGS if tag in png_df.columns]
+    columns = promoted_tags + ["metadata", "dicom", "overlay", "png_record_uuid", "scan_annotation_record_uuid", "x","y", "label"]
     
-    cond = [png_df.metadata.AccessionNumber == mha_df.accession_number,
-            png_df.metadata.SeriesNumber == mha_df.series_number,
+    cond = [get_dicom_column(png_df, "AccessionNumber") == mha_df.accession_number,
+            get_dicom_column(png_df, "SeriesNumber") == mha_df.series_number,
             png_df.label.eqNullSafe(mha_df.mha_label)]
 
     df = png_df.join(mha_df, cond) \
@@ -104,7 +106,7 @@ def generate_feature_table(cfg):
         crop_images_udf = F.udf(crop_images, StructType([StructField("dicom", BinaryType()), StructField("overlay", BinaryType())]))   
         df = df.withColumn("dicom_overlay", crop_images_udf("x","y","dicom","overlay", F.lit(CROP_WIDTH), F.lit(CROP_HEIGHT), F.lit(IMAGE_WIDTH), F.lit(IMAGE_HEIGHT))) \
                .drop("dicom", "overlay") \
-               .select("metadata", "png_record_uuid", "scan_annotation_record_uuid", "label",
+               .select(*promoted_tags, "metadata", "png_record_uuid", "scan_annotation_record_uuid", "label",
                        F.col("dicom_overlay.dicom").alias("dicom"), F.col("dicom_overlay.overlay").alias("overlay"))
        
         logger.info("Cropped pngs")
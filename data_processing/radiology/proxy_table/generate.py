@@ -12,11 +12,14 @@ from data_processing.common.custom_logger import init_logger
 from data_processing.common.sparksession import SparkConfig
 from data_processing.common.Neo4jConnection import Neo4jConnection
 import data_processing.common.constants as const
+from data_processing.radiology.common.dicom_schema import PROMOTED_TAGS, get_promoted_schema, get_promoted_values, \
+    get_dicom_column
 
-from pyspark.sql.functions import udf, lit, array
-from pyspark.sql.types import StringType, MapType
+from pyspark.sql.types import StringType, MapType, StructType, StructField
 
 import pydicom
+import hashlib
+from functools import partial
 from io import BytesIO
 import shutil, sys, importlib
 import yaml, os
@@ -28,6 +31,18 @@ SCHEMA_FILE='data_ingestion_template_schema.yml'
 DATA_CFG = 'DATA_CFG'
 APP_CFG = 'APP_CFG'
 
+# leading bytes of a dicom read at once in HEADER_ONLY mode, enough for the header of most files
+HEADER_READ_BYTES = 64 * 1024
+
+# bytes read at once to hash the rest of a dicom
+HASH_CHUNK_BYTES = 1024 * 1024
+
+# dicoms per arrow batch, bounds the content of dicoms held in memory at once
+DICOM_BATCH_ROWS = 256
+
+# binaryFile columns identifying a version of a dicom file, for incremental ingestion
+DICOM_FILE_KEYS = ["path", "length", "modificationTime"]
+
 
 def parse_dicom_from_delta_record(path, content):
 
@@ -35,6 +50,148 @@ def parse_dicom_from_delta_record(path, content):
 
     dataset = pydicom.dcmread(BytesIO(content))
 
+    return get_dicom_metadata(dataset)
+
+
+def read_dicom_header(path, read_bytes=HEADER_READ_BYTES):
+    """
+    Read the header of a dicom file, without reading its pixel data
+
+    The leading bytes of the file are read at once and parsed up to the pixel data. A parse that reached the end of
+    the bytes may have been cut short by a longer header, so the header is then read from the file itself.
+
+    :param path: file path e.g. file:/path/to/file.dcm
+    :param read_bytes: number of leading bytes to read at once
+    :return: pydicom dataset, without pixel data
+    """
+    posix_file_path = path.split(':')[-1]
+
+    with open(posix_file_path, 'rb') as fp:
+        buffer = fp.read(read_bytes)
+        is_whole_file = len(buffer) < read_bytes or not fp.read(1)
+
+    return parse_dicom_header(buffer, is_whole_file, posix_file_path)
+
+
+def parse_dicom_header(buffer, is_whole_file, posix_file_path):
+    """
+    Parse the header of a dicom file from its leading bytes, see read_dicom_header()
+
+    :param buffer: leading bytes of the dicom file
+    :param is_whole_file: True if the buffer holds the whole file
+    :param posix_file_path: path to the dicom file, to read long headers from
+    :return: pydicom dataset, without pixel data
+    """
+    leading_bytes = BytesIO(buffer)
+    try:
+        dataset = pydicom.dcmread(leading_bytes, stop_before_pixels=True)
+        if is_whole_file or leading_bytes.tell() < len(buffer):
+            return dataset
+    except Exception:
+        # a header cut short can fail to parse in many ways, e.g. struct.error or BytesLengthException
+        if is_whole_file:
+            raise
+
+    # long header
+    return pydicom.dcmread(posix_file_path, stop_before_pixels=True)
+
+
+def hash_and_parse_dicom_header(path, read_bytes=HEADER_READ_BYTES):
+    """
+    Hash a dicom file and parse its header in a single read of the file
+
+    :param path: file path e.g. file:/path/to/file.dcm
+    :param read_bytes: number of leading bytes parsed for the header
+    :return: (dicom_record_uuid, metadata)
+    """
+    posix_file_path = path.split(':')[-1]
+    sha256 = hashlib.sha256()
+
+    with open(posix_file_path, 'rb') as fp:
+        buffer = fp.read(read_bytes)
+        sha256.update(buffer)
+        is_whole_file = True
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_BYTES), b''):
+            sha256.update(chunk)
+            is_whole_file = False
+
+    dataset = parse_dicom_header(buffer, is_whole_file, posix_file_path)
+    return f"DICOM-{sha256.hexdigest()}", get_dicom_metadata(dataset)
+
+
+def hash_and_parse_dicom(content):
+    """
+    :param content: bytes of a dicom file
+    :return: (dicom_record_uuid, metadata), same as generate_uuid_binary() and parse_dicom_from_delta_record()
+    """
+    dataset = pydicom.dcmread(BytesIO(content), stop_before_pixels=True)
+    return f"DICOM-{hashlib.sha256(content).hexdigest()}", get_dicom_metadata(dataset)
+
+
+def hash_and_parse_dicoms(batches, promoted_tags=PROMOTED_TAGS):
+    """
+    Hash and parse the dicoms of each arrow batch, for mapInPandas. Each dicom crosses from spark to python once,
+    and only its uuid and metadata come back.
+
+    :param batches: iterator of binaryFile dataframes, with content, or without it to read the dicoms from their path
+    :param promoted_tags: dicom keywords added as typed columns, see dicom_schema.py
+    :return: iterator of dataframes of path, modificationTime, length, dicom_record_uuid, promoted tags and metadata
+    """
+    for batch in batches:
+        if "content" in batch.columns:
+            results = [hash_and_parse_dicom(content) for content in batch.content]
+        else:
+            results = [hash_and_parse_dicom_header(path) for path in batch.path]
+
+        metadatas = [metadata for _, metadata in results]
+        columns = {"dicom_record_uuid": [dicom_record_uuid for dicom_record_uuid, _ in results]}
+        columns.update({tag: get_promoted_values(metadatas, tag) for tag in promoted_tags})
+        columns["metadata"] = metadatas
+
+        yield batch[["path", "modificationTime", "length"]].assign(**columns)
+
+
+def get_write_count(spark, table_path):
+    """
+    Number of rows written by the last operation on a delta table, from its write metrics
+
+    :param spark: spark session
+    :param table_path: path to the delta table
+    :return: rows written by the last WRITE, or inserted and updated by the last MERGE
+    """
+    from delta.tables import DeltaTable
+    metrics = DeltaTable.forPath(spark, table_path).history(1).collect()[0]["operationMetrics"]
+
+    if "numOutputRows" in metrics:
+        return int(metrics["numOutputRows"])
+    return int(metrics.get("numTargetRowsInserted", 0)) + int(metrics.get("numTargetRowsUpdated", 0))
+
+
+def has_same_columns(schema, other_schema):
+    """
+    :param schema: StructType
+    :param other_schema: StructType
+    :return: True if both schemas have the same column names and types, in any order
+    """
+    return {(field.name, field.dataType.simpleString()) for field in schema} == \
+        {(field.name, field.dataType.simpleString()) for field in other_schema}
+
+
+def parse_dicom_header_from_path(path):
+    """
+    Same metadata as parse_dicom_from_delta_record(), from the header of the dicom file only
+
+    :param path: file path e.g. file:/path/to/file.dcm
+    :return: dict of dicom keyword -> value
+    """
+    return get_dicom_metadata(read_dicom_header(path))
+
+
+def get_dicom_metadata(dataset):
+    """
+    :param dataset: pydicom dataset
+    :return: dict of dicom keyword -> value, for values that are strings, numbers or lists of them
+    """
     kv = {}
     types = set()
     skipped_keys = []
@@ -172,30 +329,88 @@ def create_proxy_table(config_file):
             option("recursiveFileLookup", "true"). \
             load(cfg.get_value(path=DATA_CFG+'::RAW_DATA_PATH'))
 
-        from utils import generate_uuid_binary
-        generate_uuid_udf = udf(generate_uuid_binary, StringType())
-        df = df.withColumn("dicom_record_uuid", lit(generate_uuid_udf(df.content, array([lit("DICOM")]))))
-
-    # parse all dicoms and save
+        # optional, read the dicoms from their path on the executors instead of loading their content in spark,
+        # and parse their headers only
+        header_only = cfg.has_value(path=DATA_CFG+'::HEADER_ONLY') and cfg.get_value(path=DATA_CFG+'::HEADER_ONLY')
+
+        # optional, dicom tags stored as typed columns for pushdown, in addition to the metadata map
+        promoted_tags = cfg.get_value(path=DATA_CFG+'::PROMOTED_TAGS') if cfg.has_value(path=DATA_CFG+'::PROMOTED_TAGS') \
+            else PROMOTED_TAGS
+        header_schema = StructType(df.drop("content").schema.fields +
+                                   [StructField("dicom_record_uuid", StringType())] +
+                                   get_promoted_schema(promoted_tags).fields +
+                                   [StructField("metadata", MapType(StringType(), StringType()))])
+
+        # optional, parse only the dicoms that are new or changed since the last run, and merge them into the table
+        incremental = cfg.has_value(path=DATA_CFG+'::INCREMENTAL') and cfg.get_value(path=DATA_CFG+'::INCREMENTAL')
+        format_type = cfg.get_value(path=DATA_CFG+'::FORMAT_TYPE')
+        if incremental and format_type != "delta":
+            logger.warning("INCREMENTAL requires FORMAT_TYPE delta, ingesting all dicoms")
+            incremental = False
+        merge = incremental and os.path.exists(dicom_path)
+
+        # rows of the existing table would lack columns of the new headers, e.g. after PROMOTED_TAGS changed
+        if merge and not has_same_columns(header_schema, spark.read.format("delta").load(dicom_path).schema):
+            logger.warning("dicom table columns differ from the parsed headers, e.g. PROMOTED_TAGS changed, ingesting all dicoms")
+            merge = False
+
+        if header_only or merge:
+            # the binaryFile source doesn't read the content of files if it isn't selected. when merging, the
+            # listing is joined first and only new or changed dicoms are read, from their path
+            df = df.drop("content")
+
+        if merge:
+            existing_df = spark.read.format("delta").load(dicom_path).select(DICOM_FILE_KEYS)
+
+            # dicoms no longer in RAW_DATA_PATH are deleted from the table
+            from delta.tables import DeltaTable
+            deleted_df = existing_df.select("path").join(df.select("path"), on="path", how="left_anti")
+            DeltaTable.forPath(spark, dicom_path).alias("main_table") \
+                .merge(deleted_df.alias("deleted"), "main_table.path = deleted.path") \
+                .whenMatchedDelete() \
+                .execute()
+
+            df = df.join(existing_df, on=DICOM_FILE_KEYS, how="left_anti")
+
+    # hash and parse all dicoms in arrow batches, and save
     with CodeTimer(logger, 'parse and save dicom'):
-        parse_dicom_from_delta_record_udf = udf(parse_dicom_from_delta_record, MapType(StringType(), StringType()))
-        header = df.withColumn("metadata", lit(parse_dicom_from_delta_record_udf(df.path, df.content)))
-        header = header.drop("content")
-
-        header.coalesce(cfg.get_value(path=DATA_CFG+'::NUM_PARTITION')).write \
-            .format(cfg.get_value(path=DATA_CFG+'::FORMAT_TYPE')) \
-            .mode("overwrite") \
-            .option("mergeSchema", "true") \
-            .save(dicom_path)
-
-    processed_count = header.count()
-    logger.info("Processed {} dicom headers out of total {} dicom files".format(processed_count,
-                                                                        cfg.get_value(path=DATA_CFG+'::FILE_COUNT')))
-
-    # validate and show created dataset
-    if processed_count != int(cfg.get_value(path=DATA_CFG+'::FILE_COUNT')):
+        # the arrow batch size bounds the dicom content in memory, it is only set for this write and then restored
+        arrow_batch_rows = spark.conf.get("spark.sql.execution.arrow.maxRecordsPerBatch", None)
+        spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", DICOM_BATCH_ROWS)
+        header = df.mapInPandas(partial(hash_and_parse_dicoms, promoted_tags=promoted_tags), schema=header_schema)
+
+        try:
+            if merge:
+                # dicoms are keyed by path, changed files replace their previous version
+                from delta.tables import DeltaTable
+                DeltaTable.forPath(spark, dicom_path).alias("main_table") \
+                    .merge(header.alias("updates"), "main_table.path = updates.path") \
+                    .whenMatchedUpdateAll() \
+                    .whenNotMatchedInsertAll() \
+                    .execute()
+            else:
+                # the schema is replaced too, so columns of tags no longer promoted are dropped
+                header.coalesce(cfg.get_value(path=DATA_CFG+'::NUM_PARTITION')).write \
+                    .format(format_type) \
+                    .mode("overwrite") \
+                    .option("overwriteSchema", "true") \
+                    .save(dicom_path)
+        finally:
+            if arrow_batch_rows is None:
+                spark.conf.unset("spark.sql.execution.arrow.maxRecordsPerBatch")
+            else:
+                spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", arrow_batch_rows)
+
+    # validate and show created dataset. counts come from the write metrics and the table files, without parsing
+    # the dicoms again
+    df = spark.read.format(format_type).load(dicom_path)
+    dicom_count = df.count()
+    processed_count = get_write_count(spark, dicom_path) if format_type == "delta" else dicom_count
+    logger.info("Processed {} new or changed dicom headers, {} dicom headers out of total {} dicom files".format(
+        processed_count, dicom_count, cfg.get_value(path=DATA_CFG+'::FILE_COUNT')))
+
+    if dicom_count != int(cfg.get_value(path=DATA_CFG+'::FILE_COUNT')):
         exit_code = 1
-    df = spark.read.format(cfg.get_value(path=DATA_CFG+'::FORMAT_TYPE')).load(dicom_path)
     df.printSchema()
     return exit_code
 
@@ -235,7 +450,8 @@ def update_graph(config_file):
         logger.info("Loading!")
         df_dcmdata = spark.read.format("delta").load(dicom_path)
 
-        tuple_to_add = df_dcmdata.select("metadata.PatientID", "metadata.AccessionNumber", "metadata.SeriesInstanceUID")\
+        tuple_to_add = df_dcmdata.select([get_dicom_column(df_dcmdata, tag).alias(tag)
+                                          for tag in ["PatientID", "AccessionNumber", "SeriesInstanceUID"]])\
             .groupBy("PatientID", "AccessionNumber", "SeriesInstanceUID")\
             .count()\
             .toPandas()
@@ -19,6 +19,7 @@ from data_processing.common.sparksession import SparkConfig
 from data_processing.common.custom_logger import init_logger
 import data_processing.common.constants as const
 from data_processing.radiology.common.preprocess import overlay_images, create_seg_images
+from data_processing.radiology.common.dicom_schema import PROMOTED_TAGS, get_dicom_column
 
 from pyspark.sql import functions as F
 from pyspark.sql.types import StringType, IntegerType, ArrayType, StructType, StructField, BinaryType
@@ -109,9 +110,12 @@ def generate_image_table():
         seg_df = seg_df.select("accession_number", seg_df.path.alias("seg_path"), "label",
                                "instance_number", "seg_png", "scan_annotation_record_uuid", "series_number")
 
-        cond = [dicom_df.metadata.AccessionNumber == seg_df.accession_number,
-                dicom_df.metadata.SeriesNumber == seg_df.series_number,
-                dicom_df.metadata.InstanceNumber == seg_df.instance_number]
+        cond = [get_dicom_column(dicom_df, "AccessionNumber") == seg_df.accession_number,
+                get_dicom_column(dicom_df, "SeriesNumber") == seg_df.series_number,
+                get_dicom_column(dicom_df, "InstanceNumber") == seg_df.instance_number]
+
+        # promoted tags of the dicom table are kept as columns of the png table
+        promoted_tags = [tag for tag in PROMOTED_TAGS if tag in dicom_df.columns]
 
         seg_df = seg_df.join(dicom_df, cond)
 
@@ -122,7 +126,7 @@ def generate_image_table():
  
         # unpack dicom_overlay struct into 2 columns
         seg_df = seg_df.select(F.col("dicom_overlay.dicom").alias("dicom"), F.col("dicom_overlay.overlay").alias("overlay"),
-                                "metadata", "scan_annotation_record_uuid", "label")
+                                *promoted_tags, "metadata", "scan_annotation_record_uuid", "label")
 
         # generate uuid
         spark.sparkContext.addPyFile("./data_processing/common/EnsureByteContext.py")
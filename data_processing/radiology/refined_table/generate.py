@@ -26,6 +26,7 @@ from data_processing.common.config import ConfigSet
 from data_processing.common.sparksession import SparkConfig
 from data_processing.common.custom_logger import init_logger
 import data_processing.common.constants as const
+from data_processing.radiology.common.dicom_schema import get_dicom_column
 
 from pyspark.sql import functions as F
 from pyspark.sql.types import ArrayType,StringType,StructType,StructField
@@ -148,7 +149,7 @@ def generate_scan_table(spark, uid, hdfs_uri, custom_preprocessing_script, tag,
 
     # Filter dicom table with the given SeriesInstanceUID and return 1 row. (Assumption: Dicom folders are organized by SeriesInstanceUID)
     df = df_dcmdata \
-        .filter(F.col("metadata."+concept_id_type)==uid) \
+        .filter(get_dicom_column(df_dcmdata, concept_id_type)==uid) \
         .limit(1)
 
     if df.count()==0: 
@@ -161,7 +162,7 @@ def generate_scan_table(spark, uid, hdfs_uri, custom_preprocessing_script, tag,
         df_scan = df.withColumn("scan_data", udf_generate_scan(F.lit(project_dir), F.lit(file_ext), df.path))
         # expand the array and flatten the schema
         df_scan = df_scan.withColumn("exp", F.explode("scan_data"))
-        df_scan = df_scan.select("metadata.SeriesInstanceUID", "exp.*")
+        df_scan = df_scan.select(get_dicom_column(df_scan, "SeriesInstanceUID").alias("SeriesInstanceUID"), "exp.*")
 
         # Check if the same scan_record_uuid/filetype combo exists. if not, append to scan table.
         scan_table_path = os.path.join(project_dir, const.SCAN_TABLE)
@@ -7,7 +7,9 @@ from data_processing.common.Neo4jConnection  import Neo4jConnection
 from data_processing.common.Node      import Node
 from data_processing.common.config    import ConfigSet
 from data_processing.common.Container import Container
+from data_processing.radiology.common.dicom_schema import get_dicom_column
 
+from pyspark.sql.functions import col
 from pyspark.sql.types import StringType, IntegerType, StructType, StructField
 
 import os, shutil, sys, json, subprocess, uuid, requests
@@ -306,19 +308,24 @@ class initScans(Resource):
 
         if not len(res_data)==1: return make_response(("Operations only support singleton datasets right now", 500))
 
-        df = spark.read\
+        df_dicom = spark.read\
             .format("delta")\
-            .load(res_data[0]['das']['TABLE_LOCATION'])\
-            .select("path", \
-                "AccessionNumber", \
-                "SeriesInstanceUID", \
-                "metadata.SeriesNumber", \
-                "metadata.SeriesDescription", \
-                "metadata.PerformedProcedureStepDescription", \
-                "metadata.ImageType", \
-                "metadata.InstanceNumber")\
+            .load(res_data[0]['das']['TABLE_LOCATION'])
+
+        # promoted tags are read from their columns, the others from the metadata map. node properties stay strings
+        df = df_dicom\
+            .select("path", *[get_dicom_column(df_dicom, tag).alias(tag) for tag in [
+                "AccessionNumber",
+                "SeriesInstanceUID",
+                "SeriesNumber",
+                "SeriesDescription",
+                "PerformedProcedureStepDescription",
+                "ImageType",
+                "InstanceNumber"]])\
             .where(query)\
-            .where("InstanceNumber='1'")\
+            .where("InstanceNumber=1")\
+            .withColumn("SeriesNumber", col("SeriesNumber").cast("string"))\
+            .withColumn("InstanceNumber", col("InstanceNumber").cast("string"))\
             .orderBy("AccessionNumber") \
             .join(df_cohort, ['AccessionNumber'])
 
@@ -0,0 +1,45 @@
+import os
+import shutil
+import datetime
+
+import pytest
+from data_processing.common.config import ConfigSet
+from data_processing.common.sparksession import SparkConfig
+from data_processing.common.delta_merge import merge_latest
+
+table_path = "tests/data_processing/common/test_data/delta_merge_table"
+
+
+@pytest.fixture
+def spark():
+    print('------setup------')
+    APP_CFG = 'APP_CFG'
+    ConfigSet(name=APP_CFG, config_file='tests/test_config.yaml')
+    spark = SparkConfig().spark_session(config_name=APP_CFG, app_name='test-delta-merge')
+
+    yield spark
+
+    print('------teardown------')
+    if os.path.exists(table_path):
+        shutil.rmtree(table_path)
+
+
+def _records(spark, rows, date_updated):
+    return spark.createDataFrame([(uuid, user, slide_id, date_updated, True) for uuid, user, slide_id in rows],
+                                 ["record_uuid", "user", "slide_id", "date_updated", "latest"])
+
+
+def test_merge_latest(spark):
+    day1, day2 = datetime.datetime(2021, 3, 1), datetime.datetime(2021, 3, 2)
+
+    merge_latest(spark, _records(spark, [("a1", "jill", "1"), ("b1", "jill", "2"), ("c1", "joe", "1")], day1),
+                 table_path, "record_uuid", ["user", "slide_id"])
+    # new annotation of (jill, 1), same annotation of (joe, 1) pulled again
+    merge_latest(spark, _records(spark, [("a2", "jill", "1"), ("c1", "joe", "1")], day2),
+                 table_path, "record_uuid", ["user", "slide_id"])
+
+    df = spark.read.format("delta").load(table_path).toPandas().set_index("record_uuid")
+
+    assert df.latest.to_dict() == {"a1": False, "a2": True, "b1": True, "c1": True}
+    assert df.date_updated["c1"] == day2
+    assert df.date_updated["b1"] == day1
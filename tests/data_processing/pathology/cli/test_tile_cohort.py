@@ -0,0 +1,205 @@
+import importlib
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+from click.testing import CliRunner
+
+from data_processing.common.Node import Node
+
+slide_path = os.path.abspath('tests/data_processing/testdata/data/test-project/wsi/123.svs')
+
+generate_params = {
+    "input_wsi_tag": "whole_slide_image",
+    "job_tag": "test_generate_tiles",
+    "tile_size": 128,
+    "scale_factor": 8,
+    "magnification": 10
+}
+
+
+class FakeContainer(object):
+    """
+    Container with its data nodes in memory instead of the graph DB, keyed by (container, type, name)
+    """
+    nodes = {}
+
+    def __init__(self, params):
+        self._commits = []
+
+    def setNamespace(self, namespace_id):
+        self._namespace_id = namespace_id
+        return self
+
+    def lookupAndAttach(self, container_id):
+        self._name = container_id
+        self.logger = logging.getLogger(container_id)
+        return self
+
+    def get(self, type, name):
+        return FakeContainer.nodes.get((self._name, type, name))
+
+    def add(self, node):
+        self._commits.append(node)
+
+    def saveAll(self):
+        for node in self._commits:
+            FakeContainer.nodes[(self._name, node.type, node.name)] = node
+
+
+def add_wsi(container_id, path):
+    node = Node("wsi", "whole_slide_image", {"path": "file:" + path})
+    node.path = path
+    FakeContainer.nodes[(container_id, "wsi", "whole_slide_image")] = node
+
+
+@pytest.fixture
+def tile_cohort(tmp_path, monkeypatch):
+    # the cli modules load config.yaml from the working directory when imported
+    shutil.copy("tests/test_config.yaml", tmp_path / "config.yaml")
+    monkeypatch.chdir(tmp_path)
+    tile_cohort = importlib.import_module("data_processing.pathology.cli.tile_cohort")
+    generate_tile_labels = importlib.import_module("data_processing.pathology.cli.generate_tile_labels")
+
+    monkeypatch.setenv("MIND_GPFS_DIR", str(tmp_path))
+    monkeypatch.setattr(FakeContainer, "nodes", {})
+    monkeypatch.setattr(tile_cohort, "Container", FakeContainer)
+    monkeypatch.setattr(generate_tile_labels, "Container", FakeContainer)
+
+    return tile_cohort
+
+
+@pytest.fixture
+def slide_copy(tmp_path):
+    # a copy, so its mtime can be changed
+    slide_copy_path = str(tmp_path / "123.svs")
+    shutil.copy(slide_path, slide_copy_path)
+    return slide_copy_path
+
+
+def test_tile_slide_skip_existing(tile_cohort, slide_copy, monkeypatch):
+    add_wsi("slide-1", slide_copy)
+
+    hashed = []
+    get_slide_hash = tile_cohort.get_slide_hash
+    monkeypatch.setattr(tile_cohort, "get_slide_hash", lambda path: hashed.append(path) or get_slide_hash(path))
+
+    result = tile_cohort.tile_slide("test-cohort", "slide-1", {"generate_tile_labels": generate_params}, True)
+    assert result["container_id"] == "slide-1"
+    assert result["status"] == "done"
+    assert isinstance(result["generate_tile_labels"], float)
+    assert result["total"] >= result["generate_tile_labels"]
+    assert len(hashed) == 1
+
+    output_node = FakeContainer.nodes[("slide-1", "TileScores", "test_generate_tiles")]
+    assert output_node.properties["slide_size"] == os.stat(slide_copy).st_size
+
+    # same params, and the slide size and mtime are unchanged, so it isn't hashed again
+    result = tile_cohort.tile_slide("test-cohort", "slide-1", {"generate_tile_labels": generate_params}, True)
+    assert result["status"] == "done"
+    assert result["generate_tile_labels"] == "skipped"
+    assert len(hashed) == 1
+
+    # not skipped without --skip_existing
+    result = tile_cohort.tile_slide("test-cohort", "slide-1", {"generate_tile_labels": generate_params}, False)
+    assert isinstance(result["generate_tile_labels"], float)
+
+    # other params
+    result = tile_cohort.tile_slide("test-cohort", "slide-1", {"generate_tile_labels": dict(generate_params, tile_size=256)}, True)
+    assert isinstance(result["generate_tile_labels"], float)
+
+    # touched slide, hashed again and the output is current
+    os.utime(slide_copy, ns=(0, 0))
+    result = tile_cohort.tile_slide("test-cohort", "slide-1", {"generate_tile_labels": dict(generate_params, tile_size=256)}, True)
+    assert result["generate_tile_labels"] == "skipped"
+    assert len(hashed) == 2
+
+
+def test_tile_slide_failed_step(tile_cohort, monkeypatch):
+    add_wsi("slide-1", slide_path)
+
+    # entry methods log their exceptions, and save no output
+    monkeypatch.setattr(tile_cohort, "TILING_STEPS", [("generate_tile_labels", lambda *args: None, "TileScores")])
+
+    result = tile_cohort.tile_slide("test-cohort", "slide-1", {"generate_tile_labels": generate_params}, True)
+    assert result["status"] == "failed: generate_tile_labels"
+
+    result = tile_cohort.tile_slide("test-cohort", "slide-2", {"generate_tile_labels": generate_params}, True)
+    assert result["status"] == "failed"
+
+
+def test_cli_report(tile_cohort, slide_copy, tmp_path, monkeypatch):
+    add_wsi("slide-1", slide_copy)
+    add_wsi("slide-2", slide_copy)
+
+    # threads share the in-memory container nodes, processes wouldn't
+    monkeypatch.setattr(tile_cohort, "ProcessPoolExecutor", ThreadPoolExecutor)
+
+    with open(tmp_path / "slides.txt", "w") as fp:
+        fp.write("slide-1\nslide-2\n")
+    with open(tmp_path / "method.json", "w") as fp:
+        json.dump({"generate_tile_labels": generate_params}, fp)
+
+    result = CliRunner().invoke(tile_cohort.cli,
+        ['-c', 'test-cohort',
+         '-l', str(tmp_path / "slides.txt"),
+         '-m', str(tmp_path / "method.json"),
+         '-n', '2',
+         '-o', str(tmp_path / "timings.csv")])
+    assert result.exit_code == 0
+
+    df_timings = pd.read_csv(tmp_path / "timings.csv")
+    assert sorted(df_timings.container_id) == ["slide-1", "slide-2"]
+    assert list(df_timings.status) == ["done", "done"]
+    assert {"generate_tile_labels", "total"} <= set(df_timings.columns)
+
+
+def test_cli_requires_query_or_slide_list(tile_cohort, tmp_path):
+    with open(tmp_path / "method.json", "w") as fp:
+        json.dump({"generate_tile_labels": generate_params}, fp)
+
+    result = CliRunner().invoke(tile_cohort.cli, ['-c', 'test-cohort', '-m', str(tmp_path / "method.json")])
+    assert result.exit_code != 0
+
+
+def test_container_reuses_connections(monkeypatch):
+    container_module = importlib.import_module("data_processing.common.Container")
+
+    connections, clients = [], []
+
+    class FakeConnection(object):
+        def __init__(self, uri, user, pwd):
+            connections.append(uri)
+
+        def test_connection(self):
+            return True
+
+    class FakeMinio(object):
+        def __init__(self, uri, access_key, secret_key, secure):
+            clients.append(uri)
+
+        def list_buckets(self):
+            return []
+
+    monkeypatch.setattr(container_module, "Neo4jConnection", FakeConnection)
+    monkeypatch.setattr(container_module, "Minio", FakeMinio)
+    monkeypatch.setattr(container_module, "_graph_connections", {})
+    monkeypatch.setattr(container_module, "_object_store_clients", {})
+
+    params = {"GRAPH_URI": "bolt://localhost:7687", "GRAPH_USER": "neo4j", "GRAPH_PASSWORD": "password",
+              "OBJECT_STORE_ENABLED": True, "MINIO_URI": "localhost:9000", "MINIO_USER": "minio", "MINIO_PASSWORD": "password"}
+
+    first  = container_module.Container(dict(params))
+    second = container_module.Container(dict(params))
+    assert connections == ["bolt://localhost:7687"]
+    assert clients == ["localhost:9000"]
+    assert first._conn is second._conn
+    assert first._client is second._client
+
+    container_module.Container(dict(params, GRAPH_URI="bolt://otherhost:7687"))
+    assert connections == ["bolt://localhost:7687", "bolt://otherhost:7687"]
+    assert clients == ["localhost:9000"]
@@ -18,6 +18,18 @@ class CSVMockResponse:
 
 class ZIPMockResponse:
 
+    status_code = 200
+    headers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
     def iter_content(self, chunk_size=128):
         return [Path('tests/data_processing/pathology/proxy_table/'
                             'regional_annotation/test_data/input/CMU-1.zip').read_bytes()]
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from data_processing.pathology.common.annotation_rle import RunLengthAnnotation, load_annotation
+from data_processing.pathology.common.build_geojson import get_label_stats
+
+
+def _sparse_annotation():
+    rng = np.random.default_rng(seed=0)
+    annotation = np.zeros((203, 317), dtype=np.uint8)
+    annotation[10:60, 20:90]   = 1
+    annotation[30:40, 40:50]   = 0
+    annotation[100:180, 0:317] = 2
+    annotation[150:170, 250:300] = 4
+    annotation[190:, :] = rng.integers(0, 3, size=(13, 317))    # many short runs
+    return annotation
+
+
+def test_round_trip(tmp_path):
+    annotation = _sparse_annotation()
+    rle = RunLengthAnnotation.from_array(annotation, strip_rows=16)
+
+    assert rle.shape == annotation.shape
+    assert np.array_equal(rle.to_array(), annotation)
+    assert np.array_equal(RunLengthAnnotation.from_array(annotation, strip_rows=1000).run_labels, rle.run_labels)
+
+    rle.save(tmp_path / "annotation.rle.npz")
+    np.save(tmp_path / "annotation.npy", annotation)
+    loaded = load_annotation(tmp_path / "annotation.rle.npz")
+
+    assert isinstance(loaded, RunLengthAnnotation)
+    assert loaded.dtype == np.uint8
+    assert np.array_equal(np.asarray(loaded), annotation)
+    assert isinstance(load_annotation(tmp_path / "annotation.npy", mmap_mode='r'), np.memmap)
+
+
+def test_crops():
+    annotation = _sparse_annotation()
+    rle = RunLengthAnnotation.from_array(annotation)
+
+    for key in [np.s_[0:50, 0:50], np.s_[25:35, 45:100], np.s_[100:], np.s_[150:200, 249:], np.s_[:, 300:317], np.s_[5:5, 0:10], np.s_[-20:, -30:-10]]:
+        assert np.array_equal(rle[key], annotation[key])
+
+    with pytest.raises(IndexError):
+        rle[::2]
+    with pytest.raises(IndexError):
+        rle[3, 4]
+
+
+def test_empty_and_invalid():
+    rle = RunLengthAnnotation.from_array(np.zeros((40, 30), dtype=np.uint8))
+
+    assert rle.num_runs == 0
+    assert rle.get_label_stats(16) == {}
+    assert np.array_equal(rle[10:20, 5:10], np.zeros((10, 5), dtype=np.uint8))
+    with pytest.raises(ValueError):
+        RunLengthAnnotation.from_array(np.zeros((4, 4, 3), dtype=np.uint8))
+
+
+def test_label_stats_match_dense():
+    annotation = _sparse_annotation()
+    rle = RunLengthAnnotation.from_array(annotation)
+
+    for block_size in [1, 16, 64, 1000]:
+        expected = get_label_stats(annotation, block_size)
+        expected.pop(0)
+        assert get_label_stats(rle, block_size) == expected
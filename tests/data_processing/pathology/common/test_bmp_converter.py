@@ -0,0 +1,102 @@
+import struct
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from data_processing.pathology.common.bmp_converter import *
+
+
+def _labels(height=203, width=317):
+    rng = np.random.default_rng(seed=0)
+    labels = np.zeros((height, width), dtype=np.uint8)
+    labels[10:60, 20:90] = 1
+    labels[100:180, 130:260] = 2
+    labels[190:] = rng.integers(0, 5, size=(height - 190, width))
+    return labels
+
+
+def _save_palette_bmp(path, labels):
+    img = Image.fromarray(labels, mode='P')
+    img.putpalette([value for n in range(256) for value in (n, 255 - n, 0)])
+    img.save(path)
+
+
+def _to_top_down(bmp_path, top_down_path):
+    """ Rewrite a bottom-up bmp as top-down, with a negative height and rows in reverse order """
+    data = bytearray(open(bmp_path, 'rb').read())
+    offset, = struct.unpack_from("<I", data, 10)
+    height, = struct.unpack_from("<i", data, 22)
+    stride  = (len(data) - offset) // height
+
+    rows = [data[offset + n * stride:offset + (n + 1) * stride] for n in range(height)]
+    struct.pack_into("<i", data, 22, -height)
+    data[offset:] = b"".join(reversed(rows))
+    open(top_down_path, 'wb').write(bytes(data))
+
+
+@pytest.mark.parametrize("mode", ["P", "L", "RGB"])
+def test_iter_bmp_strips_matches_pil(tmp_path, mode):
+    bmp_path = str(tmp_path / "labels.bmp")
+    if mode == "P":
+        _save_palette_bmp(bmp_path, _labels())
+    elif mode == "L":
+        Image.fromarray(_labels(), mode='L').save(bmp_path)
+    else:
+        rng = np.random.default_rng(seed=0)
+        Image.fromarray(rng.integers(0, 256, size=(203, 317, 3), dtype=np.uint8)).save(bmp_path)
+    _to_top_down(bmp_path, str(tmp_path / "top_down.bmp"))
+
+    for path in [bmp_path, str(tmp_path / "top_down.bmp")]:
+        expected = np.array(Image.open(path))
+        assert get_bmp_layout(path)["shape"] == expected.shape
+
+        strips = list(iter_bmp_strips(path, strip_rows=16))
+        assert len(strips) == 13
+        assert all(len(strip) <= 16 for _, strip in strips)
+
+        annotation = np.zeros_like(expected)
+        for row_start, strip in strips:
+            annotation[row_start:row_start + len(strip)] = strip
+        assert np.array_equal(annotation, expected)
+
+
+def test_iter_bmp_strips_4_bit_palette(tmp_path):
+    # SlideViewer label bitmap
+    bmp_path = 'tests/data_processing/testdata/data/test-project/pathology_annotations/regional_bmps/2021_HobS21_8_123/123_joe_SVBMP-123asd_annot.bmp'
+    _to_top_down(bmp_path, str(tmp_path / "top_down.bmp"))
+
+    for path in [bmp_path, str(tmp_path / "top_down.bmp")]:
+        assert get_bmp_layout(path)["bits"] == 4
+
+        save_bmp_as_npy(path, str(tmp_path / "labels.npy"), strip_rows=100)
+        assert np.array_equal(np.load(tmp_path / "labels.npy"), np.array(Image.open(path)))
+
+
+def test_convert_bmp_to_npy_and_rle(tmp_path):
+    import data_processing
+    sys.modules['annotation_rle'] = data_processing.pathology.common.annotation_rle
+    from data_processing.pathology.common.annotation_rle import load_annotation
+
+    labels = _labels()
+    (tmp_path / "input").mkdir()
+    _save_palette_bmp(str(tmp_path / "input" / "labels.bmp"), labels)
+
+    npy_path = convert_bmp_to_npy(str(tmp_path / "input" / "labels.bmp"), str(tmp_path / "npys"))
+    rle_path = convert_bmp_to_rle(str(tmp_path / "input" / "labels.bmp"), str(tmp_path / "npys"))
+
+    assert npy_path == str(tmp_path / "npys" / "input" / "labels.npy")
+    assert rle_path == str(tmp_path / "npys" / "input" / "labels.rle.npz")
+    assert np.array_equal(np.load(npy_path), labels)
+    assert np.array_equal(load_annotation(rle_path).to_array(), labels)
+    assert convert_bmp_to_npy(str(tmp_path / "input" / "labels.png"), str(tmp_path / "npys")) == ''
+
+
+def test_save_bmp_as_npy_falls_back_to_pil(tmp_path):
+    labels = _labels()
+    Image.fromarray(labels > 0).save(tmp_path / "mask.bmp")    # 1 bit
+
+    assert get_bmp_layout(str(tmp_path / "mask.bmp")) is None
+    save_bmp_as_npy(str(tmp_path / "mask.bmp"), str(tmp_path / "mask.npy"))
+    assert np.array_equal(np.load(tmp_path / "mask.npy"), labels > 0)
@@ -1,5 +1,6 @@
 from data_processing.pathology.common.build_geojson import *
-import os, sys
+import data_processing.pathology.common.annotation_rle
+import os, sys, time
 import numpy as np
 import pandas as pd
 import json
@@ -31,6 +32,7 @@ def test_build_geojson_from_bitmap():
 
     import data_processing
     sys.modules['build_geojson'] = data_processing.pathology.common.build_geojson
+    sys.modules['annotation_rle'] = data_processing.pathology.common.annotation_rle
 
     data = [{"label_config": "{'DEFAULT_LABELS': {1: 'tissue_1', 2: 'tissue_2', 3: 'tissue_3', 4: 'tissue_4', 5: 'tissue_5'}}",
              "npy_filepath": os.path.join(npy_data_path, '123_joe_SVBMP-123asd_annot.npy'),
@@ -68,6 +70,27 @@ def test_concatenate_regional_geojsons_one_geojson():
     assert isinstance(res, dict)
     assert 1 == len(res['features'])
 
+def test_concatenate_serialized_geojsons():
+    sys.path.append('data_processing/common')
+    from data_processing.common.utils import generate_uuid_dict
+
+    geojson_list = ['{"type":"FeatureCollection","features":[{"type":"Feature","properties":{"label_num":"1","label_name":"tissue_1"},"geometry":{"type":"Polygon","coordinates":[[1261,2140],[1236,2140],[1222,2134],[1222,2132],[1216,2125]]}}]}',
+                    '{"type": "FeatureCollection", "features": []}',
+                    '{"type":"FeatureCollection","features":[{"type":"Feature","properties":{"label_num":"3","label_name":"tissue_3"},"geometry":{"type":"Polygon","coordinates":[[1117,844],[1074,844],[1062,836],[1056,830],[1054,825]]}}]}']
+
+    res, uuid = concatenate_serialized_geojsons(geojson_list, ["SVCONCATGEOJSON", "DEFAULT_LABELS"])
+
+    assert json.loads(res) == concatenate_regional_geojsons(geojson_list)
+    assert uuid == generate_uuid_dict(res, ["SVCONCATGEOJSON", "DEFAULT_LABELS"])
+
+    # features before the type member can't be spliced, the geojsons are parsed instead
+    geojson_list = ['{"features":[{"type":"Feature"}],"type":"FeatureCollection"}', geojson_list[0]]
+    res, uuid = concatenate_serialized_geojsons(geojson_list, ["SVCONCATGEOJSON", "DEFAULT_LABELS"])
+
+    assert json.loads(res) == concatenate_regional_geojsons(geojson_list)
+    assert uuid == generate_uuid_dict(res, ["SVCONCATGEOJSON", "DEFAULT_LABELS"])
+
+
 def test_build_geojson_from_pointclick_json():
 
     res = build_geojson_from_pointclick_json("{'DEFAULT_LABELS': {0: 'tissue_1', 2: 'tissue_2', 3: 'tissue_3', 4: 'tissue_4', 5: 'tissue_5'}}",
@@ -80,3 +103,203 @@ def test_build_geojson_from_pointclick_json():
     assert "PathAnnotationObject" == res[0]['id']
     assert isinstance(res[0]['properties'], dict)
     assert 2 == len(res[0]['geometry']['coordinates'])
+
+
+def test_build_geojsons_from_pointclick_jsons():
+    label_config = "{'DEFAULT_LABELS': {0: 'tissue_1', 3: 'tissue_3'}, 'OTHER_LABELS': {3: 'other'}}"
+    sv_json = [{"project_id":"8","image_id":"123.svs","label_type":"nucleus","x":"1440","y":"747","class":"0","classname":"tissue_1"},
+               {"project_id":"8","image_id":"123.svs","label_type":"nucleus","x":"1040","y":"477","class":"3","classname":"tissue_3"},
+               {"project_id":"8","image_id":"123.svs","label_type":"nucleus","x":"10","y":"20","class":"7","classname":"tissue_7"}]
+    labelsets = ["DEFAULT_LABELS", "OTHER_LABELS", "DEFAULT_LABELS", "OTHER_LABELS"]
+
+    res = build_geojsons_from_pointclick_jsons(pd.Series([label_config] * 4), pd.Series(labelsets), pd.Series([sv_json, sv_json, [], None]))
+
+    assert res[0] == build_geojson_from_pointclick_json(label_config, "DEFAULT_LABELS", sv_json)
+    assert [point['geometry']['coordinates'] for point in res[0]] == [[1440, 747], [1040, 477]]
+    assert res[1] == [{"type": "Feature", "id": "PathAnnotationObject",
+                       "geometry": {"type": "Point", "coordinates": [1040, 477]},
+                       "properties": {"classification": {"name": "other"}}}]
+    assert res[2] == [] and res[3] is None
+
+
+def _synthetic_annotation():
+    annotation = np.zeros((300, 410), dtype=np.uint8)
+    annotation[10:60, 20:90]     = 1
+    annotation[30:40, 40:50]     = 0    # hole
+    annotation[200:300, 350:410] = 1    # touches the bitmap edges
+    annotation[100:180, 130:260] = 2
+    annotation[150:170, 250:300] = 4
+    annotation[0:5, 0:400]       = 4
+    return annotation
+
+
+def test_get_label_stats():
+    annotation = _synthetic_annotation()
+    label_stats = get_label_stats(annotation, block_size=64)
+
+    assert sorted(label_stats) == [0, 1, 2, 4]
+    for label_num, (num_pixels, (row_start, row_stop, col_start, col_stop)) in label_stats.items():
+        rows, cols = np.nonzero(annotation == label_num)
+        assert num_pixels == len(rows)
+        assert row_start <= rows.min() and rows.max() < row_stop
+        assert col_start <= cols.min() and cols.max() < col_stop
+
+
+def test_add_contours_for_label_matches_full_bitmap():
+    annotation = _synthetic_annotation()
+    mappings = {1: "tissue_1", 2: "tissue_2", 3: "tissue_3", 4: "tissue_4"}
+    label_stats = get_label_stats(annotation, block_size=64)
+
+    for label_num in mappings:
+        res = add_contours_for_label(copy.deepcopy(geojson_base), annotation, label_num, mappings, 0.5, 1, label_stats)
+
+        mask = np.where(annotation == label_num, 1, 0).astype(np.int8)
+        contours = [measure.approximate_polygon(c, tolerance=1) for c in measure.find_contours(mask, level=0.5)]
+        expected = [[[int(round(y)), int(round(x))] for x, y in contour.tolist()] for contour in contours]
+
+        assert [feature['geometry']['coordinates'] for feature in res['features']] == expected
+
+
+def _normalize_contour(contour):
+    """ Closed contours start at their smallest point, so contours traced from different start points compare equal """
+    points = [tuple(point) for point in contour.tolist()]
+    if points[0] != points[-1]:
+        return tuple(points)
+    ring = points[:-1]
+    start = ring.index(min(ring))
+    return tuple(ring[start:] + ring[:start])
+
+
+def test_find_contours_tiled_matches_full_bitmap():
+    annotation = _synthetic_annotation()
+    annotation[60:140, 20:25] = 1    # label 1 crosses several blocks
+    bbox = (0, annotation.shape[0], 0, annotation.shape[1])
+
+    for label_num in [1, 2, 4]:
+        mask = (annotation == label_num).astype(np.int8)
+        expected = sorted(_normalize_contour(c) for c in measure.find_contours(mask, level=0.5))
+
+        for block_size in [16, 37, 1000]:
+            contours = find_contours_tiled(annotation, label_num, 0.5, bbox, block_size)
+            assert sorted(_normalize_contour(c) for c in contours) == expected
+
+
+def test_find_contours_tiled_stopped():
+    import threading
+    annotation = _synthetic_annotation()
+    bbox = (0, annotation.shape[0], 0, annotation.shape[1])
+
+    stop_event = threading.Event()
+    assert len(find_contours_tiled(annotation, 2, 0.5, bbox, 37, stop_event)) > 0
+
+    stop_event.set()
+    assert find_contours_tiled(annotation, 2, 0.5, bbox, 37, stop_event) == []
+    assert get_label_polygons(annotation, 2, 0.5, 1, get_label_stats(annotation), 37, stop_event) == []
+
+
+def test_build_geojson_from_annotation_tiled(tmp_path):
+    import data_processing
+    sys.modules['build_geojson'] = data_processing.pathology.common.build_geojson
+    sys.modules['annotation_rle'] = data_processing.pathology.common.annotation_rle
+
+    npy_filepath = str(tmp_path / "annotation.npy")
+    np.save(npy_filepath, _synthetic_annotation())
+
+    data = {"label_config": "{'DEFAULT_LABELS': {1: 'tissue_1', 2: 'tissue_2', 3: 'tissue_3', 4: 'tissue_4'}}",
+            "npy_filepath": npy_filepath,
+            "labelset": "DEFAULT_LABELS",
+            "contour_level": 0.5,
+            "polygon_tolerance": 1,
+            "geojson": ""}
+
+    untiled = json.loads(build_geojson_from_annotation(pd.DataFrame([data])).geojson.item())
+    tiled   = json.loads(build_geojson_from_annotation(pd.DataFrame([dict(data, contour_block_size=64)])).geojson.item())
+
+    assert len(tiled['features']) == len(untiled['features'])
+    assert sorted(f['properties']['label_num'] for f in tiled['features']) == sorted(f['properties']['label_num'] for f in untiled['features'])
+
+
+def test_build_geojsons_from_annotation(tmp_path):
+    import data_processing
+    sys.modules['build_geojson'] = data_processing.pathology.common.build_geojson
+    sys.modules['annotation_rle'] = data_processing.pathology.common.annotation_rle
+
+    npy_filepath = str(tmp_path / "annotation.npy")
+    np.save(npy_filepath, _synthetic_annotation())
+
+    label_config = "{'DEFAULT_LABELS': {1: 'tissue_1', 2: 'tissue_2', 4: 'tissue_4'}, 'TUMOR_LABELS': {2: 'tumor'}, 'EMPTY_LABELS': {3: 'tissue_3'}}"
+    data = {"bmp_record_uuid": "SVBMP-123", "label_config": label_config, "npy_filepath": npy_filepath,
+            "contour_level": 0.5, "polygon_tolerance": 1, "geojson": ""}
+
+    res = build_geojsons_from_annotation(pd.DataFrame([dict(data, labelset_list=["DEFAULT_LABELS", "TUMOR_LABELS", "EMPTY_LABELS"])]))
+
+    assert list(res.labelset) == ["DEFAULT_LABELS", "TUMOR_LABELS"]
+    assert "labelset_list" not in res.columns
+    for labelset, geojson in zip(res.labelset, res.geojson):
+        expected = build_geojson_from_annotation(pd.DataFrame([dict(data, labelset=labelset)])).geojson.item()
+        assert json.loads(geojson) == json.loads(expected)
+
+    # same bitmap pulled for several users, each gets its geojsons
+    res = build_geojsons_from_annotation(pd.DataFrame([dict(data, user=user, labelset_list=["DEFAULT_LABELS", "TUMOR_LABELS"])
+                                                       for user in ["jill", "joe"]]))
+
+    assert sorted(zip(res.user, res.labelset)) == [("jill", "DEFAULT_LABELS"), ("jill", "TUMOR_LABELS"),
+                                                   ("joe", "DEFAULT_LABELS"), ("joe", "TUMOR_LABELS")]
+
+
+def test_build_geojsons_from_annotation_timeout(tmp_path, monkeypatch):
+    import data_processing
+    sys.modules['build_geojson'] = data_processing.pathology.common.build_geojson
+    sys.modules['annotation_rle'] = data_processing.pathology.common.annotation_rle
+
+    npy_filepath = str(tmp_path / "annotation.npy")
+    np.save(npy_filepath, _synthetic_annotation())
+
+    traced = []
+
+    def slow_label_polygons(*args):
+        stop_event = args[-1]
+        # tracing block by block, until stopped
+        for _ in range(30):
+            if stop_event.is_set():
+                return []
+            time.sleep(0.1)
+        traced.append(args[1])
+        return []
+
+    monkeypatch.setattr(data_processing.pathology.common.build_geojson, "TIMEOUT_SECONDS", 1)
+    monkeypatch.setattr(data_processing.pathology.common.build_geojson, "get_label_polygons", slow_label_polygons)
+
+    label_config = "{'DEFAULT_LABELS': {1: 'tissue_1', 2: 'tissue_2', 3: 'tissue_3', 4: 'tissue_4'}}"
+    data = {"bmp_record_uuid": "SVBMP-123", "label_config": label_config, "npy_filepath": npy_filepath,
+            "contour_level": 0.5, "polygon_tolerance": 1, "geojson": "", "build_threads": 1,
+            "labelset_list": ["DEFAULT_LABELS"]}
+
+    start = time.time()
+    res = build_geojsons_from_annotation(pd.DataFrame([data]))
+
+    # labels not yet traced are cancelled, the label being traced is stopped and waited for
+    assert len(res) == 0
+    assert time.time() - start < 2.5
+    assert traced == []
+
+
+def test_build_geojson_from_rle_annotation(tmp_path):
+    import data_processing
+    from data_processing.pathology.common.annotation_rle import RunLengthAnnotation
+    sys.modules['build_geojson'] = data_processing.pathology.common.build_geojson
+    sys.modules['annotation_rle'] = data_processing.pathology.common.annotation_rle
+
+    np.save(tmp_path / "annotation.npy", _synthetic_annotation())
+    RunLengthAnnotation.from_array(_synthetic_annotation()).save(tmp_path / "annotation.rle.npz")
+
+    data = {"label_config": "{'DEFAULT_LABELS': {1: 'tissue_1', 2: 'tissue_2', 3: 'tissue_3', 4: 'tissue_4'}}",
+            "labelset": "DEFAULT_LABELS",
+            "contour_level": 0.5,
+            "polygon_tolerance": 1,
+            "geojson": ""}
+
+    for contour_block_size in [0, 64]:
+        expected = build_geojson_from_annotation(pd.DataFrame([dict(data, npy_filepath=str(tmp_path / "annotation.npy"), contour_block_size=contour_block_size)]))
+        res      = build_geojson_from_annotation(pd.DataFrame([dict(data, npy_filepath=str(tmp_path / "annotation.rle.npz"), contour_block_size=contour_block_size)]))
+        assert json.loads(res.geojson.item()) == json.loads(expected.geojson.item())
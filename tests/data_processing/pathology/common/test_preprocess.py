@@ -0,0 +1,284 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from data_processing.pathology.common.preprocess import *
+
+
+def _random_thumbnail(height=203, width=317):
+    rng = np.random.default_rng(seed=0)
+    return rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+
+def _tile_addresses(img, tile_size):
+    tiles_y = -(-img.shape[0] // tile_size)
+    tiles_x = -(-img.shape[1] // tile_size)
+    return list(itertools.product(range(tiles_x), range(tiles_y)))
+
+
+def test_get_tile_grid():
+    img = _random_thumbnail()
+    tile_grid, tile_pixels = get_tile_grid(img, 32)
+
+    assert tile_grid.shape == (7, 10, 32, 32, 3)
+    assert np.array_equal(tile_grid[2, 3], img[64:96, 96:128])
+    assert tile_pixels[0, 0] == 32 * 32
+    assert tile_pixels[-1, -1] == (203 - 6 * 32) * (317 - 9 * 32)
+
+
+def test_get_otsu_scores_matches_deepzoom():
+    img = _random_thumbnail()
+    otsu_img = make_otsu(img)
+    addresses = _tile_addresses(img, 32)
+
+    generator, level = get_full_resolution_generator(array_to_slide(otsu_img), tile_size=32)
+    expected = [np.array(generator.get_tile(level, address)).mean().item() for address in addresses]
+
+    assert np.allclose(get_otsu_scores(addresses, otsu_img, 32), expected)
+
+
+def test_get_purple_scores_matches_deepzoom():
+    img = _random_thumbnail()
+    addresses = _tile_addresses(img, 32)
+
+    generator, level = get_full_resolution_generator(array_to_slide(img), tile_size=32)
+    expected = []
+    for address in addresses:
+        tile = np.array(generator.get_tile(level, address))
+        r, g, b = tile[..., 0], tile[..., 1], tile[..., 2]
+        expected.append(np.mean((r > (g + 10)) & (b > (g + 10))))
+
+    assert get_purple_scores(addresses, img, 32) == expected
+
+
+def test_score_tiles_default_scorers():
+    img = _random_thumbnail()
+    addresses = _tile_addresses(img, 32)
+
+    score_grids = score_tiles(img, 32)
+
+    assert list(score_grids.keys()) == ["otsu_score", "purple_score"]
+    assert np.allclose(get_scores_at_addresses(score_grids["otsu_score"], addresses),
+                       get_otsu_scores(addresses, make_otsu(img), 32))
+    assert get_scores_at_addresses(score_grids["purple_score"], addresses) == get_purple_scores(addresses, img, 32)
+
+
+def test_score_tiles_with_params_and_per_tile_scorer():
+    img = _random_thumbnail()
+
+    @register_tile_scorer("test_mean_red", vectorized=False)
+    def score_mean_red(tile):
+        return tile[..., 0].mean()
+
+    score_grids = score_tiles(img, 32, ["blur_score", "pen_score", {"scorer": "otsu_score", "scale": 0.8}, "test_mean_red"])
+    TILE_SCORERS.pop("test_mean_red")
+
+    assert list(score_grids.keys()) == ["blur_score", "pen_score", "otsu_score_0.8", "test_mean_red"]
+    assert np.allclose(score_grids["otsu_score_0.8"], get_otsu_score_grid(make_otsu(img, scale=0.8), 32))
+    assert score_grids["test_mean_red"][-1, -1] == img[192:, 288:, 0].mean()
+    for score_grid in score_grids.values():
+        assert score_grid.shape == (7, 10)
+
+
+def test_score_blur():
+    from skimage.filters import gaussian
+
+    # 4 pixel checkerboard, sharp on the left tile, blurred on the right tile
+    checkerboard = (np.indices((32, 64)) // 4).sum(axis=0) % 2 * 255
+    img = np.repeat(checkerboard[..., None], 3, axis=2).astype(np.uint8)
+    img[:, 32:] = (gaussian(img[:, 32:], sigma=2, channel_axis=-1, preserve_range=True)).astype(np.uint8)
+
+    blur_score = score_tiles(img, 32, ["blur_score"])["blur_score"]
+
+    assert blur_score.shape == (1, 2)
+    assert blur_score[0, 0] > 10 * blur_score[0, 1]
+
+
+def test_score_pen():
+    # white tissue-free background, with a blue, a green and a black pen stroke in tiles 1 to 3
+    img = np.full((32, 128, 3), 230, dtype=np.uint8)
+    img[8:12, 32:64] = [40, 60, 200]
+    img[8:12, 64:96] = [40, 160, 60]
+    img[8:12, 96:]   = [20, 20, 20]
+
+    pen_score = score_tiles(img, 32, ["pen_score"])["pen_score"]
+
+    assert pen_score[0, 0] == 0
+    assert np.allclose(pen_score[0, 1:], 4 * 32 / (32 * 32))
+
+
+def test_score_tiles_unknown_scorer():
+    with pytest.raises(ValueError):
+        score_tiles(_random_thumbnail(), 32, ["not_a_scorer"])
+
+
+@pytest.fixture
+def slide_and_scores(tmp_path, monkeypatch):
+    import tifffile
+    from data_processing.pathology.common import preprocess
+
+    # generic tiled tiff, which has no aperio magnification property
+    monkeypatch.setattr(preprocess, "get_scale_factor_at_magnfication", lambda slide, requested_magnification: 1)
+
+    rng = np.random.default_rng(seed=0)
+    slide_file_path = str(tmp_path / "slide.tif")
+    tifffile.imwrite(slide_file_path, rng.integers(0, 256, size=(1000, 1300, 3), dtype=np.uint8), tile=(256, 256), photometric='rgb')
+
+    df = make_tile_index(*zip(*itertools.product(range(1, 9), range(1, 6))), 20)
+    df["otsu_score"]   = rng.random(len(df))
+    df["purple_score"] = rng.random(len(df))
+    scores_file_path = str(tmp_path / "tile_scores_and_labels.parquet")
+    write_tile_index(df, scores_file_path)
+
+    return slide_file_path, scores_file_path
+
+
+def test_save_tiles_parallel_matches_serial(tmp_path, slide_and_scores):
+    slide_file_path, scores_file_path = slide_and_scores
+    params = {"tile_size": 64, "magnification": 20}
+
+    for output_dir, num_processes in [("serial", 1), ("parallel", 3)]:
+        os.makedirs(tmp_path / output_dir)
+        properties = save_tiles(slide_file_path, scores_file_path, str(tmp_path / output_dir), dict(params, num_processes=num_processes))
+
+    assert properties["pil_image_bytes_length"] == 64 * 64 * 3
+    assert (tmp_path / "serial" / "tiles.slice.pil").read_bytes() == (tmp_path / "parallel" / "tiles.slice.pil").read_bytes()
+    pd.testing.assert_frame_equal(read_tile_index(tmp_path / "serial" / "address.slice.parquet"),
+                                  read_tile_index(tmp_path / "parallel" / "address.slice.parquet"))
+
+    df = read_tile_index(tmp_path / "serial" / "address.slice.parquet")
+    address, row = next(df.iterrows())
+    generator, level = get_full_resolution_generator(openslide.OpenSlide(slide_file_path), tile_size=64)
+    expected = generator.get_tile(level, address_to_coord(address)).resize((64, 64)).tobytes()
+    with open(tmp_path / "serial" / "tiles.slice.pil", "rb") as fp:
+        fp.seek(int(row.tile_image_offset))
+        assert fp.read(int(row.tile_image_length)) == expected
+
+
+def test_save_tiles_to_shards(tmp_path, slide_and_scores):
+    from data_processing.pathology.common.tile_shards import TileShardReader
+
+    slide_file_path, scores_file_path = slide_and_scores
+    params = {"tile_size": 64, "magnification": 20, "tile_codec": "png", "tiles_per_shard": 4}
+
+    os.makedirs(tmp_path / "raw")
+    save_tiles(slide_file_path, scores_file_path, str(tmp_path / "raw"), {"tile_size": 64, "magnification": 20})
+    for output_dir, num_processes in [("serial", 1), ("parallel", 3)]:
+        os.makedirs(tmp_path / output_dir)
+        properties = save_tiles(slide_file_path, scores_file_path, str(tmp_path / output_dir), dict(params, num_processes=num_processes))
+
+    df_raw    = read_tile_index(tmp_path / "raw" / "address.slice.parquet")
+    df_shards = read_tile_index(tmp_path / "serial" / "address.slice.parquet")
+
+    assert properties["num_shards"] == len(os.listdir(tmp_path / "serial")) - 1
+    assert properties["compression_ratio"] > 0
+    assert list(df_shards.index) == list(df_raw.index)
+    pd.testing.assert_frame_equal(df_shards, read_tile_index(tmp_path / "parallel" / "address.slice.parquet"))
+
+    address, row = next(df_raw.iterrows())
+    with open(tmp_path / "raw" / "tiles.slice.pil", "rb") as fp:
+        fp.seek(int(row.tile_image_offset))
+        raw_tile = np.frombuffer(fp.read(int(row.tile_image_length)), dtype=np.uint8).reshape(64, 64, 3)
+    reader = TileShardReader(tmp_path / "parallel" / df_shards.loc[address, "tile_shard"])
+    assert np.array_equal(reader.get_tile(address), raw_tile)
+
+
+def test_get_thumbnail_and_otsu_cache(tmp_path, slide_and_scores, monkeypatch):
+    from data_processing.pathology.common import preprocess
+
+    slide_file_path, _ = slide_and_scores
+    slide = openslide.OpenSlide(slide_file_path)
+    slide_hash = get_slide_hash(slide_file_path)
+
+    thumbnail_calls = []
+    get_downscaled_thumbnail = preprocess.get_downscaled_thumbnail
+    monkeypatch.setattr(preprocess, "get_downscaled_thumbnail", lambda *args: thumbnail_calls.append(args) or get_downscaled_thumbnail(*args))
+
+    rgb_thumbnail, otsu_thumbnail = get_thumbnail_and_otsu(slide, 4, cache_dir=str(tmp_path), slide_hash=slide_hash)
+    rgb_cached, otsu_cached = get_thumbnail_and_otsu(slide, 4, cache_dir=str(tmp_path), slide_hash=slide_hash)
+    get_thumbnail_and_otsu(slide, 8, cache_dir=str(tmp_path), slide_hash=slide_hash)
+
+    assert len(thumbnail_calls) == 2
+    assert isinstance(rgb_cached, np.memmap)
+    assert np.array_equal(rgb_cached, get_downscaled_thumbnail(slide, 4))
+    assert np.array_equal(otsu_cached, make_otsu(rgb_cached).astype(bool))
+
+    scorers = ["otsu_score", {"scorer": "otsu_score", "scale": 0.8}]
+    for column, score_grid in score_tiles(rgb_cached, 16, scorers, otsu_cached).items():
+        assert np.allclose(score_grid, score_tiles(rgb_cached, 16, scorers)[column])
+
+
+def test_pretile_scoring_with_other_scorers(tmp_path, slide_and_scores):
+    slide_file_path, _ = slide_and_scores
+    output_dir = tmp_path / "scores"
+    output_dir.mkdir()
+
+    properties = pretile_scoring(slide_file_path, str(output_dir), {"tile_size": 64, "magnification": 20, "scorers": ["blur_score"]})
+
+    # the default scores used to select tiles are computed too
+    df = read_tile_index(properties["file"])
+    assert {"otsu_score", "purple_score", "blur_score"} <= set(df.columns)
+
+    os.makedirs(tmp_path / "tiles")
+    save_tiles(slide_file_path, properties["file"], str(tmp_path / "tiles"), {"tile_size": 64, "magnification": 20})
+
+
+def test_visualize_tiling_scores_matches_per_tile_drawing():
+    from skimage.draw import rectangle_perimeter
+
+    img = _random_thumbnail()
+    rng = np.random.default_rng(seed=1)
+    df = make_tile_index(*zip(*_tile_addresses(img, 32)), 20)
+    df["otsu_score"]   = rng.random(len(df))
+    df["purple_score"] = rng.random(len(df))
+    df.loc[df.index[3], "otsu_score"] = np.nan
+
+    expected = img.copy()
+    generator, level = get_full_resolution_generator(array_to_slide(img), tile_size=32)
+    for index, row in df.iterrows():
+        if not (row.otsu_score > 0.5 and row.purple_score > 0.1): continue
+        x, y = address_to_coord(index)
+        rr, cc = rectangle_perimeter(start=(y * 32, x * 32), extent=generator.get_tile_dimensions(level, (x, y)), shape=img.shape)
+        expected[rr, cc] = scoring_palette_as_list[round(row.otsu_score * (NUM_COLORS-1))]
+
+    assert np.array_equal(visualize_tiling_scores(df, img.copy(), 32), expected)
+
+
+def test_tile_key_round_trip():
+    x, y, z = np.array([0, 1, 2**24 - 1]), np.array([5, 2**24 - 1, 0]), np.array([20, 40, 5])
+
+    assert [np.array_equal(a, b) for a, b in zip(unpack_tile_key(pack_tile_key(x, y, z)), (x, y, z))] == [True] * 3
+    with pytest.raises(ValueError):
+        pack_tile_key(2**24, 0, 20)
+
+
+def test_make_tile_index():
+    df = make_tile_index([1, 10], [2, 21], 20)
+
+    assert list(df.index) == ["x1_y2_z20", "x10_y21_z20"]
+    assert list(df.columns) == ["x", "y", "z", "tile_key"]
+    assert df.dtypes.tolist() == [np.int64] * 4
+    assert parse_tile_addresses(["x1_y2_z20", "X10_Y21_Z20"]).tolist() == [[1, 2, 20], [10, 21, 20]]
+    with pytest.raises(ValueError):
+        parse_tile_addresses(["x1_z20"])
+
+
+def test_read_tile_index(tmp_path):
+    df = make_tile_index([1, 10], [2, 21], 20)
+    df["otsu_score"] = [0.1, 0.9]
+    write_tile_index(df, tmp_path / "index.parquet")
+
+    # Legacy csv index, with the address as the only tile identity
+    df_csv = pd.DataFrame({"address": df.index, "coordinates": [(1, 2), (10, 21)], "otsu_score": df.otsu_score})
+    df_csv.to_csv(tmp_path / "index.csv", index=False)
+
+    pd.testing.assert_frame_equal(read_tile_index(tmp_path / "index.parquet"), df)
+    pd.testing.assert_frame_equal(read_tile_index(tmp_path / "index.csv"), df)
+
+
+def test_get_params_hash():
+    params = {"tile_size": 128, "magnification": 20, "scorers": ["otsu_score", {"scorer": "otsu_score", "scale": 0.8}]}
+
+    assert get_params_hash(params) == get_params_hash(dict(reversed(list(params.items()))))
+    assert get_params_hash(params) != get_params_hash(dict(params, tile_size=256))
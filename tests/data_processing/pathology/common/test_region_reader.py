@@ -0,0 +1,59 @@
+import itertools
+
+import numpy as np
+import openslide
+import pytest
+import tifffile
+
+from data_processing.pathology.common.preprocess import get_full_resolution_generator
+from data_processing.pathology.common.region_reader import SlideRegionReader
+
+
+@pytest.fixture
+def pyramid_slide_path(tmp_path):
+    rng = np.random.default_rng(seed=0)
+    img = rng.integers(0, 256, size=(1000, 1300, 3), dtype=np.uint8)
+
+    slide_file_path = str(tmp_path / "slide.tif")
+    with tifffile.TiffWriter(slide_file_path) as tw:
+        tw.write(img, tile=(256, 256), photometric='rgb')
+        tw.write(img[::2, ::2].copy(), tile=(256, 256), photometric='rgb', subfiletype=1)
+    return slide_file_path
+
+
+def test_level_zero_matches_deepzoom(pyramid_slide_path):
+    slide = openslide.OpenSlide(pyramid_slide_path)
+    generator, level = get_full_resolution_generator(slide, tile_size=100)
+    reader = SlideRegionReader(slide, full_resolution_tile_size=100, tile_size=70, block_tiles=4)
+
+    assert reader.level == 0
+    for address in itertools.product(range(13), range(10)):
+        expected = generator.get_tile(level, address).resize((70, 70))
+        assert reader.get_tile(address).tobytes() == expected.tobytes()
+
+
+def test_reads_from_lower_resolution_level(pyramid_slide_path):
+    slide = openslide.OpenSlide(pyramid_slide_path)
+    assert slide.level_downsamples == (1.0, 2.0)
+
+    reader = SlideRegionReader(slide, full_resolution_tile_size=128, tile_size=64)
+    assert reader.level == 1
+
+    level_1 = np.array(slide.read_region((0, 0), 1, slide.level_dimensions[1]).convert('RGB'))
+    assert np.array_equal(np.array(reader.get_tile((2, 3))), level_1[3 * 64:4 * 64, 2 * 64:3 * 64])
+
+    # Between levels, read from the more detailed one
+    assert SlideRegionReader(slide, full_resolution_tile_size=128, tile_size=96).level == 0
+
+
+def test_block_cache(pyramid_slide_path):
+    reader = SlideRegionReader(openslide.OpenSlide(pyramid_slide_path), full_resolution_tile_size=100, tile_size=100,
+                               block_tiles=4, cache_size=2)
+
+    for y in range(10):
+        reader.get_tile((0, y))
+    assert (reader.cache_misses, reader.cache_hits) == (3, 7)
+
+    reader.get_tile((1, 0))
+    reader.get_tile((0, 0))
+    assert reader.cache_misses == 5
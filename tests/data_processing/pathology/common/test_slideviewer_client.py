@@ -5,11 +5,16 @@ Created on January 31, 2021
 '''
 import os, sys
 import shutil
+import threading
+from pathlib import Path
+
+import pytest
 import requests
 from data_processing.common.config import ConfigSet
 from data_processing.common.constants import DATA_CFG
 from data_processing.pathology.common.slideviewer_client import get_slide_id, fetch_slide_ids, \
-    download_zip, unzip, download_sv_point_annotation
+    download_zip, unzip, download_sv_point_annotation, get_session, download_zips, download_sv_point_annotations, \
+    download_zip_if_changed
 from tests.data_processing.pathology.common.request_mock import CSVMockResponse, \
     ZIPMockResponse, PointJsonResponse
 
@@ -85,7 +90,7 @@ def test_downlaod_zip(monkeypatch):
     def mock_get(*args, **kwargs):
         return ZIPMockResponse()
 
-    monkeypatch.setattr(requests, "get", mock_get)
+    monkeypatch.setattr(requests.Session, "get", mock_get)
 
     download_zip(SLIDEVIEWER_API_URL, zipfile_path, chunk_size=128)
 
@@ -108,7 +113,7 @@ def test_download_sv_point_annotation(monkeypatch):
     def mock_get(*args, **kwargs):
         return PointJsonResponse()
 
-    monkeypatch.setattr(requests, "get", mock_get)
+    monkeypatch.setattr(requests.Session, "get", mock_get)
 
     import data_processing
     sys.modules['slideviewer_client'] = data_processing.pathology.common.slideviewer_client
@@ -118,3 +123,109 @@ def test_download_sv_point_annotation(monkeypatch):
     assert res == [{"project_id":"8","image_id":"123.svs","label_type":"nucleus","x":"1440","y":"747","class":"0","classname":"Tissue 1"},
                    {"project_id":"8","image_id":"123.svs","label_type":"nucleus","x":"1424","y":"774","class":"3","classname":"Tissue 4"}]
 
+
+
+@pytest.fixture
+def slideviewer_server():
+    """ Local stand-in for the slideviewer api, serving zips with an ETag, point jsons, and failing a few times on /flaky paths """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    zip_bytes = Path('tests/data_processing/pathology/proxy_table/regional_annotation/test_data/input/CMU-1.zip').read_bytes()
+    requests_seen = {"count": 0, "flaky": 0, "ports": set()}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            requests_seen["count"] += 1
+            requests_seen["ports"].add(self.client_address[1])
+
+            if self.path.startswith("/flaky") and requests_seen["flaky"] < 2:
+                requests_seen["flaky"] += 1
+                status, body = 503, b"unavailable"
+            elif self.path.endswith("/getLabelFileBMP") and self.headers.get("If-None-Match") == '"v1"':
+                status, body = 304, b""
+            elif self.path.endswith("/getLabelFileBMP"):
+                status, body = 200, b"Label image not found." if "missing" in self.path else zip_bytes
+            elif self.path.endswith("/getSVGLabels/nucleus"):
+                status, body = 200, b"[]" if "missing" in self.path else PointJsonResponse.content
+            else:
+                status, body = 404, b"not found"
+
+            self.send_response(status)
+            if self.path.endswith("/getLabelFileBMP") and status in (200, 304):
+                self.send_header("ETag", '"v1"')
+                self.send_header("Last-Modified", "Wed, 21 Oct 2026 07:28:00 GMT")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.server_address[1]}", requests_seen
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_zips(tmp_path, slideviewer_server):
+    url, requests_seen = slideviewer_server
+    downloads = [(f"{url}/slides/user{n}/getLabelFileBMP", str(tmp_path / f"{n}.zip")) for n in range(10)]
+    downloads.append((f"{url}/slides/missing/getLabelFileBMP", str(tmp_path / "missing.zip")))
+
+    results = download_zips(downloads, num_threads=4)
+
+    assert [status for status, _, _ in results] == ["downloaded"] * 10 + ["not_found"]
+    assert unzip(str(tmp_path / "3.zip")).read('labels.bmp')[:2] == b'BM'
+    # connections are kept alive and reused across downloads
+    assert len(requests_seen["ports"]) <= 4
+
+
+def test_download_zip_retries(tmp_path, slideviewer_server):
+    url, requests_seen = slideviewer_server
+
+    assert download_zip(f"{url}/flaky/getLabelFileBMP", str(tmp_path / "flaky.zip"), session=get_session(backoff_factor=0)) == True
+    assert requests_seen["count"] == 3
+    assert unzip(str(tmp_path / "flaky.zip")) is not None
+
+    # requests that keep failing are reported as None by the batch download
+    with pytest.raises(requests.HTTPError):
+        download_zip(f"{url}/not_an_api", str(tmp_path / "404.zip"))
+    assert download_zips([(f"{url}/not_an_api", str(tmp_path / "404.zip"))], retries=0) == [None]
+    requests_seen["flaky"] = 0
+    assert download_zips([(f"{url}/flaky/getLabelFileBMP", str(tmp_path / "flaky.zip"))], retries=1) == [None]
+
+
+def test_download_zip_if_changed(tmp_path, slideviewer_server):
+    url, requests_seen = slideviewer_server
+    zip_path = str(tmp_path / "annot.zip")
+
+    status, etag, last_modified = download_zip_if_changed(f"{url}/slides/user/getLabelFileBMP", zip_path)
+    assert (status, etag, last_modified) == ("downloaded", '"v1"', "Wed, 21 Oct 2026 07:28:00 GMT")
+    assert unzip(zip_path) is not None
+
+    os.remove(zip_path)
+    assert download_zip_if_changed(f"{url}/slides/user/getLabelFileBMP", zip_path, etag, last_modified) == ("not_modified", etag, last_modified)
+    assert not os.path.exists(zip_path)
+
+    assert download_zip_if_changed(f"{url}/slides/missing/getLabelFileBMP", zip_path)[0] == "not_found"
+    assert requests_seen["count"] == 3
+
+    # the batch download passes the validators of each zip
+    assert download_zips([(f"{url}/slides/user/getLabelFileBMP", zip_path, etag, last_modified),
+                          (f"{url}/slides/other/getLabelFileBMP", zip_path)]) == \
+        [("not_modified", etag, last_modified), ("downloaded", etag, last_modified)]
+
+
+def test_download_sv_point_annotations(slideviewer_server):
+    url, _ = slideviewer_server
+    urls = [f"{url}/slides/user{n}/getSVGLabels/nucleus" for n in range(5)] + [f"{url}/slides/missing/getSVGLabels/nucleus"]
+
+    results = download_sv_point_annotations(urls, num_threads=3)
+
+    assert results == [PointJsonResponse().json()] * 5 + [None]
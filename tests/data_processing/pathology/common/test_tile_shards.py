@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from data_processing.pathology.common.tile_shards import encode_tile, get_shard_name, write_tile_shard, TileShardReader
+
+
+def _random_tiles(count=5, size=16):
+    rng = np.random.default_rng(seed=0)
+    return rng.integers(0, 256, size=(count, size, size, 3), dtype=np.uint8)
+
+
+@pytest.mark.parametrize("codec", ["png", "webp"])
+def test_lossless_roundtrip(tmp_path, codec):
+    tiles = _random_tiles()
+    addresses = [f"x{i}_y1_z20" for i in range(len(tiles))]
+    shard_path = tmp_path / get_shard_name(0)
+
+    entries = write_tile_shard(shard_path, [(address, encode_tile(Image.fromarray(tile), codec)) for address, tile in zip(addresses, tiles)], codec, 16, "RGB")
+    reader = TileShardReader(shard_path)
+
+    assert [entry[0] for entry in entries] == addresses
+    assert reader.codec == codec and len(reader) == 5
+    for address, tile in zip(addresses, tiles):
+        assert np.array_equal(reader.get_tile(address), tile)
+
+
+def test_jpeg_quality(tmp_path):
+    tile = Image.fromarray(_random_tiles(count=1, size=64)[0])
+
+    assert len(encode_tile(tile, "jpeg", quality=20)) < len(encode_tile(tile, "jpeg", quality=95))
+    with pytest.raises(ValueError):
+        encode_tile(tile, "gif")
+
+
+def test_not_a_shard(tmp_path):
+    (tmp_path / "tiles.slice.pil").write_bytes(_random_tiles().tobytes())
+
+    with pytest.raises(ValueError):
+        TileShardReader(tmp_path / "tiles.slice.pil")
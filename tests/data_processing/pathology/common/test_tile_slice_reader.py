@@ -0,0 +1,72 @@
+import itertools, os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_processing.pathology.common.preprocess import make_tile_index, write_tile_index
+from data_processing.pathology.common.tile_slice_reader import TileSliceReader
+
+
+@pytest.fixture
+def slice_dir(tmp_path):
+    """ Tiles laid out the way save_tiles() writes them """
+    rng = np.random.default_rng(seed=0)
+    tiles = rng.integers(0, 256, size=(6, 16, 16, 3), dtype=np.uint8)
+    (tmp_path / "tiles.slice.pil").write_bytes(tiles.tobytes())
+
+    df = make_tile_index(*zip(*itertools.product(range(1, 4), range(1, 3))), 20)
+    df["tile_image_offset"]  = np.arange(6) * 16 * 16 * 3.0
+    df["tile_image_length"]  = 16 * 16 * 3.0
+    df["tile_image_size_xy"] = 16.0
+    df["tile_image_mode"]    = "RGB"
+    write_tile_index(df, tmp_path / "address.slice.parquet")
+
+    return tmp_path, tiles
+
+
+def test_get_tile(slice_dir):
+    output_dir, tiles = slice_dir
+    reader = TileSliceReader.from_dir(output_dir)
+
+    assert len(reader) == 6
+    assert np.array_equal(reader.get_tile("x1_y2_z20"), tiles[1])
+    assert np.array_equal(reader.get_tile_at(3, 1), tiles[4])
+    assert np.array_equal(reader.get_tiles(["x3_y2_z20", "x1_y1_z20"]), tiles[[5, 0]])
+
+
+def test_legacy_csv_index(slice_dir):
+    output_dir, tiles = slice_dir
+    df = pd.read_parquet(output_dir / "address.slice.parquet").drop(columns=["x", "y", "z", "tile_key"])
+    df.to_csv(output_dir / "address.slice.csv", index=False)
+    os.remove(output_dir / "address.slice.parquet")
+
+    reader = TileSliceReader.from_dir(output_dir)
+
+    assert np.array_equal(reader.get_tile_at(3, 1), tiles[4])
+
+
+def test_get_batch_is_zero_copy(slice_dir):
+    output_dir, tiles = slice_dir
+    reader = TileSliceReader.from_dir(output_dir)
+
+    batch = reader.get_batch(2, 5)
+
+    assert np.array_equal(batch, tiles[2:5])
+    assert np.shares_memory(batch, reader.get_tile("x2_y1_z20"))
+
+
+def test_from_parquet(slice_dir):
+    output_dir, tiles = slice_dir
+    (output_dir / "other.slice.pil").write_bytes(tiles[::-1].tobytes())
+
+    df = pd.read_parquet(output_dir / "address.slice.parquet")
+    df_collected = pd.concat([df.assign(data_path=str(output_dir / "tiles.slice.pil")),
+                              df.assign(data_path=str(output_dir / "other.slice.pil"))])
+    df_collected.to_parquet(output_dir / "collected.parquet")
+
+    readers = list(TileSliceReader.from_parquet(output_dir / "collected.parquet"))
+
+    assert len(readers) == 2
+    assert [address for address, tile in readers[0]][:3] == ["x1_y1_z20", "x1_y2_z20", "x2_y1_z20"]
+    assert np.array_equal(readers[1].get_tile("x1_y1_z20"), tiles[5])
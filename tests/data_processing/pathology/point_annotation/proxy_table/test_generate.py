@@ -1,12 +1,14 @@
 import pytest
-import os, shutil, sys
+import os, shutil, sys, json
 import requests
+import pandas as pd
 
 from data_processing.common.config import ConfigSet
 from data_processing.common.sparksession import SparkConfig
 import data_processing.common.constants as const
 from data_processing.pathology.point_annotation.proxy_table import generate
-from data_processing.pathology.point_annotation.proxy_table.generate import create_proxy_table, download_point_annotation
+from data_processing.pathology.point_annotation.proxy_table.generate import create_proxy_table, download_point_annotation, \
+    download_point_annotations
 from tests.data_processing.pathology.common.request_mock import PointJsonResponse
 
 point_json_table_path = "tests/data_processing/pathology/point_annotation/testdata/test-project/tables/POINT_RAW_JSON_ds"
@@ -34,7 +36,7 @@ def test_download_point_annotation(monkeypatch):
     def mock_get(*args, **kwargs):
         return PointJsonResponse()
 
-    monkeypatch.setattr(requests, "get", mock_get)
+    monkeypatch.setattr(requests.Session, "get", mock_get)
 
     import data_processing
     sys.modules['slideviewer_client'] = data_processing.pathology.common.slideviewer_client
@@ -45,13 +47,32 @@ def test_download_point_annotation(monkeypatch):
                    {"project_id":"8","image_id":"123.svs","label_type":"nucleus","x":"1424","y":"774","class":"3","classname":"Tissue 4"}]
 
 
+def test_download_point_annotations(monkeypatch):
+
+    def mock_get(session, url, *args, **kwargs):
+        return PointJsonResponse()
+
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+
+    import data_processing
+    sys.modules['slideviewer_client'] = data_processing.pathology.common.slideviewer_client
+
+    batch = pd.DataFrame({"slideviewer_path": ["123.svs", "456.svs"], "sv_project_id": [8, 8], "user": ["jill", "joe"]})
+    res = pd.concat(download_point_annotations(iter([batch]), 'http://test'))
+
+    assert list(res.user) == ["jill", "joe"]
+    assert [json.loads(sv_json) for sv_json in res.sv_json] == [PointJsonResponse().json()] * 2
+
+
 def test_create_proxy_table(monkeypatch):
 
-    def mock_download(*args, **kwargs):
-        return [{"project_id":"8","image_id":"123.svs","label_type":"nucleus","x":"1440","y":"747","class":"0","classname":"Tissue 1"},
-                {"project_id":"8","image_id":"123.svs","label_type":"nucleus","x":"1424","y":"774","class":"3","classname":"Tissue 4"}]
+    def mock_download(batches, slideviewer_url):
+        sv_json = [{"project_id":"8","image_id":"123.svs","label_type":"nucleus","x":"1440","y":"747","class":"0","classname":"Tissue 1"},
+                   {"project_id":"8","image_id":"123.svs","label_type":"nucleus","x":"1424","y":"774","class":"3","classname":"Tissue 4"}]
+        for batch in batches:
+            yield batch.assign(sv_json=json.dumps(sv_json))
 
-    monkeypatch.setattr(generate, "download_point_annotation", mock_download)
+    monkeypatch.setattr(generate, "download_point_annotations", mock_download)
 
     create_proxy_table()
 
@@ -13,7 +13,7 @@ from data_processing.common.config import ConfigSet
 from data_processing.common.sparksession import SparkConfig
 from data_processing.pathology.proxy_table.regional_annotation import generate
 from data_processing.pathology.proxy_table.regional_annotation.generate import cli, convert_bmp_to_npy, \
-    create_proxy_table, process_regional_annotation_slide_row_pandas
+    create_proxy_table, process_regional_annotation_slide_row_pandas, process_regional_annotation_slide_rows
 import data_processing.common.constants as const
 from tests.data_processing.pathology.common.request_mock import CSVMockResponse, \
     ZIPMockResponse
@@ -59,18 +59,22 @@ def test_process_regional_annotation_slide_row_pandas(monkeypatch):
     monkeypatch.setenv("HDFS_URI", "")
 
     import data_processing
+    import data_processing.pathology.common.annotation_rle
     sys.modules['slideviewer_client'] = data_processing.pathology.common.slideviewer_client
+    sys.modules['annotation_rle'] = data_processing.pathology.common.annotation_rle
+    sys.modules['bmp_converter'] = data_processing.pathology.common.bmp_converter
+    sys.modules['pull_state'] = data_processing.pathology.common.pull_state
 
     # mock request to slideviewer api
-    def mock_get(*args, **kwargs):
-        if 'exportProjectCSV' in args[0]:
+    def mock_get(session, url, *args, **kwargs):
+        if 'exportProjectCSV' in url:
             return CSVMockResponse()
-        elif 'getLabelFileBMP' in args[0]:
+        elif 'getLabelFileBMP' in url:
             return ZIPMockResponse()
         else:
             return None
 
-    monkeypatch.setattr(requests, "get", mock_get)
+    monkeypatch.setattr(requests.Session, "get", mock_get)
 
     data = {'slideviewer_path': ['CMU-1.svs'],
             'slide_id': ['CMU-1'],
@@ -81,9 +85,17 @@ def test_process_regional_annotation_slide_row_pandas(monkeypatch):
             'date_updated': ['2021-02-02 10:07:55.802143'],
             'bmp_record_uuid': [''],
             'latest': [True],
+            'npy_filepath': [''],
             'SLIDE_BMP_DIR': ['tests/data_processing/pathology/proxy_table/regional_annotation/test_data/output/regional_bmps'],
             'TMP_ZIP_DIR': ['tests/data_processing/pathology/proxy_table/regional_annotation/test_data/output/gynocology_tmp_zips'],
-            'SLIDEVIEWER_API_URL':['https://fakeslides-res.mskcc.org/']}
+            'SLIDEVIEWER_API_URL':['https://fakeslides-res.mskcc.org/'],
+            'SLIDE_NPY_DIR': ['tests/data_processing/pathology/proxy_table/regional_annotation/test_data/output/regional_npys'],
+            'ANNOTATION_FORMAT': ['npy'],
+            'content_hash': [''],
+            'content_length': [-1],
+            'etag': [''],
+            'last_modified': [''],
+            'pull_status': ['']}
 
     df = pandas.DataFrame(data=data)
 
@@ -93,13 +105,36 @@ def test_process_regional_annotation_slide_row_pandas(monkeypatch):
                                         '/test_data/output/regional_bmps/CMU-1' \
                                         '/CMU-1_someuser_SVBMP-90649b2e6e64b4925eed1f32bb68560ade249a9c3bf8e9b27bebebe005638375_annot.bmp'
     assert df['bmp_record_uuid'].item() == 'SVBMP-90649b2e6e64b4925eed1f32bb68560ade249a9c3bf8e9b27bebebe005638375'
+    assert df['npy_filepath'].item() == 'tests/data_processing/pathology/proxy_table/regional_annotation' \
+                                        '/test_data/output/regional_npys/CMU-1' \
+                                        '/CMU-1_someuser_SVBMP-90649b2e6e64b4925eed1f32bb68560ade249a9c3bf8e9b27bebebe005638375_annot.npy'
+    assert os.path.exists(df['npy_filepath'].item())
+    assert df['pull_status'].item() == 'changed'
+    assert df['content_hash'].item() == df['bmp_record_uuid'].item()
+    assert df['content_length'].item() > 0
+
+    # same bitmap as the last pull, not converted again
+    data['content_hash'] = [df['content_hash'].item()]
+    df = process_regional_annotation_slide_row_pandas(pandas.DataFrame(data=data))
+
+    assert df['pull_status'].item() == 'unchanged'
+    assert df['npy_filepath'].item() == 'n/a'
+
+    # batches of rows are downloaded together, then converted
+    data['content_hash'] = ['']
+    batch = pandas.concat([pandas.DataFrame(data=data), pandas.DataFrame(data=dict(data, user=['otheruser']))], ignore_index=True)
+    df = pandas.concat(process_regional_annotation_slide_rows(iter([batch.iloc[:0], batch])))
+
+    assert list(df['user']) == ['someuser', 'otheruser']
+    assert list(df['pull_status']) == ['changed', 'changed']
+    assert all(os.path.exists(npy_filepath) for npy_filepath in df['npy_filepath'])
 
 
 def test_create_proxy_table(monkeypatch):
     monkeypatch.setenv("MIND_GPFS_DIR", "")
     monkeypatch.setenv("HDFS_URI", "")
 
-    def mock_process(row:  pandas.DataFrame)-> pandas.DataFrame:
+    def mock_process(batches):
         data = {'slideviewer_path': ['CMU-1.svs'],
                 'slide_id': ['CMU-1'],
                 'sv_project_id': [155],
@@ -109,16 +144,26 @@ def test_create_proxy_table(monkeypatch):
                 'date_updated': [1612403271],
                 'bmp_record_uuid': ['SVBMP-90836da'],
                 'latest': [True],
+                'npy_filepath': ['tests/data_processing/pathology/proxy_table/regional_annotation/test_data/output/regional_npys/input/labels.npy'],
                 'SLIDE_BMP_DIR': [
                     'tests/data_processing/pathology/proxy_table/regional_annotation/test_data/output/regional_bmps'],
                 'TMP_ZIP_DIR': [
                     'tests/data_processing/pathology/proxy_table/regional_annotation/test_data/output/gynocology_tmp_zips'],
-                'SLIDEVIEWER_API_URL': ['https://fakeslides-res.mskcc.org/']}
+                'SLIDEVIEWER_API_URL': ['https://fakeslides-res.mskcc.org/'],
+                'SLIDE_NPY_DIR': [
+                    'tests/data_processing/pathology/proxy_table/regional_annotation/test_data/output/regional_npys'],
+                'ANNOTATION_FORMAT': ['npy'],
+                'content_hash': ['SVBMP-90836da'],
+                'content_length': [1024],
+                'etag': [''],
+                'last_modified': [''],
+                'pull_status': ['changed']}
 
-        return pandas.DataFrame(data=data)
+        for batch in batches:
+            yield pandas.DataFrame(data=data).iloc[:len(batch)]
 
 
-    monkeypatch.setattr(generate, "process_regional_annotation_slide_row_pandas",
+    monkeypatch.setattr(generate, "process_regional_annotation_slide_rows",
                         mock_process)
 
     assert create_proxy_table() == 0  # exit code
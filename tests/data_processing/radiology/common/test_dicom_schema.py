@@ -0,0 +1,20 @@
+from pyspark.sql.types import StringType, IntegerType, DoubleType
+from data_processing.radiology.common.dicom_schema import get_promoted_schema, get_promoted_values
+
+
+def test_get_promoted_schema():
+    schema = get_promoted_schema(["SeriesInstanceUID", "InstanceNumber", "SliceThickness", "NotADicomTag"])
+
+    assert [field.dataType for field in schema] == [StringType(), IntegerType(), DoubleType(), StringType()]
+
+
+def test_get_promoted_values():
+    metadatas = [{"InstanceNumber": "71", "SliceThickness": "1.1", "ImagePositionPatient": "163.71//104.648//37.1251"},
+                 {"InstanceNumber": "x"},
+                 {}]
+
+    assert get_promoted_values(metadatas, "InstanceNumber") == [71, None, None]
+    assert get_promoted_values(metadatas, "SliceThickness") == [1.1, None, None]
+    # multi-valued numbers aren't promoted
+    assert get_promoted_values(metadatas, "ImagePositionPatient") == [None, None, None]
+    assert get_promoted_values(metadatas, "PatientID") == [None, None, None]
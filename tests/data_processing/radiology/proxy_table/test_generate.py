@@ -42,3 +42,72 @@ def test_cli(spark):
     assert "dicom_record_uuid" in df.columns
     assert "metadata" in df.columns
     df.unpersist()
+
+
+def test_cli_incremental(spark, tmp_path):
+    incremental_template = str(tmp_path / "data_ingestion_template_incremental.yml")
+    with open('tests/data_processing/data_ingestion_template_valid.yml') as fp:
+        template = fp.read()
+    with open(incremental_template, 'w') as fp:
+        fp.write(template + "\nINCREMENTAL: True\n")
+
+    runner = CliRunner()
+    for _ in range(2):
+        result = runner.invoke(cli,
+            ['-t', incremental_template,
+            '-f', 'tests/test_config.yaml',
+            '-p', 'delta'])
+
+        assert result.exit_code == 0
+
+    # the unchanged dicom isn't parsed again
+    dicom_path = landing_path + const.DICOM_TABLE
+    assert spark.read.format("delta").load(dicom_path).count() == 1
+    assert get_write_count(spark, dicom_path) == 0
+
+
+def test_cli_incremental_deleted_dicom(spark, tmp_path):
+    incremental_template = str(tmp_path / "data_ingestion_template_incremental.yml")
+    with open('tests/data_processing/data_ingestion_template_valid.yml') as fp:
+        template = fp.read()
+    with open(incremental_template, 'w') as fp:
+        fp.write(template + "\nINCREMENTAL: True\n")
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['-t', incremental_template, '-f', 'tests/test_config.yaml', '-p', 'delta'])
+    assert result.exit_code == 0
+
+    # a dicom ingested before, and deleted from RAW_DATA_PATH since
+    dicom_path = landing_path + const.DICOM_TABLE
+    from pyspark.sql.functions import lit
+    spark.read.format("delta").load(dicom_path).withColumn("path", lit("file:/deleted/1.dcm")) \
+        .write.format("delta").mode("append").save(dicom_path)
+
+    result = runner.invoke(cli, ['-t', incremental_template, '-f', 'tests/test_config.yaml', '-p', 'delta'])
+    assert result.exit_code == 0
+
+    df = spark.read.format("delta").load(dicom_path)
+    assert df.count() == 1
+    assert df.filter(df.path == "file:/deleted/1.dcm").count() == 0
+
+
+def test_cli_incremental_promoted_tags_changed(spark, tmp_path):
+    with open('tests/data_processing/data_ingestion_template_valid.yml') as fp:
+        template = fp.read()
+
+    runner = CliRunner()
+    for n, promoted_tags in enumerate(["[PatientID]", "[PatientID, SeriesNumber]"]):
+        incremental_template = str(tmp_path / f"data_ingestion_template_incremental_{n}.yml")
+        with open(incremental_template, 'w') as fp:
+            fp.write(template + "\nINCREMENTAL: True\nPROMOTED_TAGS: " + promoted_tags + "\n")
+
+        result = runner.invoke(cli, ['-t', incremental_template, '-f', 'tests/test_config.yaml', '-p', 'delta'])
+        assert result.exit_code == 0
+
+    # the table is rebuilt with the new promoted columns, instead of merged into
+    dicom_path = landing_path + const.DICOM_TABLE
+    df = spark.read.format("delta").load(dicom_path)
+    assert df.count() == 1
+    assert "SeriesNumber" in df.columns
+    assert df.filter(df.SeriesNumber.isNull()).count() == 0
+    assert get_write_count(spark, dicom_path) == 1
@@ -0,0 +1,70 @@
+import os
+import sys
+import glob
+
+import pytest
+import pydicom
+from io import BytesIO
+import pandas as pd
+import data_processing.common.EnsureByteContext
+from data_processing.common.utils import generate_uuid_binary
+from data_processing.radiology.common.dicom_schema import PROMOTED_TAGS
+from data_processing.radiology.proxy_table.generate import parse_dicom_from_delta_record, parse_dicom_header_from_path, \
+    read_dicom_header, get_dicom_metadata, hash_and_parse_dicoms
+
+sys.modules['EnsureByteContext'] = data_processing.common.EnsureByteContext
+
+dicom_files = sorted(glob.glob("tests/data_processing/radiology/testdata/test-project/dicoms/*.dcm"))
+
+
+@pytest.mark.parametrize("dicom_file", dicom_files)
+def test_parse_dicom_header_from_path(dicom_file):
+    with open(dicom_file, 'rb') as fp:
+        expected = parse_dicom_from_delta_record(dicom_file, fp.read())
+
+    assert parse_dicom_header_from_path("file:" + os.path.abspath(dicom_file)) == expected
+
+
+def _header_length(dicom_file):
+    with open(dicom_file, 'rb') as fp:
+        leading_bytes = BytesIO(fp.read())
+    pydicom.dcmread(leading_bytes, stop_before_pixels=True)
+    return leading_bytes.tell()
+
+
+# just past the preamble and DICM prefix, cut in the middle of an element (struct.error), one byte short of the
+# header, and the whole header
+@pytest.mark.parametrize("read_bytes", [lambda _: 133, lambda _: 736, lambda header: header - 1, lambda header: header],
+                         ids=["past_prefix", "mid_element", "header_minus_1", "whole_header"])
+def test_read_dicom_header_long_header(read_bytes):
+    # headers longer than the leading bytes, cut short with or without a parse error, are read from the file
+    dicom_file = dicom_files[0]
+    with open(dicom_file, 'rb') as fp:
+        expected = parse_dicom_from_delta_record(dicom_file, fp.read())
+
+    dataset = read_dicom_header("file:" + os.path.abspath(dicom_file), read_bytes(_header_length(dicom_file)))
+
+    assert "PixelData" not in dataset
+    assert get_dicom_metadata(dataset) == expected
+
+
+@pytest.mark.parametrize("with_content", [True, False])
+def test_hash_and_parse_dicoms(with_content):
+    contents = [open(dicom_file, 'rb').read() for dicom_file in dicom_files]
+    batch = pd.DataFrame({"path": ["file:" + os.path.abspath(dicom_file) for dicom_file in dicom_files],
+                          "modificationTime": pd.Timestamp("2021-03-01"),
+                          "length": [len(content) for content in contents]})
+    if with_content:
+        batch["content"] = contents
+
+    results = list(hash_and_parse_dicoms(iter([batch.iloc[:2], batch.iloc[2:]])))
+    result = pd.concat(results, ignore_index=True)
+
+    assert list(result.columns) == ["path", "modificationTime", "length", "dicom_record_uuid"] + PROMOTED_TAGS + \
+        ["metadata"]
+    assert list(result.path) == list(batch.path)
+    for dicom_file, content, row in zip(dicom_files, contents, result.itertuples()):
+        assert row.dicom_record_uuid == generate_uuid_binary(content, ["DICOM"])
+        assert row.metadata == parse_dicom_from_delta_record(dicom_file, content)
+        assert row.SeriesInstanceUID == row.metadata["SeriesInstanceUID"]
+        assert row.InstanceNumber == int(row.metadata["InstanceNumber"])